@@ -0,0 +1,344 @@
+# Benchmarks of the retrieval, relevance, metric and fusion hot paths on synthetic data.
+#
+#   cd ir_system
+#   python -m benchmarks.run_benchmarks --scales 1000 10000 --save benchmarks/baseline.json
+#   python -m benchmarks.run_benchmarks --scales 1000 10000 --compare benchmarks/baseline.json
+#
+# Each stage reports throughput (queries/s), latency percentiles (per query for
+# per-query stages, per call for batched stages) and peak traced memory.
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import make_catalogue, make_system_results
+from scripts.evaluation_metrics import beyond_accuracy_metrics, evaluate_metrics
+from scripts.late_fusion import LateFusion, system_from_content
+from scripts.metric_kernels import evaluate_retrieved
+from scripts.relevance_computation import TagIndex, compute_weighted_jaccard
+from scripts.retrieval_by_similarity import retrieve_n_songs_by_similarity, top_k_by_similarity
+
+
+BENCHMARK_FORMAT_VERSION = 1
+
+# Configuration entries that change the measured workload; reports are only comparable when they match
+COMPARABLE_CONFIG_KEYS = ("dim", "n_tags", "n_queries", "N", "seed")
+
+
+class Context:
+    """Synthetic catalogue and shared objects of one scale."""
+
+    def __init__(self, n_songs, dim, n_tags, n_queries, N, seed):
+        self.dataset, self.feature_columns = make_catalogue(n_songs, dim, n_tags, seed=seed)
+        self.N = N
+        self.tag_index = TagIndex.from_dataset(self.dataset)
+        rng = np.random.default_rng(seed)
+        self.query_indices = np.sort(rng.choice(n_songs, min(n_queries, n_songs), replace=False))
+        self.query_ids = self.dataset["id"].values[self.query_indices]
+        self.matrix = self.dataset[self.feature_columns].values
+        self.fusion_systems = make_system_results(self.dataset, self.query_ids, k=max(N, 100), seed=seed)
+        retrieved, _ = top_k_by_similarity(self.query_indices, self.matrix, k=N)
+        self.retrieved_ids = self.dataset["id"].values[retrieved]
+
+
+def _weighted_jaccard_query(context, query_index):
+    query_tags = context.dataset["(tag, weight)"].iloc[query_index]
+    return [compute_weighted_jaccard(query_tags, tags) for tags in context.dataset["(tag, weight)"]]
+
+
+def _relevance_query(context, query_index):
+    context.tag_index.clear_cache()
+    return context.tag_index.relevance_for_id(context.dataset["id"].iloc[query_index])
+
+
+def _late_fusion_batch(context):
+    systems = {name: system_from_content(content, context.query_ids) for name, content in context.fusion_systems.items()}
+    fusion = LateFusion(context.query_ids, systems, "minmax")
+    return fusion.fuse("weighted", N=context.N)
+
+
+# Stage name -> (kind, function). Per-query stages are called once per query index,
+# batched stages once per repeat with all queries.
+STAGES = {
+    "retrieve_n_songs_by_similarity": (
+        "query",
+        lambda c, q: retrieve_n_songs_by_similarity(c.dataset.iloc[q], c.dataset, c.feature_columns, "cosine", c.N),
+    ),
+    "top_k_by_similarity": ("batch", lambda c: top_k_by_similarity(c.query_indices, c.matrix, k=c.N)),
+    "compute_weighted_jaccard": ("query", _weighted_jaccard_query),
+    "tag_index_relevance": ("query", _relevance_query),
+    "evaluate_metrics": (
+        "query",
+        lambda c, q: evaluate_metrics(c.dataset.iloc[q], c.dataset, c.feature_columns, "cosine", c.N, tag_index=c.tag_index),
+    ),
+    "evaluate_retrieved": ("batch", lambda c: evaluate_retrieved(c.tag_index, c.query_ids, c.retrieved_ids, k=c.N)),
+    "beyond_accuracy_metrics": (
+        "query",
+        lambda c, q: beyond_accuracy_metrics(
+            [q], c.dataset, c.feature_columns, ["cosine"], "(tag, weight)", "popularity", c.N
+        ),
+    ),
+    "late_fusion": ("batch", _late_fusion_batch),
+}
+
+
+def _peak_memory_mb(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+@contextlib.contextmanager
+def _silenced():
+    """Discard stdout and stderr (the evaluation functions print and show tqdm bars)."""
+    stdout, stderr = sys.stdout, sys.stderr
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = sys.stderr = devnull
+        try:
+            yield
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+
+def run_stage(context, stage, max_queries=None, repeats=5):
+    """
+    Benchmark one stage on a context.
+
+    Returns
+    -------
+        dict
+            stage, unit, calls, qps, p50_ms, p90_ms, p99_ms, mean_ms and peak_mb.
+    """
+    kind, function = STAGES[stage]
+    # Output is silenced once around the whole stage, not inside the timed calls
+    with _silenced():
+        if kind == "query":
+            query_indices = context.query_indices[:max_queries]
+            function(context, query_indices[0])  # warm-up
+            latencies = []
+            for q in query_indices:
+                start = time.perf_counter()
+                function(context, q)
+                latencies.append(time.perf_counter() - start)
+            n_queries = len(query_indices)
+            peak_mb = _peak_memory_mb(lambda: function(context, query_indices[0]))
+        else:
+            function(context)  # warm-up
+            latencies = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                function(context)
+                latencies.append(time.perf_counter() - start)
+            n_queries = len(context.query_indices) * repeats
+            peak_mb = _peak_memory_mb(lambda: function(context))
+
+    latencies_ms = np.asarray(latencies) * 1000
+    return {
+        "stage": stage,
+        "unit": kind,
+        "calls": len(latencies),
+        "qps": n_queries / (latencies_ms.sum() / 1000),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p90_ms": float(np.percentile(latencies_ms, 90)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "mean_ms": float(latencies_ms.mean()),
+        "peak_mb": peak_mb,
+    }
+
+
+def run_benchmarks(
+    scales=(1000, 10000),
+    dim=128,
+    n_tags=1000,
+    n_queries=100,
+    N=10,
+    stages=None,
+    max_queries=20,
+    repeats=5,
+    seed=42,
+):
+    """
+    Run the selected stages at every catalogue size.
+
+    Args
+    ----
+        scales
+            Catalogue sizes (number of songs).
+        dim
+            Embedding dimension.
+        n_tags
+            Tag vocabulary size.
+        n_queries
+            Number of queries of the batched stages.
+        N
+            Number of retrieved songs.
+        stages
+            Names of STAGES to run (defaults to all).
+        max_queries
+            Number of queries timed for per-query stages (the slow reference paths).
+        repeats
+            Number of timed calls of batched stages.
+        seed
+            Random seed for the data and the queries.
+
+    Returns
+    -------
+        dict
+            Baseline document: environment, configuration and one result per stage and scale.
+    """
+    stages = list(stages or STAGES)
+    results = []
+    for n_songs in scales:
+        context = Context(n_songs, dim, n_tags, n_queries, N, seed)
+        for stage in stages:
+            result = run_stage(context, stage, max_queries, repeats)
+            results.append({"n_songs": n_songs, "dim": dim, **result})
+            print(
+                f"{stage:32s} n={n_songs:>8d}  {result['qps']:>10.1f} q/s  "
+                f"p50 {result['p50_ms']:>9.2f} ms  p99 {result['p99_ms']:>9.2f} ms  "
+                f"peak {result['peak_mb']:>8.1f} MB"
+            )
+    return {
+        "version": BENCHMARK_FORMAT_VERSION,
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": {
+            "scales": list(scales),
+            "dim": dim,
+            "n_tags": n_tags,
+            "n_queries": n_queries,
+            "N": N,
+            "max_queries": max_queries,
+            "repeats": repeats,
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+
+def save_baseline(report, path):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=4)
+
+
+def load_baseline(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def config_mismatches(report, baseline):
+    """Configuration entries (see COMPARABLE_CONFIG_KEYS) that differ: key -> (report value, baseline value)."""
+    mismatches = {}
+    for key in COMPARABLE_CONFIG_KEYS:
+        current, previous = report["config"].get(key), baseline.get("config", {}).get(key)
+        if current != previous:
+            mismatches[key] = (current, previous)
+    if report.get("version") != baseline.get("version"):
+        mismatches["version"] = (report.get("version"), baseline.get("version"))
+    return mismatches
+
+
+def compare_to_baseline(report, baseline, tolerance=0.2, allow_config_mismatch=False):
+    """
+    Compare a report to a baseline, stage by stage and scale by scale.
+
+    A result regresses when its throughput dropped, or its p50 latency or peak memory
+    grew, by more than `tolerance` (relative). Reports measured on a different workload
+    (dimension, tags, queries, N, seed or format version) are not comparable.
+
+    Args
+    ----
+        report
+            Report of `run_benchmarks`.
+        baseline
+            Saved baseline report.
+        tolerance
+            Relative change counted as a regression.
+        allow_config_mismatch
+            Compare anyway, with a warning, when the configurations differ.
+
+    Returns
+    -------
+        pandas.DataFrame
+            One row per (stage, n_songs) present in both, with the relative changes and
+            a `regression` flag.
+    """
+    mismatches = config_mismatches(report, baseline)
+    if mismatches:
+        details = ", ".join(f"{key}={current!r} (baseline {previous!r})" for key, (current, previous) in mismatches.items())
+        if not allow_config_mismatch:
+            raise ValueError(f"The report is not comparable to the baseline: {details}.")
+        warnings.warn(f"Comparing reports with different configurations: {details}.", stacklevel=2)
+    current = pd.DataFrame(report["results"]).set_index(["stage", "n_songs"])
+    previous = pd.DataFrame(baseline["results"]).set_index(["stage", "n_songs"])
+    common = current.index.intersection(previous.index)
+    comparison = pd.DataFrame(
+        {
+            "qps": current.loc[common, "qps"],
+            "baseline_qps": previous.loc[common, "qps"],
+            "qps_change": current.loc[common, "qps"] / previous.loc[common, "qps"] - 1,
+            "p50_change": current.loc[common, "p50_ms"] / previous.loc[common, "p50_ms"] - 1,
+            "peak_mb_change": current.loc[common, "peak_mb"] / previous.loc[common, "peak_mb"].clip(lower=1e-9) - 1,
+        }
+    )
+    comparison["regression"] = (
+        (comparison["qps_change"] < -tolerance)
+        | (comparison["p50_change"] > tolerance)
+        | (comparison["peak_mb_change"] > tolerance)
+    )
+    return comparison.reset_index()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ir_system hot paths on synthetic data.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--tags", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--N", type=int, default=10)
+    parser.add_argument("--stages", nargs="*", default=None, choices=list(STAGES))
+    parser.add_argument("--max-queries", type=int, default=20)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--save", help="Write the report as a JSON baseline.")
+    parser.add_argument("--compare", help="Compare against a saved JSON baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument(
+        "--allow-config-mismatch", action="store_true", help="Compare even if the baseline used another configuration."
+    )
+    args = parser.parse_args()
+
+    report = run_benchmarks(
+        args.scales, args.dim, args.tags, args.queries, args.N, args.stages, args.max_queries, args.repeats, args.seed
+    )
+    if args.save:
+        save_baseline(report, args.save)
+        print(f"Baseline saved to {args.save}")
+    if args.compare:
+        comparison = compare_to_baseline(
+            report, load_baseline(args.compare), args.tolerance, args.allow_config_mismatch
+        )
+        print(comparison.to_string(index=False))
+        if comparison["regression"].any():
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+
+
+def make_tags(n_songs, n_tags=1000, mean_tags=6, max_tags=30, zipf_exponent=1.1, seed=42):
+    """
+    Synthetic '(tag, weight)' dicts shaped like id_tags_dict.tsv.
+
+    Tag popularity follows a Zipf law (a few tags such as 'rock' are on many songs),
+    the number of tags per song is Poisson (some songs have none) and weights are
+    integers in [0, 100] skewed towards low values, like Last.fm tag weights.
+
+    Args
+    ----
+        n_songs
+            Number of songs.
+        n_tags
+            Vocabulary size.
+        mean_tags
+            Mean number of tags per song.
+        max_tags
+            Maximum number of tags per song.
+        zipf_exponent
+            Exponent of the tag frequency distribution; higher means more skewed.
+        seed
+            Random seed.
+
+    Returns
+    -------
+        list
+            One {tag: weight} dict per song.
+    """
+    rng = np.random.default_rng(seed)
+    tag_names = np.array([f"tag{i}" for i in range(n_tags)])
+    tag_probabilities = 1 / np.arange(1, n_tags + 1) ** zipf_exponent
+    tag_probabilities /= tag_probabilities.sum()
+
+    counts = np.minimum(rng.poisson(mean_tags, n_songs), min(max_tags, n_tags))
+    tags = []
+    for count in counts:
+        chosen = rng.choice(n_tags, count, replace=False, p=tag_probabilities)
+        weights = np.minimum(np.round(100 * rng.beta(0.7, 2.0, count)), 100).astype(int)
+        tags.append(dict(zip(tag_names[chosen].tolist(), weights.tolist())))
+    return tags
+
+
+def make_embeddings(n_songs, dim=128, n_clusters=50, noise=0.5, seed=42):
+    """(n_songs x dim) float32 embeddings drawn around random cluster centres."""
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(n_clusters, dim))
+    assignment = rng.integers(0, n_clusters, n_songs)
+    return (centres[assignment] + noise * rng.normal(size=(n_songs, dim))).astype(np.float32)
+
+
+def make_catalogue(n_songs=10000, dim=128, n_tags=1000, mean_tags=6, zipf_exponent=1.1, seed=42):
+    """
+    Synthetic MMSR-shaped dataset: 'id', feature columns f0..f{dim-1}, '(tag, weight)'
+    dicts, 'genre' and a long-tailed 'popularity'.
+
+    Returns
+    -------
+        tuple
+            (dataset, feature_columns)
+    """
+    rng = np.random.default_rng(seed)
+    feature_columns = [f"f{i}" for i in range(dim)]
+    dataset = pd.DataFrame(make_embeddings(n_songs, dim, seed=seed), columns=feature_columns)
+    dataset.insert(0, "id", [f"song{i:07d}" for i in range(n_songs)])
+    dataset["(tag, weight)"] = make_tags(n_songs, n_tags, mean_tags, zipf_exponent=zipf_exponent, seed=seed)
+    dataset["genre"] = [[f"genre{g}"] for g in rng.integers(0, 20, n_songs)]
+    dataset["popularity"] = np.round(rng.pareto(1.5, n_songs) * 10, 2)
+    return dataset, feature_columns
+
+
+def make_system_results(dataset, query_ids, n_systems=2, k=100, seed=42):
+    """
+    Synthetic precomputed systems for late fusion: {system: {query_id: {id: score}}}
+    with random candidates (partly shared between systems) and descending scores.
+    """
+    rng = np.random.default_rng(seed)
+    ids = dataset["id"].values
+    shared = {query_id: rng.choice(len(ids), k // 2, replace=False) for query_id in query_ids}
+    systems = {}
+    for s in range(n_systems):
+        content = {}
+        for query_id in query_ids:
+            rows = np.unique(np.concatenate([shared[query_id], rng.choice(len(ids), k - k // 2, replace=False)]))[:k]
+            scores = np.sort(rng.random(len(rows)))[::-1]
+            content[query_id] = dict(zip(ids[rng.permutation(rows)].tolist(), scores.tolist()))
+        systems[f"system{s}"] = content
+    return systems
@@ -0,0 +1,355 @@
+import json
+import os
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from scripts.embedding_store import DEFAULT_STORE_DIR
+from scripts.metric_kernels import batch_metrics, batch_relevance
+from scripts.retrieval_by_similarity import prepare_feature_matrix, top_k_by_similarity, top_k_rows
+
+
+# Default ANN settings for the high-dimensional feature spaces; others use exact search
+DEFAULT_ANN_CONFIG = {
+    "BERT": {"n_lists": 256, "n_probe": 16},
+    "VGG19": {"n_lists": 256, "n_probe": 16},
+    "Inception": {"n_lists": 256, "n_probe": 16},
+}
+
+
+def _assign(vectors, centroids, metric, chunk_size=4096):
+    """Nearest centroid of every vector (max inner product for cosine, min distance for euclidean)."""
+    centroid_squared_norms = np.einsum("ij,ij->i", centroids, centroids)
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        products = vectors[start : start + chunk_size] @ centroids.T
+        if metric == "cosine":
+            assignment[start : start + chunk_size] = np.argmax(products, axis=1)
+        else:
+            assignment[start : start + chunk_size] = np.argmin(centroid_squared_norms - 2 * products, axis=1)
+    return assignment
+
+
+def _kmeans(vectors, n_lists, metric, n_iter=20, seed=42):
+    """Plain Lloyd k-means; spherical (re-normalised centroids) for cosine."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+        assignment = _assign(vectors, centroids, metric)
+        counts = np.bincount(assignment, minlength=n_lists)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Re-seed empty lists with random points
+        centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        if metric == "cosine":
+            norms = np.linalg.norm(centroids, axis=1)
+            norms[norms == 0] = 1
+            centroids /= norms[:, None]
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted-file (IVF) approximate nearest-neighbour index in pure NumPy.
+
+    Songs are clustered into `n_lists` lists with k-means; a query is scored exactly
+    against the songs of its `n_probe` closest lists only. Scores are the same as the
+    exact engine's, so results differ only by the neighbours that are never probed.
+
+    Args
+    ----
+        metric
+            Similarity metric ('cosine', 'euclidean').
+        n_lists
+            Number of k-means lists. More lists mean smaller lists and faster queries.
+        n_probe
+            Number of lists scanned per query; the recall/latency knob.
+        n_iter
+            Number of k-means iterations.
+        train_size
+            Maximum number of songs sampled to train the centroids.
+        seed
+            Random seed for sampling and initialisation.
+    """
+
+    def __init__(self, metric="cosine", n_lists=256, n_probe=16, n_iter=20, train_size=50000, seed=42):
+        self.metric = metric
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.train_size = train_size
+        self.seed = seed
+        self.prepared = None
+        self.centroids = None
+        self.list_order = None
+        self.list_offsets = None
+
+    def build(self, feature_matrix):
+        """Train the centroids and fill the inverted lists."""
+        if sparse.issparse(feature_matrix):
+            raise ValueError("IVFIndex needs a dense feature matrix; use ExactIndex for sparse feature spaces.")
+        self.prepared = prepare_feature_matrix(feature_matrix, self.metric)
+        vectors = self.prepared["matrix"]
+        n_lists = min(self.n_lists, len(vectors))
+
+        rng = np.random.default_rng(self.seed)
+        sample = vectors
+        if len(vectors) > self.train_size:
+            sample = vectors[np.sort(rng.choice(len(vectors), self.train_size, replace=False))]
+        self.centroids = _kmeans(sample, n_lists, self.metric, self.n_iter, self.seed)
+
+        assignment = _assign(vectors, self.centroids, self.metric)
+        self.list_order = np.argsort(assignment, kind="stable")
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))])
+        return self
+
+    def _probe(self, query_vectors):
+        """(n_queries x n_probe) closest lists of every query, in no particular order."""
+        products = query_vectors @ self.centroids.T
+        if self.metric == "cosine":
+            closeness = products
+        else:
+            closeness = 2 * products - np.einsum("ij,ij->i", self.centroids, self.centroids)
+        n_probe = min(self.n_probe, len(self.centroids))
+        return np.argpartition(-closeness, n_probe - 1, axis=1)[:, :n_probe]
+
+    def search(self, query_rows, k=10, exclude_self=True, max_block=2**22):
+        """
+        Approximate top-K for songs of the indexed matrix.
+
+        Queries are processed in batches. Every batch is scored list by list: the members
+        of a probed list are scored against all the queries of the batch that probe it
+        with one matrix product, so the Python loop runs over lists, not queries.
+
+        Args
+        ----
+            query_rows
+                Rows of the query songs.
+            k
+                Number of results per query.
+            exclude_self
+                Exclude each query from its own results.
+            max_block
+                Maximum number of candidate scores held per batch (bounds memory).
+
+        Returns
+        -------
+            tuple
+                (indices, scores): (n_queries x k) rows and similarities; rows are -1 and
+                scores -inf where fewer than k candidates were probed.
+        """
+        matrix = self.prepared["matrix"]
+        query_rows = np.asarray(query_rows, dtype=np.int64).reshape(-1)
+        indices = np.full((len(query_rows), k), -1, dtype=np.int64)
+        scores = np.full((len(query_rows), k), -np.inf)
+
+        n_probe = min(self.n_probe, len(self.centroids))
+        max_candidates = max(1, n_probe * int(np.diff(self.list_offsets).max(initial=1)))
+        batch_size = max(1, max_block // max_candidates)
+        for start in range(0, len(query_rows), batch_size):
+            rows = query_rows[start : start + batch_size]
+            candidates, candidate_scores = self._score_candidates(rows, self._probe(matrix[rows]))
+            if exclude_self:
+                candidate_scores[candidates == rows[:, None]] = -np.inf
+            top = top_k_rows(candidate_scores, k)
+            top_scores = np.take_along_axis(candidate_scores, top, axis=1)
+            top_indices = np.where(np.isfinite(top_scores), np.take_along_axis(candidates, top, axis=1), -1)
+            indices[start : start + len(rows), : top.shape[1]] = top_indices
+            scores[start : start + len(rows), : top.shape[1]] = top_scores
+        return indices, scores
+
+    def _score_candidates(self, rows, probed):
+        """
+        Candidates and their scores of a batch of queries, as (n_queries x n_slots)
+        blocks: the members of every probed list, in probe order, padded with -1 rows
+        and -inf scores.
+        """
+        matrix = self.prepared["matrix"]
+        squared_norms = self.prepared["squared_norms"]
+        list_sizes = np.diff(self.list_offsets)
+        sizes = list_sizes[probed]
+        slot_starts = np.cumsum(sizes, axis=1) - sizes
+        candidates = np.full((len(rows), max(1, int(sizes.sum(axis=1).max()))), -1, dtype=np.int64)
+        candidate_scores = np.full(candidates.shape, -np.inf)
+
+        query_of, probe_of = np.divmod(np.argsort(probed, axis=None, kind="stable"), probed.shape[1])
+        lists, first = np.unique(probed[query_of, probe_of], return_index=True)
+        for l, begin, end in zip(lists, first, np.append(first[1:], len(query_of))):
+            members = self.list_order[self.list_offsets[l] : self.list_offsets[l + 1]]
+            if not len(members):
+                continue
+            queries = query_of[begin:end]
+            products = matrix[rows[queries]] @ matrix[members].T
+            if self.metric == "cosine":
+                list_scores = products
+            else:
+                distances = np.maximum(
+                    squared_norms[rows[queries], None] - 2 * products + squared_norms[members][None, :], 0
+                )
+                list_scores = 1 / (1 + np.sqrt(distances))
+            slots = slot_starts[queries, probe_of[begin:end], None] + np.arange(len(members))
+            candidates[queries[:, None], slots] = members
+            candidate_scores[queries[:, None], slots] = list_scores
+        return candidates, candidate_scores
+
+    def save(self, path):
+        """Save the trained index (centroids and lists, not the vectors) to a directory."""
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "centroids.npy"), self.centroids)
+        np.save(os.path.join(path, "list_order.npy"), self.list_order)
+        np.save(os.path.join(path, "list_offsets.npy"), self.list_offsets)
+        params = {
+            "backend": "ivf",
+            "metric": self.metric,
+            # Effective number of lists (capped at the number of songs when built)
+            "n_lists": len(self.centroids),
+            "n_probe": self.n_probe,
+            "n_iter": self.n_iter,
+            "train_size": self.train_size,
+            "seed": self.seed,
+        }
+        with open(os.path.join(path, "params.json"), "w") as f:
+            json.dump(params, f, indent=4)
+
+    @classmethod
+    def load(cls, path, feature_matrix, n_probe=None):
+        """Load a saved index for `feature_matrix` (the same matrix it was built on)."""
+        with open(os.path.join(path, "params.json"), "r") as f:
+            params = json.load(f)
+        params.pop("backend")
+        index = cls(**params)
+        if n_probe is not None:
+            index.n_probe = n_probe
+        index.prepared = prepare_feature_matrix(feature_matrix, index.metric)
+        index.centroids = np.load(os.path.join(path, "centroids.npy"))
+        index.list_order = np.load(os.path.join(path, "list_order.npy"))
+        index.list_offsets = np.load(os.path.join(path, "list_offsets.npy"))
+        if index.list_offsets[-1] != len(index.prepared["matrix"]):
+            raise ValueError("The saved index was built on a different number of songs.")
+        return index
+
+
+class ExactIndex:
+    """Exact search with the batched engine, behind the same interface as IVFIndex."""
+
+    def __init__(self, metric="cosine"):
+        self.metric = metric
+        self.prepared = None
+
+    def build(self, feature_matrix):
+        self.prepared = prepare_feature_matrix(feature_matrix, self.metric)
+        return self
+
+    def search(self, query_rows, k=10, exclude_self=True):
+        return top_k_by_similarity(query_rows, metric=self.metric, k=k, exclude_self=exclude_self, prepared=self.prepared)
+
+
+def ann_index_path(feature_space, metric, store_dir=DEFAULT_STORE_DIR):
+    return os.path.join(store_dir, feature_space, f"ann_ivf_{metric}")
+
+
+def build_index(feature_space, feature_matrix, metric="cosine", config=None, store_dir=None):
+    """
+    Build the search index of a feature space: IVF if it has ANN settings, exact otherwise.
+
+    Args
+    ----
+        feature_space
+            Name of the feature space (e.g., "BERT").
+        feature_matrix
+            (n_songs x dim) feature embeddings.
+        metric
+            Similarity metric ('cosine', 'euclidean').
+        config
+            Mapping of feature space -> IVFIndex keyword arguments (defaults to DEFAULT_ANN_CONFIG).
+        store_dir
+            If given, the IVF index is saved under the feature space in this store.
+
+    Returns
+    -------
+        IVFIndex or ExactIndex
+            Sparse feature spaces (e.g., TF-IDF) always get an ExactIndex.
+    """
+    config = DEFAULT_ANN_CONFIG if config is None else config
+    if feature_space in config and sparse.issparse(feature_matrix):
+        warnings.warn(f"{feature_space} is sparse: using exact search instead of IVF.", stacklevel=2)
+    if feature_space not in config or sparse.issparse(feature_matrix):
+        return ExactIndex(metric).build(feature_matrix)
+    index = IVFIndex(metric, **config[feature_space]).build(feature_matrix)
+    if store_dir is not None:
+        index.save(ann_index_path(feature_space, metric, store_dir))
+    return index
+
+
+def ann_report(feature_matrix, tag_index, ids, metric="cosine", settings=None, k=10, query_rows=None, n_queries=500, seed=42):
+    """
+    Compare IVF settings against exact search, to choose ANN settings per system.
+
+    Args
+    ----
+        feature_matrix
+            (n_songs x dim) feature embeddings.
+        tag_index
+            TagIndex of the same songs, for NDCG.
+        ids
+            Song ids in the row order of `feature_matrix`.
+        metric
+            Similarity metric ('cosine', 'euclidean').
+        settings
+            List of IVFIndex keyword-argument dicts, e.g. [{"n_lists": 256, "n_probe": 8}].
+        k
+            Cut-off for recall and NDCG.
+        query_rows
+            Rows used as queries; defaults to `n_queries` random rows.
+        n_queries
+            Number of sampled queries when `query_rows` is not given.
+        seed
+            Seed for sampling the queries.
+
+    Returns
+    -------
+        pandas.DataFrame
+            One row per setting (plus the exact baseline) with build time, latency per query,
+            Recall@K against the exact top K and NDCG@K.
+    """
+    ids = np.asarray(ids)
+    if query_rows is None:
+        rng = np.random.default_rng(seed)
+        query_rows = np.sort(rng.choice(len(ids), min(n_queries, len(ids)), replace=False))
+    settings = settings or [{"n_lists": 256, "n_probe": n_probe} for n_probe in (1, 4, 8, 16, 32)]
+
+    def run(index, label):
+        start = time.perf_counter()
+        index.build(feature_matrix)
+        build_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        indices, _ = index.search(query_rows, k)
+        latency_ms = (time.perf_counter() - start) / len(query_rows) * 1000
+        return label, build_seconds, latency_ms, indices
+
+    results = [run(ExactIndex(metric), {"backend": "exact"})]
+    results += [run(IVFIndex(metric, **setting), {"backend": "ivf", **setting}) for setting in settings]
+
+    exact_indices = results[0][3]
+    rows = []
+    for label, build_seconds, latency_ms, indices in results:
+        recall = np.mean([len(np.intersect1d(a[a >= 0], b)) / len(b) for a, b in zip(indices, exact_indices)])
+        # Positions left empty (-1) when too few candidates were probed count as missing
+        retrieved = np.where(indices >= 0, ids[np.maximum(indices, 0)], None)
+        grades, n_relevant = batch_relevance(tag_index, ids[query_rows], retrieved)
+        ndcg = batch_metrics(grades, n_relevant, k=k)["NDCG@N"]
+        rows.append(
+            {
+                **label,
+                "build_s": build_seconds,
+                "latency_ms": latency_ms,
+                "Recall@K": recall,
+                "NDCG@K": float(np.mean(ndcg)),
+            }
+        )
+    return pd.DataFrame(rows)
@@ -0,0 +1,217 @@
+import json
+import os
+
+import numpy as np
+
+
+FORMAT_NAME = "mmsr-topk"
+FORMAT_VERSION = 1
+DEFAULT_IDS_FILE = "ids.json"
+MISSING = -1
+
+
+def build_id_dictionary(*contents):
+    """
+    Shared id dictionary (list of song ids) covering the queries and results of one or
+    more precomputed systems' `content` maps.
+
+    Query ids come first, in content order, so for systems that query every song the
+    row of a query is its dictionary index.
+    """
+    ids = {}
+    for content in contents:
+        ids.update(dict.fromkeys(content))
+    for content in contents:
+        for retrieved in content.values():
+            ids.update(dict.fromkeys(retrieved))
+    return list(ids)
+
+
+def write_id_dictionary(ids, path):
+    with open(path, "w") as f:
+        json.dump(list(ids), f)
+
+
+def load_id_dictionary(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def export_precomputed_binary(data, output_path, ids, ids_file=DEFAULT_IDS_FILE, with_scores=None):
+    """
+    Write a precomputed system as a compact binary file plus a small JSON header.
+
+    The binary file holds, in order: an int32 (Q x K) matrix of indices into the shared
+    id dictionary (row q = the results of query q, padded with -1), optionally a float16
+    (Q x K) score matrix, and the int32 dictionary index of each query. Rows have a fixed
+    size, so a single query can be read with one byte-range request. The header
+    `<output_path>.json` keeps `metadata` and the section offsets.
+
+    Args
+    ----
+        data
+            Precomputed system as loaded from JSON ({"metadata": ..., "content": {query_id:
+            [ids]}}); content values may also be {id: score} dicts.
+        output_path
+            Path of the binary file (e.g., "public/data/precomputed_systems/5f790.bin").
+        ids
+            Shared id dictionary (see `build_id_dictionary`); must contain every id.
+        ids_file
+            Name of the dictionary file, relative to the binary file, stored in the header.
+        with_scores
+            Store scores; defaults to True when content values are {id: score} dicts.
+
+    Returns
+    -------
+        dict
+            The header written next to the binary file.
+    """
+    content = data["content"]
+    id_to_index = {song_id: index for index, song_id in enumerate(ids)}
+    query_ids = list(content)
+    k = max((len(retrieved) for retrieved in content.values()), default=0)
+    if with_scores is None:
+        with_scores = any(isinstance(retrieved, dict) for retrieved in content.values())
+
+    indices = np.full((len(query_ids), k), MISSING, dtype="<i4")
+    scores = np.full((len(query_ids), k), np.nan, dtype="<f2") if with_scores else None
+    for row, query_id in enumerate(query_ids):
+        retrieved = content[query_id]
+        indices[row, : len(retrieved)] = [id_to_index[song_id] for song_id in retrieved]
+        if with_scores and isinstance(retrieved, dict):
+            scores[row, : len(retrieved)] = list(retrieved.values())
+    queries = np.asarray([id_to_index[query_id] for query_id in query_ids], dtype="<i4")
+
+    sections = {}
+    offset = 0
+    with open(output_path, "wb") as f:
+        for name, array in (("indices", indices), ("scores", scores), ("queries", queries)):
+            if array is None:
+                continue
+            f.write(array.tobytes())
+            sections[name] = {"offset": offset, "dtype": array.dtype.str, "shape": list(array.shape)}
+            offset += array.nbytes
+
+    header = {
+        "format": FORMAT_NAME,
+        "version": FORMAT_VERSION,
+        "metadata": data.get("metadata", {}),
+        "n_queries": len(query_ids),
+        "k": k,
+        "ids_file": ids_file,
+        "binary_file": os.path.basename(output_path),
+        "queries_are_dictionary": bool(np.array_equal(queries, np.arange(len(query_ids)))),
+        "sections": sections,
+    }
+    with open(output_path + ".json", "w") as f:
+        json.dump(header, f, indent=4)
+    return header
+
+
+def export_precomputed_json_file(json_path, output_path=None, ids=None, ids_path=None):
+    """
+    Convert an existing precomputed system JSON into the binary format.
+
+    Args
+    ----
+        json_path
+            Path of the JSON file.
+        output_path
+            Path of the binary file; defaults to the JSON path with a .bin extension.
+        ids
+            Shared id dictionary; built from this file when not given.
+        ids_path
+            Where to write the dictionary; defaults to ids.json next to the binary file.
+
+    Returns
+    -------
+        dict
+            The header written next to the binary file.
+    """
+    with open(json_path, "r") as f:
+        data = json.load(f)
+    output_path = output_path or os.path.splitext(json_path)[0] + ".bin"
+    ids_path = ids_path or os.path.join(os.path.dirname(output_path), DEFAULT_IDS_FILE)
+    if ids is None:
+        ids = build_id_dictionary(data["content"])
+        write_id_dictionary(ids, ids_path)
+    return export_precomputed_binary(
+        data, output_path, ids, ids_file=os.path.relpath(ids_path, os.path.dirname(output_path))
+    )
+
+
+def load_header(header_path):
+    with open(header_path, "r") as f:
+        return json.load(f)
+
+
+def read_section(binary_path, section, rows=None):
+    """Read a whole section of a binary file, or only the given row range (start, stop), with a seek."""
+    dtype = np.dtype(section["dtype"])
+    shape = section["shape"]
+    row_items = int(np.prod(shape[1:])) if len(shape) > 1 else 1
+    start, stop = (0, shape[0]) if rows is None else rows
+    with open(binary_path, "rb") as f:
+        f.seek(section["offset"] + start * row_items * dtype.itemsize)
+        values = np.fromfile(f, dtype=dtype, count=(stop - start) * row_items)
+    return values.reshape((stop - start,) + tuple(shape[1:]))
+
+
+def read_query_row(header_path, query_id, ids=None):
+    """
+    Read the results of one query from the binary file without loading the rest.
+
+    Returns
+    -------
+        tuple
+            (retrieved_ids, scores or None)
+    """
+    header = load_header(header_path)
+    base_dir = os.path.dirname(header_path)
+    binary_path = os.path.join(base_dir, header["binary_file"])
+    ids = ids if ids is not None else load_id_dictionary(os.path.join(base_dir, header["ids_file"]))
+
+    query_index = ids.index(query_id)
+    if header["queries_are_dictionary"]:
+        row = query_index
+    else:
+        queries = read_section(binary_path, header["sections"]["queries"])
+        row = int(np.flatnonzero(queries == query_index)[0])
+
+    indices = read_section(binary_path, header["sections"]["indices"], (row, row + 1))[0]
+    indices = indices[indices != MISSING]
+    scores = None
+    if "scores" in header["sections"]:
+        scores = read_section(binary_path, header["sections"]["scores"], (row, row + 1))[0][: len(indices)]
+    return [ids[index] for index in indices], scores
+
+
+def binary_to_precomputed_json(header_path, ids=None):
+    """
+    Convert a binary export back to the precomputed system JSON structure.
+
+    Returns
+    -------
+        dict
+            {"metadata": ..., "content": {query_id: [ids]}}, with query order preserved.
+            If scores were stored, content values are {id: score} dicts (scores rounded
+            to float16).
+    """
+    header = load_header(header_path)
+    base_dir = os.path.dirname(header_path)
+    binary_path = os.path.join(base_dir, header["binary_file"])
+    ids = ids if ids is not None else load_id_dictionary(os.path.join(base_dir, header["ids_file"]))
+
+    indices = read_section(binary_path, header["sections"]["indices"])
+    queries = read_section(binary_path, header["sections"]["queries"])
+    scores = read_section(binary_path, header["sections"]["scores"]) if "scores" in header["sections"] else None
+
+    content = {}
+    for row, query_index in enumerate(queries):
+        valid = indices[row] != MISSING
+        retrieved = [ids[index] for index in indices[row][valid]]
+        if scores is None:
+            content[ids[query_index]] = retrieved
+        else:
+            content[ids[query_index]] = dict(zip(retrieved, scores[row][valid].astype(float).tolist()))
+    return {"metadata": header["metadata"], "content": content}
@@ -0,0 +1,336 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+DEFAULT_DATASET_DIR = "../dataset"
+DEFAULT_STORE_DIR = "../dataset/store"
+
+# Feature space name (as used by the notebooks) -> source TSV and columns to drop
+FEATURE_SPACE_FILES = {
+    "TF-IDF": ("id_lyrics_tf-idf_mmsr.tsv", ["song"]),
+    "BERT": ("id_lyrics_bert_mmsr.tsv", []),
+    "MFCC": ("id_mfcc_stats_mmsr.tsv", []),
+    "Spectral": ("id_blf_spectralcontrast_mmsr.tsv", []),
+    "Inception": ("id_incp_mmsr.tsv", []),
+    "VGG19": ("id_vgg19_mmsr.tsv", []),
+}
+
+# Feature spaces that are mostly zeros and are stored and scored as CSR matrices
+SPARSE_FEATURE_SPACES = ("TF-IDF",)
+
+MANIFEST_FILE = "manifest.json"
+MATRIX_FILE = "matrix.npy"
+SPARSE_MATRIX_FILE = "matrix.npz"
+IDS_FILE = "ids.npy"
+
+
+class FeatureSpace:
+    """
+    Read-only view of one converted feature space.
+
+    Attributes
+    ----------
+        name: str
+            Name of the feature space (e.g., "BERT").
+        ids: numpy.ndarray
+            Song ids in row order.
+        matrix: numpy.ndarray or scipy.sparse.csr_matrix
+            Memory-mapped (n_songs x dim) float32 matrix, or a float32 CSR matrix for
+            sparse feature spaces.
+        manifest: dict
+            Manifest written during conversion.
+    """
+
+    def __init__(self, name, ids, matrix, manifest):
+        self.name = name
+        self.ids = ids
+        self.matrix = matrix
+        self.manifest = manifest
+        self._id_to_row = None
+
+    @property
+    def id_to_row(self):
+        """Mapping of song id -> row in `matrix`, built on first access."""
+        if self._id_to_row is None:
+            self._id_to_row = {song_id: row for row, song_id in enumerate(self.ids)}
+        return self._id_to_row
+
+    @property
+    def columns(self):
+        return self.manifest["columns"]
+
+    def rows_for_ids(self, song_ids):
+        """Return the matrix rows of the given song ids as an int64 array."""
+        id_to_row = self.id_to_row
+        return np.fromiter(
+            (id_to_row[song_id] for song_id in song_ids), dtype=np.int64, count=len(song_ids)
+        )
+
+    def vectors_for_ids(self, song_ids):
+        """Return the vectors of the given song ids (a copy, in the given order; CSR for sparse feature spaces)."""
+        return self.matrix[self.rows_for_ids(song_ids)]
+
+
+def _feature_space_dir(store_dir, feature_space):
+    return os.path.join(store_dir, feature_space)
+
+
+def _remove_manifest(target_dir):
+    """Drop the manifest of a feature space about to be rewritten, so it never describes half-written files."""
+    path = os.path.join(target_dir, MANIFEST_FILE)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _write_manifest(target_dir, manifest):
+    """Write the manifest last and atomically: a store with a manifest is complete."""
+    path = os.path.join(target_dir, MANIFEST_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def read_sparse_tsv(tsv_path, drop_columns=None, chunksize=2000):
+    """
+    Read a mostly-zero feature TSV (e.g., TF-IDF) straight into a CSR matrix.
+
+    The TSV is streamed in chunks and every chunk is converted to CSR before the next
+    one is parsed, so the dense matrix is never built.
+
+    Args
+    ----
+        tsv_path
+            Path to the TSV file with an 'id' column followed by feature columns.
+        drop_columns
+            Non-feature columns to drop besides 'id' (e.g., ['song'] for TF-IDF).
+        chunksize
+            Number of rows parsed per chunk.
+
+    Returns
+    -------
+        tuple
+            (ids, float32 CSR matrix, feature column names)
+    """
+    drop_columns = drop_columns or []
+    header = pd.read_csv(tsv_path, sep="\t", nrows=0).columns.str.strip()
+    columns = [c for c in header if c != "id" and c not in drop_columns]
+
+    ids = []
+    blocks = []
+    for chunk in pd.read_csv(tsv_path, sep="\t", chunksize=chunksize):
+        chunk.columns = chunk.columns.str.strip()
+        ids.extend(chunk["id"].astype(str))
+        blocks.append(sparse.csr_matrix(chunk[columns].to_numpy(dtype=np.float32)))
+    matrix = sparse.vstack(blocks, format="csr") if blocks else sparse.csr_matrix((0, len(columns)), dtype=np.float32)
+    return np.asarray(ids), matrix, columns
+
+
+def convert_tsv_to_store(
+    tsv_path, feature_space, store_dir=DEFAULT_STORE_DIR, drop_columns=None, chunksize=2000, sparse_format=False
+):
+    """
+    Convert a feature TSV into a memory-mappable float32 store.
+
+    The TSV is parsed once, in chunks, so the full file is never held in memory as a
+    DataFrame; rows are counted from the parsed chunks (quoted fields may span lines).
+    With `sparse_format` the matrix is stored as CSR (matrix.npz) instead.
+
+    Args
+    ----
+        tsv_path
+            Path to the TSV file with an 'id' column followed by feature columns.
+        feature_space
+            Name of the feature space, used as the store sub-directory.
+        store_dir
+            Root directory of the store.
+        drop_columns
+            Non-feature columns to drop besides 'id' (e.g., ['song'] for TF-IDF).
+        chunksize
+            Number of rows parsed per chunk.
+        sparse_format
+            Store the matrix as CSR; for mostly-zero feature spaces (see SPARSE_FEATURE_SPACES).
+
+    Returns
+    -------
+        dict
+            The manifest written for the feature space.
+    """
+    if sparse_format:
+        return _convert_tsv_to_sparse_store(tsv_path, feature_space, store_dir, drop_columns, chunksize)
+
+    drop_columns = drop_columns or []
+    header = pd.read_csv(tsv_path, sep="\t", nrows=0).columns.str.strip()
+    columns = [c for c in header if c != "id" and c not in drop_columns]
+
+    target_dir = _feature_space_dir(store_dir, feature_space)
+    os.makedirs(target_dir, exist_ok=True)
+    _remove_manifest(target_dir)
+
+    # Rows are appended to a raw file while parsing; the .npy header needs the final row count
+    matrix_path = os.path.join(target_dir, MATRIX_FILE)
+    raw_path = matrix_path + ".raw"
+    tmp_path = matrix_path + ".tmp"
+    ids = []
+    n_rows = 0
+    try:
+        with open(raw_path, "wb") as raw:
+            for chunk in pd.read_csv(tsv_path, sep="\t", chunksize=chunksize):
+                chunk.columns = chunk.columns.str.strip()
+                ids.extend(chunk["id"].astype(str))
+                raw.write(np.ascontiguousarray(chunk[columns].to_numpy(dtype=np.float32)).tobytes())
+                n_rows += len(chunk)
+
+        header = {
+            "descr": np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+            "fortran_order": False,
+            "shape": (n_rows, len(columns)),
+        }
+        with open(tmp_path, "wb") as f, open(raw_path, "rb") as raw:
+            np.lib.format.write_array_header_1_0(f, header)
+            shutil.copyfileobj(raw, f, 16 * 2**20)
+        os.replace(tmp_path, matrix_path)
+    finally:
+        for path in (raw_path, tmp_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    np.save(os.path.join(target_dir, IDS_FILE), np.asarray(ids))
+
+    manifest = {
+        "feature_space": feature_space,
+        "source": os.path.basename(tsv_path),
+        "n_rows": n_rows,
+        "dim": len(columns),
+        "dtype": "float32",
+        "columns": columns,
+    }
+    _write_manifest(target_dir, manifest)
+
+    return manifest
+
+
+def _convert_tsv_to_sparse_store(tsv_path, feature_space, store_dir, drop_columns, chunksize):
+    ids, matrix, columns = read_sparse_tsv(tsv_path, drop_columns, chunksize)
+
+    target_dir = _feature_space_dir(store_dir, feature_space)
+    os.makedirs(target_dir, exist_ok=True)
+    _remove_manifest(target_dir)
+    sparse.save_npz(os.path.join(target_dir, SPARSE_MATRIX_FILE), matrix, compressed=False)
+    np.save(os.path.join(target_dir, IDS_FILE), ids)
+
+    manifest = {
+        "feature_space": feature_space,
+        "source": os.path.basename(tsv_path),
+        "n_rows": matrix.shape[0],
+        "dim": matrix.shape[1],
+        "dtype": "float32",
+        "format": "csr",
+        "nnz": int(matrix.nnz),
+        "columns": columns,
+    }
+    _write_manifest(target_dir, manifest)
+
+    return manifest
+
+
+def convert_all_feature_spaces(dataset_dir=DEFAULT_DATASET_DIR, store_dir=DEFAULT_STORE_DIR, feature_spaces=None):
+    """
+    One-time conversion of all known feature space TSVs (see FEATURE_SPACE_FILES).
+
+    Feature spaces whose TSV is missing are skipped.
+
+    Returns
+    -------
+        dict
+            "converted" (feature space name -> manifest) and "skipped" (feature space
+            name -> the missing TSV path).
+    """
+    summary = {"converted": {}, "skipped": {}}
+    for feature_space in feature_spaces or FEATURE_SPACE_FILES:
+        filename, drop_columns = FEATURE_SPACE_FILES[feature_space]
+        tsv_path = os.path.join(dataset_dir, filename)
+        if not os.path.exists(tsv_path):
+            summary["skipped"][feature_space] = tsv_path
+            continue
+        summary["converted"][feature_space] = convert_tsv_to_store(
+            tsv_path,
+            feature_space,
+            store_dir=store_dir,
+            drop_columns=drop_columns,
+            sparse_format=feature_space in SPARSE_FEATURE_SPACES,
+        )
+    return summary
+
+
+def has_feature_space(feature_space, store_dir=DEFAULT_STORE_DIR):
+    return os.path.exists(os.path.join(_feature_space_dir(store_dir, feature_space), MANIFEST_FILE))
+
+
+def load_feature_space(feature_space, store_dir=DEFAULT_STORE_DIR):
+    """
+    Load a converted feature space as zero-copy memory-mapped views.
+
+    The matrix is opened read-only, so worker processes loading the same store share
+    the page cache instead of each holding a private copy. Sparse feature spaces are
+    loaded as CSR matrices (read into memory, a fraction of the dense size).
+
+    Args
+    ----
+        feature_space
+            Name of the feature space (e.g., "BERT").
+        store_dir
+            Root directory of the store.
+
+    Returns
+    -------
+        FeatureSpace
+            The ids, memory-mapped matrix and manifest of the feature space.
+    """
+    target_dir = _feature_space_dir(store_dir, feature_space)
+    with open(os.path.join(target_dir, MANIFEST_FILE), "r") as f:
+        manifest = json.load(f)
+
+    if manifest.get("format") == "csr":
+        matrix = sparse.load_npz(os.path.join(target_dir, SPARSE_MATRIX_FILE)).tocsr()
+    else:
+        matrix = np.load(os.path.join(target_dir, MATRIX_FILE), mmap_mode="r")
+    ids = np.load(os.path.join(target_dir, IDS_FILE))
+
+    if matrix.shape != (manifest["n_rows"], manifest["dim"]):
+        raise ValueError(
+            f"Store for {feature_space} is inconsistent: matrix {matrix.shape}, "
+            f"manifest ({manifest['n_rows']}, {manifest['dim']})."
+        )
+
+    return FeatureSpace(feature_space, ids, matrix, manifest)
+
+
+def feature_space_to_dataframe(feature_space, dataset=None):
+    """
+    Rebuild the wide DataFrame the notebooks use from a stored feature space.
+
+    Args
+    ----
+        feature_space: FeatureSpace
+            A loaded feature space.
+        dataset: pandas.DataFrame or None
+            If given, the features are merged onto it on 'id' (like `pd.merge(dataset, data, on='id')`).
+
+    Returns
+    -------
+        tuple
+            (DataFrame, feature column names)
+    """
+    matrix = feature_space.matrix
+    matrix = matrix.toarray() if sparse.issparse(matrix) else np.asarray(matrix)
+    data = pd.DataFrame(matrix, columns=feature_space.columns)
+    data.insert(0, "id", feature_space.ids)
+    if dataset is not None:
+        data = pd.merge(dataset, data, on="id")
+    return data, pd.Index(feature_space.columns)
@@ -1,7 +1,10 @@
+import numpy as np
 import pandas as pd
-from scripts.random_baseline import random_baseline
-from scripts.relevance_computation import compute_weighted_jaccard
-from scripts.retrieval_by_similarity import retrieve_n_songs_by_similarity
+from scripts.instrumentation import count, timed, timer
+from scripts.metric_kernels import evaluate_retrieved, mean_metrics
+from scripts.random_baseline import random_baseline, random_baseline_rows
+from scripts.relevance_computation import TagIndex, compute_weighted_jaccard
+from scripts.retrieval_by_similarity import retrieve_n_songs_by_similarity, top_k_by_similarity
 from sklearn.metrics import ndcg_score
 from tqdm import tqdm
 
@@ -35,6 +38,7 @@ def ndcg_at_k(retrieved, relevant, k=10):
 
 
 # Beyond-Accuracy Metrics
+@timed()
 def beyond_accuracy_metrics(
     query_indices,
     dataset,
@@ -44,6 +48,7 @@ def beyond_accuracy_metrics(
     popularity_column=None,
     N=10,
     weight_threshold=60,
+    neighbour_graphs=None,
 ):
     """
     Compute beyond-accuracy metrics: Coverage, Diversity, and Popularity for similarity metrics and/or a random baseline.
@@ -66,7 +71,9 @@ def beyond_accuracy_metrics(
             Number of top results to retrieve.
         weight_threshold: int
             Minimum weight for a tag to be considered in the diversity calculation.
-
+        neighbour_graphs: dict or None
+            Optional mapping of similarity metric -> NeighbourGraph of this feature space.
+            Metrics with a graph read their top N from it instead of recomputing similarities.
 
 
     Returns
@@ -83,7 +90,8 @@ def beyond_accuracy_metrics(
         retrievable_ids.update(retrieved_songs)
 
         # Diversity: Calculate the ratio of unique tags among retrieved songs to total tags in retrieved songs
-        retrieved_tags_dicts = dataset[dataset["id"].isin(retrieved_songs)][tags_column]
+        with timer("beyond_accuracy_metrics.filter"):
+            retrieved_tags_dicts = dataset[dataset["id"].isin(retrieved_songs)][tags_column]
         unique_tags = set()
         total_tags_in_retrieved = 0
 
@@ -100,9 +108,10 @@ def beyond_accuracy_metrics(
         )
 
         # Popularity: Compute normalized average popularity of retrieved songs
-        avg_popularity = dataset[dataset["id"].isin(retrieved_songs)][
-            popularity_column
-        ].mean()
+        with timer("beyond_accuracy_metrics.filter"):
+            avg_popularity = dataset[dataset["id"].isin(retrieved_songs)][
+                popularity_column
+            ].mean()
         normalized_popularity = (
             (avg_popularity - min_popularity) / (max_popularity - min_popularity)
             if max_popularity > min_popularity
@@ -123,7 +132,7 @@ def beyond_accuracy_metrics(
             query_indices, desc="Processing queries for Random Baseline"
         ):
             query_song = dataset.iloc[query_index]
-            retrieved_songs = random_baseline(query_song, dataset, N)["id"].tolist()
+            retrieved_songs = random_baseline(query_song, dataset, N=N)["id"].tolist()
             diversity, popularity = compute_metrics(retrieved_songs)
 
             results["random"][f"Div@N"] += diversity
@@ -146,9 +155,14 @@ def beyond_accuracy_metrics(
             query_indices, desc=f"Processing queries for {metric} metric"
         ):
             query_song = dataset.iloc[query_index]
-            retrieved_songs = retrieve_n_songs_by_similarity(
-                query_song, dataset, feature_columns, metric, N
-            )["id"]
+            if neighbour_graphs and metric in neighbour_graphs:
+                retrieved_songs = neighbour_graphs[metric].top_n_ids(
+                    [query_song["id"]], N
+                )[0][0]
+            else:
+                retrieved_songs = retrieve_n_songs_by_similarity(
+                    query_song, dataset, feature_columns, metric, N
+                )["id"]
             diversity, popularity = compute_metrics(retrieved_songs)
 
             results[metric][f"Div@N"] += diversity
@@ -163,10 +177,50 @@ def beyond_accuracy_metrics(
     return results
 
 
-def evaluate_metrics(query_song, dataset, feature_columns, metric, N=10):
+@timed()
+def retrieve_rows(query_indices, dataset, feature_columns, metric, N=10, neighbour_graph=None, feature_matrix=None):
+    """
+    Retrieved rows (positions in `dataset`) of all queries as a (Q x N) array.
+
+    Uses the neighbour graph if given, the batched engine for feature columns (or for
+    `feature_matrix`, e.g. a sparse TF-IDF matrix aligned with `dataset`), or the
+    random baseline when `feature_columns` is None.
+    """
+    ids = dataset["id"].values
+    if feature_columns is None:
+        rows, _ = random_baseline_rows(query_indices, len(dataset), N)
+        return rows
+    elif neighbour_graph is not None:
+        retrieved_ids = neighbour_graph.top_n_ids(ids[query_indices], N)[0]
+    else:
+        if feature_matrix is None:
+            feature_matrix = dataset[feature_columns].values
+        rows, _ = top_k_by_similarity(query_indices, feature_matrix, metric=metric, k=N)
+        return rows
+    retrieved_ids = np.asarray(retrieved_ids).ravel()
+    rows = pd.Index(ids).get_indexer(retrieved_ids)
+    if np.any(rows < 0):
+        missing = pd.unique(retrieved_ids[rows < 0])
+        raise ValueError(f"Neighbour graph returned songs missing from the dataset: {missing[:10].tolist()}")
+    return rows.reshape(len(query_indices), -1)
+
+
+@timed()
+def evaluate_metrics(
+    query_song,
+    dataset,
+    feature_columns,
+    metric,
+    N=10,
+    tag_index=None,
+    neighbour_graph=None,
+):
     """
     Evaluate retrieval performance for a given similarity metric.
 
+    Per-query reference implementation; `run_evaluations` evaluates all queries in
+    one batch with the same results.
+
     Args
     ----
         query_song
@@ -179,6 +233,12 @@ def evaluate_metrics(query_song, dataset, feature_columns, metric, N=10):
             Similarity metric to evaluate ('cosine', 'euclidean').
         N
             Number of top results to retrieve.
+        tag_index
+            Optional TagIndex built from `dataset`. When given, relevance is looked up
+            in the index instead of scanning every row of the dataset.
+        neighbour_graph
+            Optional NeighbourGraph for this feature space and metric. When given, the
+            top N are read from it instead of recomputing similarities.
 
     Returns
     -------
@@ -186,33 +246,44 @@ def evaluate_metrics(query_song, dataset, feature_columns, metric, N=10):
             Evaluation metrics (Precision@10, Recall@10, NDCG@10).
     """
 
+    count("evaluate_metrics.queries")
+
     # Check for random baseline usage
-    if feature_columns is None:
-        retrieved_songs = random_baseline(query_song, dataset, N)["id"].tolist()
-    else:
-        # Retrieve top N songs
-        retrieved_songs = retrieve_n_songs_by_similarity(
-            query_song, dataset, feature_columns, metric, N
-        )["id"]
+    with timer("evaluate_metrics.retrieval"):
+        if feature_columns is None:
+            retrieved_songs = random_baseline(query_song, dataset, N=N)["id"].tolist()
+        elif neighbour_graph is not None:
+            retrieved_songs = neighbour_graph.top_n_ids([query_song["id"]], N)[0][0].tolist()
+        else:
+            # Retrieve top N songs
+            retrieved_songs = retrieve_n_songs_by_similarity(
+                query_song, dataset, feature_columns, metric, N
+            )["id"]
 
     # Define relevance based on query song's genre
-    query_tags = query_song["(tag, weight)"]  # Parse query song tags
-    relevant_songs = []
-    relevance_scores = {}
-
-    for _, candidate_song in dataset.iterrows():
-        candidate_tags = candidate_song["(tag, weight)"]
-        # Compute Weighted Jaccard Similarity
-        relevance_score = compute_weighted_jaccard(query_tags, candidate_tags)
-        if relevance_score > 0:  # Only consider non-zero similarities
-            relevant_songs.append(candidate_song["id"])
-            relevance_scores[candidate_song["id"]] = relevance_score
-
-    # Compute evaluation metrics
-    precision = precision_at_k(retrieved_songs, relevant_songs, k=N)
-    recall = recall_at_k(retrieved_songs, relevant_songs, k=N)
-    ndcg = ndcg_at_k(retrieved_songs, relevant_songs, k=N)
-    mrr = mean_reciprocal_rank(retrieved_songs, relevant_songs)
+    with timer("evaluate_metrics.relevance"):
+        if tag_index is not None:
+            relevant_songs, relevance_scores = tag_index.relevant_songs(query_song)
+        else:
+            query_tags = query_song["(tag, weight)"]  # Parse query song tags
+            relevant_songs = []
+            relevance_scores = {}
+
+            for _, candidate_song in dataset.iterrows():
+                candidate_tags = candidate_song["(tag, weight)"]
+                # Compute Weighted Jaccard Similarity
+                relevance_score = compute_weighted_jaccard(query_tags, candidate_tags)
+                if relevance_score > 0:  # Only consider non-zero similarities
+                    relevant_songs.append(candidate_song["id"])
+                    relevance_scores[candidate_song["id"]] = relevance_score
+
+    # Compute evaluation metrics (membership tests against a set, not the list)
+    with timer("evaluate_metrics.metrics"):
+        relevant_songs = set(relevant_songs)
+        precision = precision_at_k(retrieved_songs, relevant_songs, k=N)
+        recall = recall_at_k(retrieved_songs, relevant_songs, k=N)
+        ndcg = ndcg_at_k(retrieved_songs, relevant_songs, k=N)
+        mrr = mean_reciprocal_rank(retrieved_songs, relevant_songs)
 
     return {
         f"Precision@N": precision,
@@ -222,10 +293,23 @@ def evaluate_metrics(query_song, dataset, feature_columns, metric, N=10):
     }
 
 
-def run_evaluations(query_indices, dataset, feature_columns, similarity_metrics, N=10):
+@timed()
+def run_evaluations(
+    query_indices,
+    dataset,
+    feature_columns,
+    similarity_metrics,
+    N=10,
+    tag_index=None,
+    neighbour_graphs=None,
+):
     """
     Run evaluation for multiple query songs and compute average metrics.
 
+    All queries of a metric are retrieved in one batch (`retrieve_rows`) and scored with
+    the vectorised metric kernels; the averages equal those of calling
+    `evaluate_metrics` for every query.
+
     Args
     ----
         query_indices
@@ -238,30 +322,30 @@ def run_evaluations(query_indices, dataset, feature_columns, similarity_metrics,
             List of similarity metrics to evaluate (e.g., ['cosine', 'euclidean']).
         N
             Number of top results to retrieve.
+        tag_index
+            Optional TagIndex built from `dataset`; built once here if not given.
+        neighbour_graphs
+            Optional mapping of similarity metric -> NeighbourGraph of this feature space.
 
     Returns
     -------
         dict
             Average evaluation metrics for each similarity metric.
     """
-    results = {
-        metric: {f"Precision@N": 0, f"Recall@N": 0, f"NDCG@N": 0, "MRR": 0}
-        for metric in similarity_metrics
-    }
+    if tag_index is None:
+        tag_index = TagIndex.from_dataset(dataset)
+    query_indices = np.asarray(query_indices, dtype=np.int64)
+    ids = dataset["id"].values
+    query_ids = ids[query_indices]
 
-    for query_index in query_indices:
-        query_song = dataset.iloc[query_index]
-        for metric in similarity_metrics:
-            eval_metrics = evaluate_metrics(
-                query_song, dataset, feature_columns, metric, N
-            )
-            for key in eval_metrics:
-                results[metric][key] += eval_metrics[key]
-
-    # Compute averages
-    num_queries = len(query_indices)
+    results = {}
     for metric in similarity_metrics:
-        for key in results[metric]:
-            results[metric][key] /= num_queries
+        count("evaluate_metrics.queries", len(query_indices))
+        with timer("run_evaluations.retrieval"):
+            rows = retrieve_rows(
+                query_indices, dataset, feature_columns, metric, N, (neighbour_graphs or {}).get(metric)
+            )
+        with timer("run_evaluations.metrics"):
+            results[metric] = mean_metrics(evaluate_retrieved(tag_index, query_ids, ids[rows], k=N))
 
     return results
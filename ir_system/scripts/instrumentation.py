@@ -0,0 +1,294 @@
+import cProfile
+import functools
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+class _Recording:
+    def __init__(self):
+        # name -> [calls, wall seconds, net allocated bytes]
+        self.stages = {}
+        # "outer;inner" stack -> [calls, self seconds], for flame graphs
+        self.stacks = {}
+        self.counters = {}
+
+    def merge(self, other):
+        for name, (calls, wall, allocated) in other.stages.items():
+            stage = self.stages.setdefault(name, [0, 0.0, 0])
+            stage[0] += calls
+            stage[1] += wall
+            stage[2] += allocated
+        for stack, (calls, seconds) in other.stacks.items():
+            frame = self.stacks.setdefault(stack, [0, 0.0])
+            frame[0] += calls
+            frame[1] += seconds
+        for name, n in other.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + n
+
+
+class _State:
+    def __init__(self):
+        self.enabled = False
+        self.track_allocations = False
+        # Whether `enable` started tracemalloc (and `disable` may stop it)
+        self.started_tracing = False
+        self.recording = _Recording()
+        # Stages may be timed from several threads (e.g., the LTR feature builder)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @property
+    def active(self):
+        """Stack of the running timers of the current thread."""
+        active = getattr(self.local, "active", None)
+        if active is None:
+            active = self.local.active = []
+        return active
+
+
+_STATE = _State()
+
+
+class _NullTimer:
+    """Shared no-op context manager returned by `timer` while instrumentation is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ("name", "start", "allocated", "children")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.children = 0.0
+        self.allocated = tracemalloc.get_traced_memory()[0] if _STATE.track_allocations else None
+        _STATE.active.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.start
+        active = _STATE.active
+        stack = ";".join(timer.name for timer in active)
+        active.pop()
+        if active:
+            active[-1].children += wall
+        allocated = 0
+        if self.allocated is not None and tracemalloc.is_tracing():
+            allocated = tracemalloc.get_traced_memory()[0] - self.allocated
+
+        with _STATE.lock:
+            recording = _STATE.recording
+            stage = recording.stages.setdefault(self.name, [0, 0.0, 0])
+            stage[0] += 1
+            stage[1] += wall
+            stage[2] += allocated
+            frame = recording.stacks.setdefault(stack, [0, 0.0])
+            frame[0] += 1
+            frame[1] += wall - self.children
+        return False
+
+
+def enable(track_allocations=False):
+    """
+    Turn instrumentation on. With `track_allocations`, tracemalloc also records the net
+    memory allocated inside every timed stage (slower).
+    """
+    _STATE.enabled = True
+    _STATE.track_allocations = track_allocations
+    if track_allocations and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _STATE.started_tracing = True
+
+
+def disable():
+    """Turn instrumentation off; tracemalloc is only stopped if `enable` started it."""
+    _STATE.enabled = False
+    _STATE.track_allocations = False
+    if _STATE.started_tracing:
+        tracemalloc.stop()
+        _STATE.started_tracing = False
+
+
+def is_enabled():
+    return _STATE.enabled
+
+
+def reset():
+    """Clear all recorded timings and counters."""
+    with _STATE.lock:
+        _STATE.recording = _Recording()
+
+
+def timer(name):
+    """
+    Context manager timing a stage under `name`; a shared no-op while disabled.
+
+        with timer("evaluate_metrics.relevance"):
+            ...
+    """
+    if not _STATE.enabled:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+def timed(name=None):
+    """
+    Decorator timing every call of a function (named "<module>.<function>" by default).
+    While disabled, the only overhead is one attribute check per call.
+    """
+
+    def decorator(function):
+        stage = name or f"{function.__module__.rsplit('.', 1)[-1]}.{function.__qualname__}"
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _STATE.enabled:
+                return function(*args, **kwargs)
+            with _Timer(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def take_recording():
+    """
+    Return everything recorded since the last `reset` and start a new recording.
+
+    Worker processes send their recording back with their results; the parent adds it
+    to its own with `merge_recording`.
+    """
+    with _STATE.lock:
+        recording, _STATE.recording = _STATE.recording, _Recording()
+    return recording
+
+
+def merge_recording(recording):
+    """Add a recording taken in another process (see `take_recording`) to the current one."""
+    with _STATE.lock:
+        _STATE.recording.merge(recording)
+
+
+def count(name, n=1):
+    """Add `n` to a counter (no-op while disabled)."""
+    if _STATE.enabled:
+        with _STATE.lock:
+            counters = _STATE.recording.counters
+            counters[name] = counters.get(name, 0) + n
+
+
+def report(recording=None):
+    """
+    Per-stage totals recorded since the last `reset` (or of the given recording).
+
+    Returns
+    -------
+        pandas.DataFrame
+            One row per stage with calls, total and mean wall time (seconds), the share of
+            the outermost stages' time and, when tracked, net allocated MB; sorted by
+            total time.
+    """
+    recording = recording or _STATE.recording
+    rows = [
+        {
+            "stage": stage,
+            "calls": calls,
+            "total_s": wall,
+            "mean_ms": wall / calls * 1000 if calls else 0.0,
+            "allocated_mb": allocated / 2**20,
+        }
+        for stage, (calls, wall, allocated) in recording.stages.items()
+    ]
+    frame = pd.DataFrame(rows, columns=["stage", "calls", "total_s", "mean_ms", "allocated_mb"])
+    # Self times of all stacks add up to the wall time of the outermost stages
+    outer = sum(seconds for _, seconds in recording.stacks.values())
+    frame["share"] = frame["total_s"] / outer if outer else 0.0
+    if not _STATE.track_allocations and not frame["allocated_mb"].any():
+        frame = frame.drop(columns="allocated_mb")
+    return frame.sort_values("total_s", ascending=False).reset_index(drop=True)
+
+
+def counters():
+    return dict(_STATE.recording.counters)
+
+
+def write_folded_stacks(path, recording=None):
+    """
+    Write the nested stage timings in the folded-stack format of flamegraph.pl /
+    speedscope ("outer;inner <self microseconds>" per line).
+    """
+    recording = recording or _STATE.recording
+    with open(path, "w") as f:
+        for stack, (_, seconds) in sorted(recording.stacks.items()):
+            f.write(f"{stack} {max(int(round(seconds * 1e6)), 0)}\n")
+
+
+@contextmanager
+def instrumented_run(profile_path=None, folded_path=None, track_allocations=False):
+    """
+    Instrument everything run inside the block, optionally under cProfile.
+
+    The block is recorded separately. If instrumentation was already enabled, the outer
+    session keeps its own recording (the block's timings are added to it afterwards)
+    and its allocation tracking setting.
+
+    Args
+    ----
+        profile_path
+            If given, cProfile stats of the block are dumped there (.prof, readable by
+            pstats, snakeviz or flameprof).
+        folded_path
+            If given, the stage timings are written there as folded stacks.
+        track_allocations
+            Also record net allocated memory per stage.
+
+    Yields
+    ------
+        function
+            Returns the per-stage totals of the block (see `report`).
+    """
+    was_enabled = _STATE.enabled
+    was_tracking = _STATE.track_allocations
+    was_tracing = tracemalloc.is_tracing()
+    with _STATE.lock:
+        outer = _STATE.recording
+        block = _STATE.recording = _Recording()
+    # Timers of the outer session that are still running need allocation tracking to stay on
+    enable(track_allocations or (was_enabled and was_tracking))
+    profiler = cProfile.Profile() if profile_path else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield lambda: report(block)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        if folded_path:
+            write_folded_stacks(folded_path, block)
+        with _STATE.lock:
+            _STATE.recording = outer
+            if was_enabled:
+                outer.merge(block)
+        if not was_enabled:
+            disable()
+        else:
+            _STATE.track_allocations = was_tracking
+            if not was_tracing and tracemalloc.is_tracing():
+                tracemalloc.stop()
+                _STATE.started_tracing = False
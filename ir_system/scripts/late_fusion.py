@@ -0,0 +1,259 @@
+import numpy as np
+
+
+NORMALIZATIONS = ("minmax", "zscore", "rank", "none")
+STRATEGIES = ("combsum", "combmnz", "rrf", "weighted")
+
+
+def system_from_content(content, query_ids, k=None):
+    """
+    (ids, scores) matrices of a precomputed system's `content` map for the given queries.
+
+    Args
+    ----
+        content
+            {query_id: [ids]} or {query_id: {id: score}} as stored in the precomputed JSON files.
+        query_ids
+            Queries to extract, in the order of the output rows.
+        k
+            Number of results kept per query (defaults to the longest list).
+
+    Returns
+    -------
+        tuple
+            (ids, scores): (Q x k) object array of ids (None where missing) and float array
+            of scores (NaN where missing). Lists without scores are scored by rank (-rank),
+            which keeps their order under every normalisation.
+    """
+    lists = [content.get(query_id, []) for query_id in query_ids]
+    k = k or max((len(retrieved) for retrieved in lists), default=0)
+    ids = np.full((len(lists), k), None, dtype=object)
+    scores = np.full((len(lists), k), np.nan)
+    for row, retrieved in enumerate(lists):
+        retrieved_ids = list(retrieved)[:k]
+        ids[row, : len(retrieved_ids)] = retrieved_ids
+        if isinstance(retrieved, dict):
+            scores[row, : len(retrieved_ids)] = [retrieved[song_id] for song_id in retrieved_ids]
+        else:
+            scores[row, : len(retrieved_ids)] = -np.arange(len(retrieved_ids))
+    return ids, scores
+
+
+def system_from_graph(graph, query_ids, N=100):
+    """(ids, scores) matrices of the top N of a NeighbourGraph for the given queries."""
+    ids, scores = graph.top_n_ids(query_ids, N)
+    return ids.astype(object), np.asarray(scores, dtype=np.float64)
+
+
+def normalize_scores(scores, method="minmax"):
+    """
+    Normalise each row (one query of one system) of a score matrix; NaN marks missing.
+
+    'minmax' matches the per-query MinMaxScaler of the LateFusion notebook (constant rows
+    become 0), 'zscore' standardises, 'rank' maps rank r (0-based) of K results to 1 - r / K.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    present = ~np.isnan(scores)
+    if method == "none":
+        return scores
+    if method == "minmax":
+        low = np.nanmin(np.where(present, scores, np.inf), axis=1, keepdims=True)
+        high = np.nanmax(np.where(present, scores, -np.inf), axis=1, keepdims=True)
+        spread = high - low
+        normalized = np.divide(scores - low, spread, out=np.zeros_like(scores), where=spread > 0)
+    elif method == "zscore":
+        counts = np.maximum(present.sum(axis=1, keepdims=True), 1)
+        mean = np.where(present, scores, 0).sum(axis=1, keepdims=True) / counts
+        std = np.sqrt((np.where(present, scores - mean, 0) ** 2).sum(axis=1, keepdims=True) / counts)
+        normalized = np.divide(scores - mean, std, out=np.zeros_like(scores), where=std > 0)
+    elif method == "rank":
+        counts = np.maximum(present.sum(axis=1, keepdims=True), 1)
+        order = np.argsort(-np.where(present, scores, -np.inf), axis=1, kind="stable")
+        ranks = np.empty_like(order)
+        np.put_along_axis(ranks, order, np.arange(scores.shape[1])[None, :].repeat(len(scores), axis=0), axis=1)
+        normalized = 1 - ranks / counts
+    else:
+        raise ValueError(f"Unsupported normalisation. Use one of {', '.join(NORMALIZATIONS)}.")
+    return np.where(present, normalized, np.nan)
+
+
+def _ranks(scores):
+    """1-based rank of every present entry of each row (by descending score)."""
+    present = ~np.isnan(scores)
+    order = np.argsort(-np.where(present, scores, -np.inf), axis=1, kind="stable")
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(1, scores.shape[1] + 1)[None, :].repeat(len(scores), axis=0), axis=1)
+    return ranks
+
+
+class LateFusion:
+    """
+    Late fusion of any number of systems over aligned score tensors.
+
+    The systems' candidate lists are aligned once per query into a (Q x U) matrix of
+    candidate ids (U = largest union of candidates), with (S x Q x U) tensors of
+    normalised scores, ranks and presence. Every fusion is then a few vectorised tensor
+    operations across all queries, cheap enough to grid-search weights in a loop.
+
+    Args
+    ----
+        query_ids
+            Ids of the Q queries.
+        systems
+            Dict of system name -> (ids, scores) matrices (see `system_from_content`,
+            `system_from_graph`).
+        normalization
+            Per-query score normalisation: 'minmax', 'zscore', 'rank' or 'none'.
+    """
+
+    def __init__(self, query_ids, systems, normalization="minmax"):
+        self.query_ids = list(query_ids)
+        self.system_names = list(systems)
+        self.normalization = normalization
+
+        id_blocks = [np.asarray(ids, dtype=object) for ids, _ in systems.values()]
+        score_blocks = [np.asarray(scores, dtype=np.float64) for _, scores in systems.values()]
+        normalized_blocks = [normalize_scores(scores, normalization) for scores in score_blocks]
+        rank_blocks = [_ranks(scores) for scores in score_blocks]
+
+        # Integer codes for ids; missing entries get code -1
+        all_ids = np.concatenate(id_blocks, axis=1)
+        missing = np.concatenate([np.isnan(scores) for scores in score_blocks], axis=1) | (all_ids == None)  # noqa: E711
+        vocabulary, codes = np.unique(np.where(missing, "", all_ids).astype(str), return_inverse=True)
+        codes = codes.reshape(all_ids.shape)
+        codes[missing] = -1
+        system_of_column = np.concatenate([np.full(ids.shape[1], s) for s, ids in enumerate(id_blocks)])
+
+        # Slot of every entry within its query's union of candidates
+        n_queries, n_columns = codes.shape
+        sort_keys = np.where(codes >= 0, codes, np.iinfo(np.int64).max)
+        order = np.argsort(sort_keys, axis=1, kind="stable")
+        sorted_codes = np.take_along_axis(sort_keys, order, axis=1)
+        new_candidate = np.ones_like(sorted_codes, dtype=bool)
+        new_candidate[:, 1:] = sorted_codes[:, 1:] != sorted_codes[:, :-1]
+        sorted_slots = np.cumsum(new_candidate, axis=1) - 1
+        slots = np.empty_like(sorted_slots)
+        np.put_along_axis(slots, order, sorted_slots, axis=1)
+        valid = codes >= 0
+        n_candidates = np.where(valid, slots + 1, 0).max(axis=1) if n_columns else np.zeros(n_queries, dtype=int)
+        width = int(n_candidates.max()) if n_queries else 0
+
+        query_index = np.repeat(np.arange(n_queries), n_columns).reshape(n_queries, n_columns)
+        self.candidate_codes = np.full((n_queries, width), -1, dtype=np.int64)
+        self.candidate_codes[query_index[valid], slots[valid]] = codes[valid]
+        self.vocabulary = np.where(vocabulary == "", None, vocabulary).astype(object)
+
+        shape = (len(id_blocks), n_queries, width)
+        self.present = np.zeros(shape, dtype=bool)
+        self.normalized = np.zeros(shape)
+        self.ranks = np.zeros(shape)
+        normalized = np.concatenate(normalized_blocks, axis=1)
+        ranks = np.concatenate(rank_blocks, axis=1)
+        target = (system_of_column[None, :].repeat(n_queries, axis=0)[valid], query_index[valid], slots[valid])
+        self.present[target] = True
+        self.normalized[target] = normalized[valid]
+        self.ranks[target] = ranks[valid]
+
+    def subset(self, query_rows):
+        """The same fusion restricted to some queries (rows) without re-aligning."""
+        subset = object.__new__(LateFusion)
+        subset.__dict__.update(self.__dict__)
+        subset.query_ids = [self.query_ids[row] for row in query_rows]
+        subset.candidate_codes = self.candidate_codes[query_rows]
+        subset.present = self.present[:, query_rows]
+        subset.normalized = self.normalized[:, query_rows]
+        subset.ranks = self.ranks[:, query_rows]
+        return subset
+
+    def _weights(self, weights):
+        if weights is None:
+            return np.ones(len(self.system_names))
+        if isinstance(weights, dict):
+            return np.array([weights.get(name, 0.0) for name in self.system_names], dtype=np.float64)
+        return np.asarray(weights, dtype=np.float64)
+
+    def fused_scores(self, strategy="weighted", weights=None, rrf_k=60):
+        """
+        (Q x U) fused score of every aligned candidate; -inf for empty slots.
+
+        Args
+        ----
+            strategy
+                'combsum' (sum of normalised scores), 'weighted' (weighted sum, the
+                notebook's fuse_results), 'combmnz' (CombSUM times the number of systems
+                retrieving the candidate) or 'rrf' (reciprocal rank fusion).
+            weights
+                Dict of system name -> weight, or a sequence in system order. Used by
+                'weighted', 'combmnz' and 'rrf'; 'combsum' uses equal weights.
+            rrf_k
+                Rank offset of RRF.
+        """
+        w = self._weights(weights)[:, None, None]
+        if strategy == "combsum":
+            fused = (self.normalized * self.present).sum(axis=0)
+        elif strategy == "weighted":
+            fused = (w * self.normalized * self.present).sum(axis=0)
+        elif strategy == "combmnz":
+            fused = (w * self.normalized * self.present).sum(axis=0) * self.present.sum(axis=0)
+        elif strategy == "rrf":
+            fused = np.where(self.present, w / (rrf_k + self.ranks), 0).sum(axis=0)
+        else:
+            raise ValueError(f"Unsupported strategy. Use one of {', '.join(STRATEGIES)}.")
+        return np.where(self.candidate_codes >= 0, fused, -np.inf)
+
+    def fuse_positions(self, strategy="weighted", weights=None, N=100, rrf_k=60):
+        """
+        Top N fused candidates of every query as positions in `candidate_codes`.
+
+        Returns
+        -------
+            tuple
+                (positions, scores): (Q x N) arrays by descending fused score; empty
+                slots have score -inf.
+        """
+        fused = self.fused_scores(strategy, weights, rrf_k)
+        N = min(N, fused.shape[1])
+        if N < fused.shape[1]:
+            top = np.argpartition(-fused, N - 1, axis=1)[:, :N]
+        else:
+            top = np.tile(np.arange(fused.shape[1]), (len(fused), 1))
+        top_scores = np.take_along_axis(fused, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+    def fuse(self, strategy="weighted", weights=None, N=100, rrf_k=60):
+        """
+        Top N fused results of every query.
+
+        Returns
+        -------
+            tuple
+                (ids, scores): (Q x N) arrays by descending fused score (None / -inf padding).
+        """
+        positions, scores = self.fuse_positions(strategy, weights, N, rrf_k)
+        codes = np.take_along_axis(self.candidate_codes, positions, axis=1)
+        ids = np.where(codes >= 0, self.vocabulary[np.maximum(codes, 0)], None)
+        return ids, scores
+
+    def to_json(self, ids, scores, metadata):
+        """
+        Fused results in the format of late_fusion_1000.json.
+
+        Args
+        ----
+            ids, scores
+                Output of `fuse`.
+            metadata
+                Dict of system name -> the system's precomputed metadata.
+
+        Returns
+        -------
+            dict
+                {"metadata": metadata, "fused_content": {query_id: {id: score}}}
+        """
+        fused_content = {}
+        for query_id, row_ids, row_scores in zip(self.query_ids, ids, scores):
+            fused_content[query_id] = {
+                song_id: float(score) for song_id, score in zip(row_ids, row_scores) if song_id is not None
+            }
+        return {"metadata": metadata, "fused_content": fused_content}
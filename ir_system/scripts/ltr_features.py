@@ -0,0 +1,310 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.stats import rankdata
+
+from scripts.binary_export import read_section
+from scripts.retrieval_by_similarity import prepare_feature_matrix
+
+
+LTR_FORMAT_NAME = "mmsr-ltr"
+LTR_FORMAT_VERSION = 1
+SONG_FEATURES = ("normalized_popularity", "normalized_listens", "unique_users", "normalized_users")
+
+
+def interaction_summary(interactions, ids):
+    """
+    Per-song interaction statistics, as the learning_to_rank notebook aggregates them.
+
+    Args
+    ----
+        interactions
+            DataFrame with 'user_id', 'track_id' and 'count' columns.
+        ids
+            Song ids to align the statistics to (songs without interactions get NaN).
+
+    Returns
+    -------
+        pandas.DataFrame
+            Indexed like `ids`, with total_listens, unique_users, normalized_listens and
+            normalized_users (min-max scaled over the songs with interactions).
+    """
+    summary = interactions.groupby("track_id").agg(
+        total_listens=("count", "sum"), unique_users=("user_id", "nunique")
+    )
+    for column, normalized in (("total_listens", "normalized_listens"), ("unique_users", "normalized_users")):
+        values = summary[column].astype(np.float64)
+        spread = values.max() - values.min()
+        summary[normalized] = (values - values.min()) / spread if spread > 0 else 0.0
+    return summary.reindex(pd.Index(ids, name="id"))
+
+
+def user_song_matrix(interactions, ids):
+    """Binary (n_songs x n_users) CSR matrix of which users listened to which song."""
+    rows = pd.Index(ids).get_indexer(interactions["track_id"])
+    known = rows >= 0
+    users, user_columns = np.unique(interactions["user_id"].values[known], return_inverse=True)
+    matrix = sparse.csr_matrix(
+        (np.ones(known.sum(), dtype=np.float32), (rows[known], user_columns)), shape=(len(ids), len(users))
+    )
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return matrix
+
+
+def song_feature_table(dataset, ids, interactions=None, popularity_column="popularity"):
+    """
+    (n_songs x len(SONG_FEATURES)) float32 per-song features aligned to `ids`; computed
+    once and shared by every query (missing values are 0).
+    """
+    popularity = dataset.set_index("id")[popularity_column].reindex(ids).astype(np.float64)
+    spread = popularity.max() - popularity.min()
+    table = pd.DataFrame(
+        {"normalized_popularity": (popularity - popularity.min()) / spread if spread > 0 else 0.0}, index=ids
+    )
+    if interactions is not None:
+        summary = interaction_summary(interactions, ids)
+        for column in SONG_FEATURES[1:]:
+            table[column] = summary[column].values
+    else:
+        for column in SONG_FEATURES[1:]:
+            table[column] = np.nan
+    return np.nan_to_num(table[list(SONG_FEATURES)].values.astype(np.float32))
+
+
+def percentile_labels(scores):
+    """
+    Discrete relevance labels of each row of candidate scores, like `prepare_ltr_data`:
+    the percentile rank (average ties) maps to 3 (> 0.90), 2 (> 0.75), 1 (> 0.50) or 0.
+    """
+    percentile = rankdata(scores, method="average", axis=1) / scores.shape[1]
+    return np.select([percentile > 0.90, percentile > 0.75, percentile > 0.50], [3, 2, 1], 0).astype(np.float32)
+
+
+class LTRFeatureBuilder:
+    """
+    (query, candidate) pairs and their features and labels for LambdaMART, built in
+    NumPy blocks of queries from a neighbour graph.
+
+    Features of a pair are the similarity of query and candidate in every feature
+    space, the candidate's per-song features (SONG_FEATURES) and its rank in the
+    candidate list. Labels follow `prepare_ltr_data`: percentile buckets of the number
+    of users shared with the query ('overlap'), or of the Weighted Jaccard tag
+    relevance ('jaccard').
+
+    Args
+    ----
+        graph
+            NeighbourGraph providing the candidates; its ids define the song order.
+        feature_spaces
+            Dict of feature space name -> FeatureSpace (or (ids, matrix) tuple).
+        dataset
+            DataFrame with 'id' and the popularity column.
+        interactions
+            DataFrame of user interactions ('user_id', 'track_id', 'count'); needed for
+            the interaction features and 'overlap' labels.
+        tag_index
+            TagIndex of the songs; needed for 'jaccard' labels.
+        metric
+            Similarity metric for the feature-space similarities ('cosine', 'euclidean').
+        popularity_column
+            Name of the popularity column of `dataset`.
+    """
+
+    def __init__(
+        self,
+        graph,
+        feature_spaces,
+        dataset,
+        interactions=None,
+        tag_index=None,
+        metric="cosine",
+        popularity_column="popularity",
+    ):
+        self.graph = graph
+        self.ids = np.asarray(graph.ids)
+        self.metric = metric
+        self.tag_index = tag_index
+
+        # Every feature space is prepared once and indexed in graph order
+        self.spaces = {}
+        for name, feature_space in feature_spaces.items():
+            if isinstance(feature_space, tuple):
+                space_ids, matrix = feature_space
+                id_to_row = {song_id: row for row, song_id in enumerate(space_ids)}
+                rows = np.fromiter((id_to_row[song_id] for song_id in self.ids), dtype=np.int64, count=len(self.ids))
+            else:
+                matrix = feature_space.matrix
+                rows = feature_space.rows_for_ids(self.ids)
+            matrix = matrix[rows] if sparse.issparse(matrix) else np.asarray(matrix)[rows]
+            self.spaces[name] = prepare_feature_matrix(matrix, metric, dtype=np.float32)
+
+        self.song_features = song_feature_table(dataset, self.ids, interactions, popularity_column)
+        self.users = user_song_matrix(interactions, self.ids) if interactions is not None else None
+        self.feature_names = [f"sim_{name}" for name in self.spaces] + list(SONG_FEATURES) + ["rank"]
+
+    def pair_similarities(self, query_rows, candidate_rows):
+        """(Q x K x n_spaces) similarity of every query to its candidates in every feature space."""
+        blocks = []
+        for prepared in self.spaces.values():
+            matrix = prepared["matrix"]
+            if sparse.issparse(matrix):
+                pairs = matrix[candidate_rows.ravel()].multiply(matrix[np.repeat(query_rows, candidate_rows.shape[1])])
+                products = np.asarray(pairs.sum(axis=1)).reshape(candidate_rows.shape)
+            else:
+                products = np.einsum("qkd,qd->qk", matrix[candidate_rows], matrix[query_rows])
+            if prepared["metric"] == "cosine":
+                blocks.append(products)
+            else:
+                squared_norms = prepared["squared_norms"]
+                distances = np.sqrt(
+                    np.maximum(squared_norms[query_rows][:, None] - 2 * products + squared_norms[candidate_rows], 0)
+                )
+                blocks.append(1 / (1 + distances))
+        return np.stack(blocks, axis=2) if blocks else np.zeros(candidate_rows.shape + (0,), dtype=np.float32)
+
+    def features(self, query_rows, candidate_rows):
+        """(Q x K x n_features) float32 features of the pairs (see `feature_names`)."""
+        n_queries, k = candidate_rows.shape
+        rank = np.broadcast_to(np.arange(1, k + 1, dtype=np.float32), (n_queries, k))[:, :, None]
+        return np.concatenate(
+            [
+                self.pair_similarities(query_rows, candidate_rows).astype(np.float32),
+                self.song_features[candidate_rows],
+                rank,
+            ],
+            axis=2,
+        )
+
+    def labels(self, query_rows, candidate_rows, label_mode="overlap"):
+        """(Q x K) relevance labels of the pairs."""
+        if label_mode == "overlap":
+            if self.users is None:
+                raise ValueError("label_mode='overlap' requires interactions.")
+            n_queries, k = candidate_rows.shape
+            shared = self.users[np.repeat(query_rows, k)].multiply(self.users[candidate_rows.ravel()])
+            scores = np.asarray(shared.sum(axis=1)).reshape(n_queries, k)
+        elif label_mode == "jaccard":
+            if self.tag_index is None:
+                raise ValueError("label_mode='jaccard' requires a tag_index.")
+            n_queries, k = candidate_rows.shape
+            scores = self.tag_index.pairwise_relevance(
+                self.tag_index.rows_for_ids(np.repeat(self.ids[query_rows], k).tolist()),
+                self.tag_index.rows_for_ids(self.ids[candidate_rows.ravel()].tolist()),
+            ).reshape(n_queries, k)
+        else:
+            raise ValueError("Unsupported label_mode. Use 'overlap' or 'jaccard'.")
+        return percentile_labels(scores)
+
+    def _block(self, query_rows, N, label_mode):
+        candidate_rows, _ = self.graph.top_n(query_rows, N)
+        candidate_rows = np.asarray(candidate_rows, dtype=np.int64)
+        features = self.features(query_rows, candidate_rows)
+        labels = self.labels(query_rows, candidate_rows, label_mode) if label_mode else None
+        return candidate_rows, features, labels
+
+    def build(self, query_ids, N=100, label_mode="overlap", block_size=64, n_workers=1):
+        """
+        Features and labels of the top N candidates of every query.
+
+        Blocks of `block_size` queries are built on `n_workers` threads; the work is
+        matrix products and sparse products, which release the GIL.
+
+        Returns
+        -------
+            dict
+                "features" (P x F float32), "labels" (P float32, absent if `label_mode`
+                is None), "group_offsets" (Q + 1 int64; the pairs of query q are rows
+                offsets[q]:offsets[q + 1]), "query_rows" and "candidate_rows" (graph
+                rows), and "feature_names".
+        """
+        query_rows = np.fromiter((self.graph.id_to_row[song_id] for song_id in query_ids), dtype=np.int64)
+        blocks = [query_rows[start : start + block_size] for start in range(0, len(query_rows), block_size)]
+        with ThreadPoolExecutor(max(n_workers, 1)) as executor:
+            results = list(executor.map(lambda rows: self._block(rows, N, label_mode), blocks))
+
+        candidate_rows = np.concatenate([r[0] for r in results]) if results else np.zeros((0, N), dtype=np.int64)
+        features = np.concatenate([r[1] for r in results]) if results else np.zeros((0, N, len(self.feature_names)))
+        data = {
+            "features": features.reshape(-1, len(self.feature_names)).astype(np.float32),
+            "group_offsets": np.arange(0, candidate_rows.size + 1, candidate_rows.shape[1], dtype=np.int64),
+            "query_rows": query_rows,
+            "candidate_rows": candidate_rows.ravel(),
+            "feature_names": list(self.feature_names),
+        }
+        if label_mode:
+            data["labels"] = np.concatenate([r[2] for r in results]).ravel()
+        return data
+
+
+def save_ltr_data(data, output_path, ids, metadata=None):
+    """
+    Write LTR data as one binary file plus a JSON header at `<output_path>.json`, in the
+    layout of `export_precomputed_binary`: features, labels, group offsets, query and
+    candidate rows as raw little-endian sections that load straight into a DMatrix.
+
+    Args
+    ----
+        data
+            Output of `LTRFeatureBuilder.build`.
+        output_path
+            Path of the binary file (e.g., "lambdamart_tuned/ltr_data/ltr_200_cosine_100.bin").
+        ids
+            Song ids the rows refer to (the graph's ids); stored in the header.
+        metadata
+            Extra parameters recorded in the header (sampling size, N, metric, ...).
+    """
+    arrays = (
+        ("features", data["features"].astype("<f4")),
+        ("labels", data["labels"].astype("<f4") if "labels" in data else None),
+        ("group_offsets", data["group_offsets"].astype("<i8")),
+        ("query_rows", data["query_rows"].astype("<i4")),
+        ("candidate_rows", data["candidate_rows"].astype("<i4")),
+    )
+    sections = {}
+    offset = 0
+    with open(output_path, "wb") as f:
+        for name, array in arrays:
+            if array is None:
+                continue
+            f.write(np.ascontiguousarray(array).tobytes())
+            sections[name] = {"offset": offset, "dtype": array.dtype.str, "shape": list(array.shape)}
+            offset += array.nbytes
+
+    header = {
+        "format": LTR_FORMAT_NAME,
+        "version": LTR_FORMAT_VERSION,
+        "metadata": metadata or {},
+        "binary_file": os.path.basename(output_path),
+        "feature_names": data["feature_names"],
+        "ids": np.asarray(ids).astype(str).tolist(),
+        "sections": sections,
+    }
+    with open(output_path + ".json", "w") as f:
+        json.dump(header, f)
+    return header
+
+
+def load_ltr_data(header_path):
+    """Load LTR data written by `save_ltr_data`; returns the `build` dict plus "ids" and "metadata"."""
+    with open(header_path, "r") as f:
+        header = json.load(f)
+    binary_path = os.path.join(os.path.dirname(header_path), header["binary_file"])
+    data = {name: read_section(binary_path, section) for name, section in header["sections"].items()}
+    data["feature_names"] = header["feature_names"]
+    data["ids"] = np.asarray(header["ids"], dtype=object)
+    data["metadata"] = header["metadata"]
+    return data
+
+
+def to_dmatrix(data):
+    """XGBoost DMatrix of LTR data with labels and query groups (requires xgboost)."""
+    import xgboost as xgb
+
+    dmatrix = xgb.DMatrix(data["features"], label=data.get("labels"), feature_names=data["feature_names"])
+    dmatrix.set_group(np.diff(data["group_offsets"]))
+    return dmatrix
@@ -0,0 +1,268 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+METRIC_KEYS = ("Precision@N", "Recall@N", "NDCG@N", "MRR")
+
+
+def _discount_cumsum(k):
+    """Cumulative DCG discounts 1/log2(i + 2) for the first k positions."""
+    return np.cumsum(1 / np.log2(np.arange(k) + 2))
+
+
+def _rows_or_missing(tag_index, song_ids):
+    """TagIndex rows of song ids, -1 for missing ids (None or NaN); unknown ids raise a KeyError."""
+    song_ids = np.asarray(song_ids, dtype=object).ravel()
+    missing = pd.isna(song_ids)
+    rows = np.full(len(song_ids), -1, dtype=np.int64)
+    rows[~missing] = [tag_index.id_to_row.get(song_id, -1) for song_id in song_ids[~missing]]
+    unknown = ~missing & (rows < 0)
+    if np.any(unknown):
+        raise KeyError(f"Song ids missing from the TagIndex: {song_ids[unknown][:10].tolist()}")
+    return rows
+
+
+def _grades(tag_index, query_rows, candidate_rows):
+    """(Q x K) Weighted Jaccard grades of row pairs; NaN where either row is missing."""
+    n_queries, k = candidate_rows.shape
+    query_rows = np.repeat(query_rows, k)
+    candidate_rows = candidate_rows.ravel()
+    valid = (query_rows >= 0) & (candidate_rows >= 0)
+    grades = np.full(n_queries * k, np.nan)
+    grades[valid] = tag_index.pairwise_relevance(query_rows[valid], candidate_rows[valid])
+    return grades.reshape(n_queries, k)
+
+
+def _relevant_sets(tag_index, query_ids, query_rows, ideal_k=None):
+    """
+    Size of each query's relevant set (the query itself included, as in
+    `evaluate_metrics`) and, if `ideal_k` is given, its (Q x ideal_k) largest grades
+    (the query itself excluded), from a single relevance lookup per query.
+    """
+    n_relevant = np.zeros(len(query_rows), dtype=np.int64)
+    ideal = None if ideal_k is None else np.zeros((len(query_rows), ideal_k))
+    for i, (song_id, row) in enumerate(zip(query_ids, query_rows)):
+        if row < 0:
+            continue
+        relevant_ids, scores = tag_index.relevance_for_id(song_id)
+        n_relevant[i] = len(relevant_ids)
+        if ideal is not None:
+            scores = np.sort(scores[relevant_ids != song_id])[::-1][:ideal_k]
+            ideal[i, : len(scores)] = scores
+    return n_relevant, ideal
+
+
+def _relevance(tag_index, query_ids, retrieved_ids, ideal_k=None):
+    """Grades, relevant-set sizes and (if `ideal_k` is given) ideal grades; see `batch_relevance`."""
+    query_ids = list(query_ids)
+    retrieved_ids = np.asarray(retrieved_ids, dtype=object)
+    query_rows = _rows_or_missing(tag_index, query_ids)
+    candidate_rows = _rows_or_missing(tag_index, retrieved_ids).reshape(retrieved_ids.shape)
+    grades = _grades(tag_index, query_rows, candidate_rows)
+    n_relevant, ideal = _relevant_sets(tag_index, query_ids, query_rows, ideal_k)
+    return grades, n_relevant, ideal
+
+
+def batch_relevance(tag_index, query_ids, retrieved_ids):
+    """
+    Relevance grades of a retrieved-id matrix and the size of each query's relevant set.
+
+    Missing ids (None or NaN) get NaN grades (a missing result, see `batch_metrics`) and
+    a missing query an empty relevant set; ids that are not in the index raise a KeyError.
+
+    Args
+    ----
+        tag_index
+            TagIndex of the dataset.
+        query_ids
+            Ids of the Q query songs.
+        retrieved_ids
+            (Q x K) matrix of retrieved song ids, in rank order.
+
+    Returns
+    -------
+        tuple
+            (grades, n_relevant): (Q x K) Weighted Jaccard grades of the retrieved songs
+            and the number of relevant songs of each query (the query itself included,
+            as in `evaluate_metrics`).
+    """
+    grades, n_relevant, _ = _relevance(tag_index, query_ids, retrieved_ids)
+    return grades, n_relevant
+
+
+def batch_metrics(grades, n_relevant, k=None, ndcg_mode="binary", ideal_grades=None):
+    """
+    Precision@k, Recall@k, NDCG@k and MRR of all queries in one pass.
+
+    Args
+    ----
+        grades
+            (Q x K) relevance grades of the retrieved songs in rank order; a grade > 0
+            means relevant. NaN marks a missing result (shorter retrieved list).
+        n_relevant
+            Number of relevant songs per query.
+        k
+            Cut-off; defaults to K.
+        ndcg_mode
+            'binary' reproduces `ndcg_at_k` (binary gains with the tied constant scores
+            it passes to sklearn's ndcg_score). 'graded' uses the grades as gains in rank
+            order and needs `ideal_grades`.
+        ideal_grades
+            (Q x k) best achievable grades per query, sorted descending (for 'graded').
+
+    Returns
+    -------
+        dict
+            Arrays of per-query Precision@N, Recall@N, NDCG@N and MRR.
+    """
+    grades = np.asarray(grades, dtype=np.float64)
+    n_queries, n_columns = grades.shape
+    k = n_columns if k is None else min(k, n_columns)
+    n_relevant = np.asarray(n_relevant)
+
+    valid = ~np.isnan(grades)
+    hits_matrix = valid & (np.nan_to_num(grades) > 0)
+    hits = hits_matrix[:, :k].sum(axis=1)
+
+    precision = hits / k
+    recall = np.divide(hits, n_relevant, out=np.zeros(n_queries), where=n_relevant > 0)
+
+    # MRR looks at the full retrieved list, like mean_reciprocal_rank
+    any_hit = hits_matrix.any(axis=1)
+    first_hit = np.argmax(hits_matrix, axis=1)
+    mrr = np.where(any_hit, 1 / (first_hit + 1), 0.0)
+
+    discount_cumsum = _discount_cumsum(k)
+    if ndcg_mode == "binary":
+        # All retrieved songs share one score, so sklearn averages the gains over the tie
+        n_retrieved = valid[:, :k].sum(axis=1)
+        dcg = np.divide(
+            hits * discount_cumsum[np.maximum(n_retrieved, 1) - 1],
+            n_retrieved,
+            out=np.zeros(n_queries),
+            where=n_retrieved > 0,
+        )
+        idcg = np.where(hits > 0, discount_cumsum[np.maximum(hits, 1) - 1], 0.0)
+    elif ndcg_mode == "graded":
+        if ideal_grades is None:
+            raise ValueError("ndcg_mode='graded' requires ideal_grades.")
+        discount = 1 / np.log2(np.arange(k) + 2)
+        dcg = np.nan_to_num(grades[:, :k]) @ discount
+        idcg = np.asarray(ideal_grades, dtype=np.float64)[:, :k] @ discount
+    else:
+        raise ValueError("Unsupported ndcg_mode. Use 'binary' or 'graded'.")
+    ndcg = np.divide(dcg, idcg, out=np.zeros(n_queries), where=idcg > 0)
+
+    return {"Precision@N": precision, "Recall@N": recall, "NDCG@N": ndcg, "MRR": mrr}
+
+
+def evaluate_retrieved(tag_index, query_ids, retrieved_ids, k=None, ndcg_mode="binary"):
+    """
+    Per-query accuracy metrics for a (Q x K) retrieved-id matrix.
+
+    Args
+    ----
+        tag_index
+            TagIndex of the dataset.
+        query_ids
+            Ids of the Q query songs.
+        retrieved_ids
+            (Q x K) matrix of retrieved song ids, in rank order; None or NaN marks a
+            missing result.
+        k
+            Cut-off; defaults to K.
+        ndcg_mode
+            'binary' (compatible with `evaluate_metrics`) or 'graded' (Weighted Jaccard gains).
+
+    Returns
+    -------
+        dict
+            Arrays of per-query Precision@N, Recall@N, NDCG@N and MRR.
+    """
+    retrieved_ids = np.asarray(retrieved_ids, dtype=object)
+    k = retrieved_ids.shape[1] if k is None else min(k, retrieved_ids.shape[1])
+    grades, n_relevant, ideal_grades = _relevance(
+        tag_index, query_ids, retrieved_ids, k if ndcg_mode == "graded" else None
+    )
+    return batch_metrics(grades, n_relevant, k=k, ndcg_mode=ndcg_mode, ideal_grades=ideal_grades)
+
+
+def mean_metrics(per_query):
+    """Average per-query metric arrays into the dict format of `run_evaluations`."""
+    return {key: float(np.mean(values)) for key, values in per_query.items()}
+
+
+def batch_beyond_accuracy(retrieved_rows, tag_weights, popularity, weight_thresholds=(60,), n_songs=None):
+    """
+    Coverage, Diversity and normalised average Popularity of all queries in one pass,
+    for several tag weight thresholds at once.
+
+    Matches `beyond_accuracy_metrics`: each query's retrieved songs are treated as a set,
+    Diversity is unique tags / tag occurrences among tags with weight >= threshold, and
+    AvgPop is the mean popularity min-max normalised over the whole catalogue.
+
+    Args
+    ----
+        retrieved_rows
+            (Q x N) rows of the retrieved songs (rows of `tag_weights` and `popularity`).
+        tag_weights
+            (n_songs x n_tags) sparse tag weight matrix (e.g., TagIndex.weights).
+        popularity
+            Popularity of every song (NaN for missing values).
+        weight_thresholds
+            Tag weight thresholds to evaluate Diversity for.
+        n_songs
+            Catalogue size for Coverage; defaults to the number of rows of `tag_weights`.
+
+    Returns
+    -------
+        dict
+            threshold -> {"Cov@N", "Div@N", "AvgPop@N"} averages, plus the per-query
+            arrays under "per_query" -> threshold -> {"Div@N", "AvgPop@N"}.
+    """
+    retrieved_rows = np.asarray(retrieved_rows, dtype=np.int64)
+    n_queries = retrieved_rows.shape[0]
+    n_songs = tag_weights.shape[0] if n_songs is None else n_songs
+
+    # Query x song selection matrix; duplicates collapse like `isin` does
+    selection = sparse.csr_matrix(
+        (np.ones(retrieved_rows.size), retrieved_rows.ravel(), np.arange(0, retrieved_rows.size + 1, retrieved_rows.shape[1])),
+        shape=(n_queries, tag_weights.shape[0]),
+    )
+    selection.sum_duplicates()
+    selection.data[:] = 1
+
+    coverage = len(np.unique(retrieved_rows)) / n_songs
+
+    popularity = np.asarray(popularity, dtype=np.float64)
+    known = ~np.isnan(popularity)
+    popularity_sum = selection @ np.where(known, popularity, 0)
+    popularity_count = selection @ known.astype(np.float64)
+    average_popularity = np.divide(
+        popularity_sum, popularity_count, out=np.full(n_queries, np.nan), where=popularity_count > 0
+    )
+    min_popularity, max_popularity = np.nanmin(popularity), np.nanmax(popularity)
+    if max_popularity > min_popularity:
+        normalized_popularity = (average_popularity - min_popularity) / (max_popularity - min_popularity)
+    else:
+        normalized_popularity = np.zeros(n_queries)
+
+    tag_weights = sparse.csr_matrix(tag_weights)
+    results = {"per_query": {}}
+    for threshold in weight_thresholds:
+        kept = tag_weights.copy()
+        kept.data = (kept.data >= threshold).astype(np.float64)
+        kept.eliminate_zeros()
+        tag_counts = (selection @ kept).tocsr()
+        total_tags = np.asarray(tag_counts.sum(axis=1)).ravel()
+        unique_tags = np.diff(tag_counts.indptr)
+        diversity = np.divide(unique_tags, total_tags, out=np.zeros(n_queries), where=total_tags > 0)
+
+        results[threshold] = {
+            "Cov@N": coverage,
+            "Div@N": float(diversity.mean()),
+            "AvgPop@N": float(normalized_popularity.mean()),
+        }
+        results["per_query"][threshold] = {"Div@N": diversity, "AvgPop@N": normalized_popularity}
+    return results
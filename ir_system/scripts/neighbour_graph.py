@@ -0,0 +1,155 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from scripts.embedding_store import DEFAULT_STORE_DIR
+from scripts.retrieval_by_similarity import prepare_feature_matrix, top_k_by_similarity
+
+
+class NeighbourGraph:
+    """
+    Top-K_max neighbours of every song for one feature space and metric.
+
+    Rankings for any N <= K_max are prefixes of the stored rows, so one graph serves
+    every N and every consumer (evaluation, beyond-accuracy metrics, late fusion, LTR
+    candidate generation) without recomputing similarities.
+
+    Attributes
+    ----------
+        feature_space: str
+            Name of the feature space (e.g., "BERT").
+        metric: str
+            Similarity metric ('cosine', 'euclidean').
+        ids: numpy.ndarray
+            Song ids in row order.
+        indices: numpy.ndarray
+            (n_songs x k_max) rows of the neighbours, by descending similarity.
+        scores: numpy.ndarray
+            (n_songs x k_max) similarities of the neighbours.
+    """
+
+    def __init__(self, feature_space, metric, ids, indices, scores):
+        self.feature_space = feature_space
+        self.metric = metric
+        self.ids = np.asarray(ids)
+        self.indices = indices
+        self.scores = scores
+        self.id_to_row = {song_id: row for row, song_id in enumerate(self.ids)}
+
+    @property
+    def k_max(self):
+        return self.indices.shape[1]
+
+    def _check_n(self, N):
+        if N > self.k_max:
+            raise ValueError(f"N={N} exceeds the {self.k_max} neighbours stored for {self.feature_space} ({self.metric}).")
+
+    def top_n(self, query_rows, N=10):
+        """(rows, scores) of the top N neighbours of the given query rows."""
+        self._check_n(N)
+        return self.indices[query_rows, :N], self.scores[query_rows, :N]
+
+    def top_n_ids(self, query_ids, N=10):
+        """(ids, scores) of the top N neighbours of the given query ids."""
+        rows = [self.id_to_row[song_id] for song_id in query_ids]
+        indices, scores = self.top_n(rows, N)
+        return self.ids[indices], scores
+
+
+def build_neighbour_graph(feature_space, ids, feature_matrix, metric="cosine", k_max=200, chunk_size=256):
+    """
+    Build the neighbour graph of a feature space with the batched retrieval engine.
+
+    Args
+    ----
+        feature_space
+            Name of the feature space (e.g., "BERT").
+        ids
+            Song ids in the row order of `feature_matrix`.
+        feature_matrix
+            (n_songs x dim) feature embeddings.
+        metric
+            Similarity metric ('cosine', 'euclidean').
+        k_max
+            Number of neighbours stored per song; the largest N that can be served.
+        chunk_size
+            Number of queries scored per matrix product.
+
+    Returns
+    -------
+        NeighbourGraph
+    """
+    prepared = prepare_feature_matrix(feature_matrix, metric)
+    indices, scores = top_k_by_similarity(
+        np.arange(len(ids)), metric=metric, k=k_max, chunk_size=chunk_size, prepared=prepared
+    )
+    index_dtype = np.int32 if len(ids) < np.iinfo(np.int32).max else np.int64
+    return NeighbourGraph(feature_space, metric, ids, indices.astype(index_dtype), scores.astype(np.float32))
+
+
+def _graph_dir(store_dir, feature_space, metric):
+    return os.path.join(store_dir, feature_space, f"graph_{metric}")
+
+
+def save_neighbour_graph(graph, store_dir=DEFAULT_STORE_DIR):
+    """Save a graph next to its feature space in the embedding store."""
+    target_dir = _graph_dir(store_dir, graph.feature_space, graph.metric)
+    os.makedirs(target_dir, exist_ok=True)
+    np.save(os.path.join(target_dir, "ids.npy"), graph.ids.astype(str))
+    np.save(os.path.join(target_dir, "indices.npy"), graph.indices)
+    np.save(os.path.join(target_dir, "scores.npy"), graph.scores)
+    with open(os.path.join(target_dir, "manifest.json"), "w") as f:
+        json.dump(
+            {
+                "feature_space": graph.feature_space,
+                "metric": graph.metric,
+                "n_rows": len(graph.ids),
+                "k_max": graph.k_max,
+            },
+            f,
+            indent=4,
+        )
+    return target_dir
+
+
+def has_neighbour_graph(feature_space, metric, store_dir=DEFAULT_STORE_DIR):
+    return os.path.exists(os.path.join(_graph_dir(store_dir, feature_space, metric), "manifest.json"))
+
+
+def load_neighbour_graph(feature_space, metric="cosine", store_dir=DEFAULT_STORE_DIR):
+    """Load a saved graph; the neighbour matrices are memory-mapped read-only."""
+    target_dir = _graph_dir(store_dir, feature_space, metric)
+    ids = np.load(os.path.join(target_dir, "ids.npy"))
+    indices = np.load(os.path.join(target_dir, "indices.npy"), mmap_mode="r")
+    scores = np.load(os.path.join(target_dir, "scores.npy"), mmap_mode="r")
+    return NeighbourGraph(feature_space, metric, ids, indices, scores)
+
+
+def retrieve_n_songs_from_graph(query_song, dataset, graph, N=10):
+    """
+    Drop-in replacement for `retrieve_n_songs_by_similarity` reading a neighbour graph.
+
+    Args
+    ----
+        query_song
+            The query song (row) from the dataset.
+        dataset
+            Full dataset; neighbours missing from it are skipped.
+        graph
+            NeighbourGraph of the feature space and metric to use.
+        N
+            Number of top results to retrieve.
+
+    Returns
+    -------
+        pandas.DataFrame
+            A DataFrame of the top N similar songs with similarity scores.
+    """
+    neighbour_ids, scores = graph.top_n_ids([query_song["id"]], N)
+    positions = pd.Index(dataset["id"]).get_indexer(neighbour_ids[0])
+    found = positions >= 0
+    results = dataset.iloc[positions[found]].copy()
+    results["similarity"] = scores[0][found]
+    return results
@@ -0,0 +1,480 @@
+import os
+import sys
+import time
+from multiprocessing import Pool, resource_tracker, shared_memory
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from scripts import instrumentation
+from scripts.instrumentation import count, timer
+from scripts.metric_kernels import batch_beyond_accuracy, evaluate_retrieved
+from scripts.random_baseline import random_baseline_rows
+from scripts.relevance_computation import TagIndex
+from scripts.retrieval_by_similarity import prepare_feature_matrix, top_k_by_similarity
+
+
+ACCURACY_KEYS = ("Precision@N", "Recall@N", "NDCG@N", "MRR")
+
+
+class Progress:
+    """
+    Progress and ETA reporting for sharded runs, replacing the per-loop tqdm bars.
+
+    Args
+    ----
+        total
+            Total number of work items (queries).
+        desc
+            Label printed in front of the progress line.
+        callback
+            Optional function called as callback(done, total, rate, eta) on every update
+            instead of printing.
+        min_interval
+            Minimum number of seconds between two printed lines.
+    """
+
+    def __init__(self, total, desc="", callback=None, min_interval=1.0):
+        self.total = total
+        self.desc = desc
+        self.callback = callback
+        self.min_interval = min_interval
+        self.done = 0
+        self.start_time = time.perf_counter()
+        self._last_print = 0.0
+
+    @property
+    def rate(self):
+        elapsed = time.perf_counter() - self.start_time
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        rate = self.rate
+        return (self.total - self.done) / rate if rate > 0 else float("inf")
+
+    def update(self, n=1):
+        self.done += n
+        if self.callback is not None:
+            self.callback(self.done, self.total, self.rate, self.eta)
+            return
+        now = time.perf_counter()
+        if self.done >= self.total or now - self._last_print >= self.min_interval:
+            self._last_print = now
+            eta = self.eta
+            eta_text = time.strftime("%H:%M:%S", time.gmtime(eta)) if np.isfinite(eta) else "--:--:--"
+            end = "\n" if self.done >= self.total else ""
+            sys.stdout.write(
+                f"\r{self.desc}: {self.done}/{self.total} queries "
+                f"({self.rate:.1f} q/s, ETA {eta_text})" + end
+            )
+            sys.stdout.flush()
+
+
+class SharedArray:
+    """
+    A NumPy array placed in POSIX shared memory so worker processes can attach to it
+    by name instead of receiving a pickled copy.
+    """
+
+    def __init__(self, array):
+        if sparse.issparse(array):
+            raise TypeError("SharedArray holds dense arrays; share sparse matrices with share_matrix().")
+        array = np.ascontiguousarray(array)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=self._shm.buf)
+        view[...] = array
+        self.spec = (self._shm.name, array.shape, array.dtype.str)
+
+    def release(self):
+        self._shm.close()
+        if os.name == "posix":
+            # Workers sharing this process's resource tracker may have unregistered the
+            # segment (see `attach_shared_array`); register it again so unlink() balances
+            resource_tracker.register(self._shm._name, "shared_memory")
+        self._shm.unlink()
+
+
+def attach_shared_array(spec):
+    """Attach to a SharedArray from its spec; returns (array view, handle to keep alive)."""
+    name, shape, dtype = spec
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no `track` argument: attaching registers the segment with this
+        # process's resource tracker, which would unlink it (and warn) when the worker exits
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name == "posix":
+            resource_tracker.unregister(shm._name, "shared_memory")
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    array.flags.writeable = False
+    return array, shm
+
+
+def share_matrix(matrix, shared):
+    """
+    Place a dense array, or a sparse matrix as its CSR data/indices/indptr buffers, in
+    shared memory. Every SharedArray is appended to `shared` as soon as it exists, so
+    the caller can release them even if a later one fails.
+
+    Returns
+    -------
+        tuple
+            Spec to pass to `attach_matrix`.
+    """
+    if sparse.issparse(matrix):
+        matrix = sparse.csr_matrix(matrix)
+        specs = []
+        for array in (matrix.data, matrix.indices, matrix.indptr):
+            shared.append(SharedArray(array))
+            specs.append(shared[-1].spec)
+        return ("csr", tuple(specs), matrix.shape)
+    shared.append(SharedArray(matrix))
+    return ("dense", shared[-1].spec)
+
+
+def attach_matrix(spec):
+    """Attach to a matrix shared by `share_matrix`; returns (matrix, handles to keep alive)."""
+    if spec[0] == "csr":
+        _, part_specs, shape = spec
+        (data, data_handle), (indices, indices_handle), (indptr, indptr_handle) = map(attach_shared_array, part_specs)
+        matrix = sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+        return matrix, [data_handle, indices_handle, indptr_handle]
+    array, handle = attach_shared_array(spec[1])
+    return array, [handle]
+
+
+# Per-process state set by `_init_worker`
+_WORKER = {}
+
+
+def _init_worker(context):
+    _WORKER.clear()
+    _WORKER.update(context)
+    # Forked workers inherit the parent's recording; each task sends back only its own
+    if context["instrumented"]:
+        instrumentation.enable()
+    else:
+        instrumentation.disable()
+    instrumentation.reset()
+    prepared = {}
+    handles = []
+    for metric, (matrix_spec, norms_spec) in context["prepared_specs"].items():
+        matrix, matrix_handles = attach_matrix(matrix_spec)
+        squared_norms, norms_handles = attach_matrix(norms_spec)
+        handles.extend(matrix_handles + norms_handles)
+        prepared[metric] = {"metric": metric, "matrix": matrix, "squared_norms": squared_norms}
+    _WORKER["prepared"] = prepared
+    _WORKER["handles"] = handles
+
+
+def _retrieve_shard(metric, query_rows, N):
+    """Retrieved rows for a shard of query rows, as the serial functions retrieve them."""
+    if metric == "random":
+        indices, _ = random_baseline_rows(query_rows, len(_WORKER["ids"]), N)
+    else:
+        indices, _ = top_k_by_similarity(query_rows, metric=metric, k=N, prepared=_WORKER["prepared"][metric])
+    return indices
+
+
+def _evaluate_shard(task):
+    """
+    Worker entry point: evaluate one shard of queries for one metric with the batch
+    kernels. Returns the shard's timings too when instrumentation is enabled.
+    """
+    shard_id, metric, query_rows, N, accuracy, weight_threshold = task
+    ids = _WORKER["ids"]
+    count("evaluate_metrics.queries", len(query_rows))
+    with timer("evaluate_shard.retrieval"):
+        retrieved = _retrieve_shard(metric, query_rows, N)
+
+    per_query = {}
+    with timer("evaluate_shard.metrics"):
+        if accuracy:
+            per_query.update(evaluate_retrieved(_WORKER["tag_index"], ids[query_rows], ids[retrieved], k=N))
+        if weight_threshold is not None:
+            beyond = batch_beyond_accuracy(
+                retrieved, _WORKER["diversity_weights"], _WORKER["popularity"], (weight_threshold,)
+            )
+            per_query.update(beyond["per_query"][weight_threshold])
+
+    rows = [
+        {"retrieved": ids[retrieved_rows].tolist(), **{key: float(values[i]) for key, values in per_query.items()}}
+        for i, retrieved_rows in enumerate(retrieved)
+    ]
+    recording = instrumentation.take_recording() if _WORKER["instrumented"] else None
+    return shard_id, rows, recording
+
+
+class ShardedEvaluator:
+    """
+    Process pool evaluating one dataset with its feature matrices in shared memory.
+
+    Query indices are split into shards of `shard_size` and evaluated by `n_workers`
+    processes with the batch metric kernels. Workers attach to the prepared
+    (normalised) feature matrices by name, dense or CSR; only the tag index, ids and
+    popularity are sent to each worker once, at start-up. Per-query results are put
+    back in query order before they are summed, so the averages match the serial
+    functions. If instrumentation is enabled when the evaluator is created, the
+    workers' timings and counters are added to the parent's recording (summed over
+    processes).
+
+    Args
+    ----
+        dataset
+            Full dataset (DataFrame with 'id' and tags columns).
+        feature_columns
+            Feature columns, or None for the random baseline.
+        metrics
+            Similarity metrics to prepare (e.g., ['cosine', 'euclidean']).
+        tags_column
+            Name of the column containing the tag dictionaries used for diversity.
+            Relevance always uses '(tag, weight)', like the serial functions.
+        popularity_column
+            Name of the popularity column (needed for beyond-accuracy metrics).
+        n_workers
+            Number of worker processes (defaults to the number of CPUs).
+        shard_size
+            Number of queries per task.
+        tag_index
+            Optional prebuilt relevance TagIndex ('(tag, weight)') for `dataset`.
+        feature_matrix
+            Optional feature matrix aligned with `dataset` (e.g., sparse TF-IDF), used
+            instead of the feature columns.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        feature_columns,
+        metrics,
+        tags_column="(tag, weight)",
+        popularity_column=None,
+        n_workers=None,
+        shard_size=64,
+        tag_index=None,
+        feature_matrix=None,
+    ):
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.shard_size = shard_size
+        self.n_songs = len(dataset)
+        self._shared = []
+
+        tag_index = tag_index or TagIndex.from_dataset(dataset)
+        if tags_column == "(tag, weight)":
+            diversity_weights = tag_index.weights
+        else:
+            diversity_weights = TagIndex.from_dataset(dataset, tags_column).weights
+        context = {
+            "ids": dataset["id"].values,
+            "tag_index": tag_index,
+            "diversity_weights": diversity_weights,
+            "instrumented": instrumentation.is_enabled(),
+        }
+        if popularity_column is not None:
+            context["popularity"] = dataset[popularity_column].values.astype(np.float64)
+
+        # Segments created before a failure (including Pool start-up) must not outlive it
+        try:
+            prepared_specs = {}
+            if feature_columns is not None:
+                if feature_matrix is None:
+                    feature_matrix = dataset[feature_columns].values
+                for metric in metrics:
+                    if metric == "random":
+                        continue
+                    prepared = prepare_feature_matrix(feature_matrix, metric)
+                    prepared_specs[metric] = (
+                        share_matrix(prepared["matrix"], self._shared),
+                        share_matrix(prepared["squared_norms"], self._shared),
+                    )
+            context["prepared_specs"] = prepared_specs
+            self._pool = Pool(self.n_workers, initializer=_init_worker, initargs=(context,))
+        except BaseException:
+            self._release()
+            raise
+
+    def _release(self):
+        for shared in self._shared:
+            shared.release()
+        self._shared = []
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def evaluate(self, query_indices, metric, N=10, accuracy=True, weight_threshold=None, progress=None):
+        """
+        Evaluate all queries for one metric.
+
+        Args
+        ----
+            query_indices
+                Positions of the query songs in the dataset.
+            metric
+                Similarity metric ('cosine', 'euclidean') or 'random'.
+            N
+                Number of top results to retrieve.
+            accuracy
+                Compute Precision@N, Recall@N, NDCG@N and MRR.
+            weight_threshold
+                If not None, compute Div@N and AvgPop@N with this tag weight threshold.
+            progress
+                Optional Progress instance to update.
+
+        Returns
+        -------
+            list
+                Per-query result dicts, in the order of `query_indices`.
+        """
+        query_rows = np.asarray(query_indices, dtype=np.int64)
+        tasks = [
+            (shard_id, metric, query_rows[start : start + self.shard_size], N, accuracy, weight_threshold)
+            for shard_id, start in enumerate(range(0, len(query_rows), self.shard_size))
+        ]
+        shards = [None] * len(tasks)
+        for shard_id, rows, recording in self._pool.imap_unordered(_evaluate_shard, tasks):
+            shards[shard_id] = rows
+            if recording is not None:
+                instrumentation.merge_recording(recording)
+            if progress is not None:
+                progress.update(len(rows))
+        return [row for rows in shards for row in rows]
+
+
+def _average(rows, keys):
+    """Sum per-query values in query order, then divide, exactly as the serial loops do."""
+    totals = {key: 0 for key in keys}
+    for row in rows:
+        for key in keys:
+            totals[key] += row[key]
+    return {key: totals[key] / len(rows) for key in keys}
+
+
+def run_evaluations_parallel(
+    query_indices,
+    dataset,
+    feature_columns,
+    similarity_metrics,
+    N=10,
+    n_workers=None,
+    shard_size=64,
+    progress_callback=None,
+    feature_matrix=None,
+):
+    """
+    Parallel version of `run_evaluations` with the same arguments and results.
+
+    Args
+    ----
+        n_workers
+            Number of worker processes (defaults to the number of CPUs).
+        shard_size
+            Number of queries per task.
+        progress_callback
+            Optional callback(done, total, rate, eta) replacing the printed progress line.
+        feature_matrix
+            Optional feature matrix aligned with `dataset` (e.g., sparse TF-IDF), used
+            instead of the feature columns.
+
+    Returns
+    -------
+        dict
+            Average evaluation metrics for each similarity metric.
+    """
+    results = {}
+    with ShardedEvaluator(
+        dataset,
+        feature_columns,
+        similarity_metrics,
+        n_workers=n_workers,
+        shard_size=shard_size,
+        feature_matrix=feature_matrix,
+    ) as evaluator:
+        for metric in similarity_metrics:
+            progress = Progress(len(query_indices), f"Evaluating {metric}", progress_callback)
+            rows = evaluator.evaluate(query_indices, metric, N=N, progress=progress)
+            results[metric] = _average(rows, ACCURACY_KEYS)
+    return results
+
+
+def evaluate_tradeoffs_parallel(
+    query_indices,
+    datasets,
+    systems,
+    beyond_metrics,
+    beyond_tags_column,
+    beyond_popularity_column,
+    N=10,
+    weight_threshold=60,
+    n_workers=None,
+    shard_size=64,
+    progress_callback=None,
+    feature_matrices=None,
+):
+    """
+    Parallel version of `evaluate_tradeoffs` with the same arguments and results.
+
+    Accuracy and beyond-accuracy metrics are computed from a single retrieval per query.
+
+    Args
+    ----
+        weight_threshold
+            Minimum tag weight used for Div@N.
+        n_workers
+            Number of worker processes (defaults to the number of CPUs).
+        shard_size
+            Number of queries per task.
+        progress_callback
+            Optional callback(done, total, rate, eta) replacing the printed progress line.
+        feature_matrices
+            Optional mapping of system name -> feature matrix aligned with its dataset.
+
+    Returns
+    -------
+        pandas.DataFrame
+            Trade-off results showing NDCG, Diversity, and Popularity for each system and metric.
+    """
+    results = []
+
+    for system_name, feature_columns in systems.items():
+        dataset = datasets[system_name]
+        metrics = ["random"] if feature_columns is None else beyond_metrics
+
+        with ShardedEvaluator(
+            dataset,
+            feature_columns,
+            metrics,
+            tags_column=beyond_tags_column,
+            popularity_column=beyond_popularity_column,
+            n_workers=n_workers,
+            shard_size=shard_size,
+            feature_matrix=(feature_matrices or {}).get(system_name),
+        ) as evaluator:
+            for metric in metrics:
+                progress = Progress(len(query_indices), f"{system_name} ({metric})", progress_callback)
+                rows = evaluator.evaluate(
+                    query_indices, metric, N=N, weight_threshold=weight_threshold, progress=progress
+                )
+                scores = _average(rows, ACCURACY_KEYS + ("Div@N", "AvgPop@N"))
+                results.append(
+                    {
+                        "System": system_name,
+                        "Metric": metric,
+                        "Precision@N": scores["Precision@N"],
+                        "Recall@N": scores["Recall@N"],
+                        "NDCG@N": scores["NDCG@N"],
+                        "Div@N": scores["Div@N"],
+                        "AvgPop@N": scores["AvgPop@N"],
+                    }
+                )
+
+    return pd.DataFrame(results)
@@ -0,0 +1,326 @@
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from scripts.embedding_store import DEFAULT_STORE_DIR, load_feature_space
+from scripts.metric_kernels import batch_metrics, batch_relevance
+from scripts.retrieval_by_similarity import prepare_feature_matrix, top_k_by_similarity
+
+
+PRECISIONS = ("float32", "float16", "int8")
+# scipy.sparse has no float16 matrices
+SPARSE_PRECISIONS = ("float32", "int8")
+
+
+def _nbytes(matrix):
+    if sparse.issparse(matrix):
+        return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+    return matrix.nbytes
+
+
+class QuantizedMatrix:
+    """
+    A prepared feature matrix stored in reduced precision and scored without ever
+    materialising it in full precision.
+
+    'float16' keeps the values as half floats. 'int8' stores every dimension d as
+    x ~= scale[d] * q + offset[d] with q in [-128, 127] (per-dimension min/max
+    quantisation), so the dot product of a query v with a song is
+    (v * scale) . q + v . offset. Songs are converted to float32 `song_chunk` rows at
+    a time, so the extra memory while scoring is bounded.
+
+    Sparse (CSR) matrices such as TF-IDF stay sparse: only the stored values are
+    quantised and `indices`/`indptr` are kept. Their int8 quantisation is symmetric
+    (x ~= scale[d] * q, no offset) so that zeros stay zeros; float16 is not available
+    for them (see SPARSE_PRECISIONS).
+
+    Args
+    ----
+        metric
+            Similarity metric the matrix was prepared for ('cosine', 'euclidean').
+        precision
+            'float32', 'float16' or 'int8'.
+        data
+            (n_songs x dim) stored values (array or CSR matrix).
+        scale, offset
+            Per-dimension int8 parameters (None otherwise; offset is None for CSR).
+        squared_norms
+            float32 squared norms of the full-precision rows (for 'euclidean').
+    """
+
+    def __init__(self, metric, precision, data, scale=None, offset=None, squared_norms=None, song_chunk=16384):
+        self.metric = metric
+        self.precision = precision
+        self.data = data
+        self.scale = scale
+        self.offset = offset
+        self.squared_norms = squared_norms
+        self.song_chunk = song_chunk
+
+    @classmethod
+    def from_matrix(cls, feature_matrix, metric="cosine", precision="int8"):
+        """Prepare (normalise for cosine) a feature matrix and quantise it."""
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unsupported precision. Use one of {', '.join(PRECISIONS)}.")
+        if sparse.issparse(feature_matrix) and precision not in SPARSE_PRECISIONS:
+            raise ValueError(f"Sparse matrices support {', '.join(SPARSE_PRECISIONS)} only, not {precision}.")
+        prepared = prepare_feature_matrix(feature_matrix, metric, dtype=np.float32)
+        matrix = prepared["matrix"]
+        squared_norms = prepared["squared_norms"].astype(np.float32)
+
+        if precision != "int8":
+            return cls(metric, precision, matrix.astype(precision), squared_norms=squared_norms)
+
+        if sparse.issparse(matrix):
+            scale = abs(matrix).max(axis=0).toarray().ravel() / 127
+            scale[scale == 0] = 1
+            data = matrix.copy()
+            data.data = np.clip(np.round(data.data / scale[data.indices]), -127, 127)
+            return cls(metric, precision, data.astype(np.int8), scale.astype(np.float32), None, squared_norms)
+
+        low = matrix.min(axis=0)
+        high = matrix.max(axis=0)
+        scale = (high - low) / 255
+        scale[scale == 0] = 1
+        offset = low + 128 * scale
+        data = np.clip(np.round((matrix - offset) / scale), -128, 127).astype(np.int8)
+        return cls(metric, precision, data, scale.astype(np.float32), offset.astype(np.float32), squared_norms)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def nbytes(self):
+        extra = sum(a.nbytes for a in (self.scale, self.offset, self.squared_norms) if a is not None)
+        return _nbytes(self.data) + extra
+
+    def _rows_float32(self, rows):
+        values = self.data[rows]
+        return values.toarray().astype(np.float32) if sparse.issparse(values) else np.asarray(values, dtype=np.float32)
+
+    def dequantize(self, rows):
+        """Approximate float32 vectors of the given rows."""
+        values = self._rows_float32(rows)
+        if self.scale is not None:
+            values *= self.scale
+        if self.offset is not None:
+            values += self.offset
+        return values
+
+    def score_block(self, query_rows=None, query_vectors=None):
+        """
+        Similarity of a block of queries (rows of the quantised matrix or raw vectors)
+        to all songs, as `_score_block` computes it, in float32.
+        """
+        if query_vectors is None:
+            queries = self.dequantize(query_rows)
+            query_squared_norms = self.squared_norms[query_rows]
+        else:
+            queries = np.asarray(query_vectors, dtype=np.float32)
+            query_squared_norms = np.einsum("ij,ij->i", queries, queries)
+            if self.metric == "cosine":
+                norms = np.sqrt(query_squared_norms)
+                norms[norms == 0] = 1
+                queries = queries / norms[:, None]
+
+        # Fold the per-dimension scales into the queries and the offsets into a constant
+        projected = (queries * self.scale).T if self.scale is not None else queries.T
+        constant = queries @ self.offset if self.offset is not None else None
+
+        n_songs = self.data.shape[0]
+        scores = np.empty((len(queries), n_songs), dtype=np.float32)
+        for start in range(0, n_songs, self.song_chunk):
+            block = self.data[start : start + self.song_chunk]
+            if sparse.issparse(block):
+                block = block.astype(np.float32)
+            else:
+                block = np.asarray(block, dtype=np.float32)
+            scores[:, start : start + block.shape[0]] = (block @ projected).T
+        if constant is not None:
+            scores += constant[:, None]
+
+        if self.metric == "euclidean":
+            scores *= -2
+            scores += query_squared_norms[:, None]
+            scores += self.squared_norms[None, :]
+            np.maximum(scores, 0, out=scores)
+            np.sqrt(scores, out=scores)
+            scores += 1
+            np.reciprocal(scores, out=scores)
+        return scores
+
+    def prepared(self):
+        """The `prepared` dict consumed by `top_k_by_similarity`."""
+        return {"metric": self.metric, "matrix": self.data, "squared_norms": self.squared_norms, "quantized": self}
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        is_sparse = sparse.issparse(self.data)
+        if is_sparse:
+            sparse.save_npz(os.path.join(path, "data.npz"), self.data, compressed=False)
+        else:
+            np.save(os.path.join(path, "data.npy"), self.data)
+        np.save(os.path.join(path, "squared_norms.npy"), self.squared_norms)
+        if self.scale is not None:
+            np.save(os.path.join(path, "scale.npy"), self.scale)
+        if self.offset is not None:
+            np.save(os.path.join(path, "offset.npy"), self.offset)
+        manifest = {
+            "metric": self.metric,
+            "precision": self.precision,
+            "format": "csr" if is_sparse else "dense",
+            "shape": list(self.shape),
+        }
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=4)
+
+    @classmethod
+    def load(cls, path):
+        """Load a saved matrix; dense values are memory-mapped read-only."""
+        with open(os.path.join(path, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+        if manifest.get("format") == "csr":
+            data = sparse.load_npz(os.path.join(path, "data.npz")).tocsr()
+        else:
+            data = np.load(os.path.join(path, "data.npy"), mmap_mode="r")
+        squared_norms = np.load(os.path.join(path, "squared_norms.npy"))
+        scale_path = os.path.join(path, "scale.npy")
+        offset_path = os.path.join(path, "offset.npy")
+        scale = np.load(scale_path) if os.path.exists(scale_path) else None
+        offset = np.load(offset_path) if os.path.exists(offset_path) else None
+        return cls(manifest["metric"], manifest["precision"], data, scale, offset, squared_norms)
+
+
+def quantized_path(feature_space, metric, precision, store_dir=DEFAULT_STORE_DIR):
+    return os.path.join(store_dir, feature_space, f"quantized_{precision}_{metric}")
+
+
+def quantize_feature_space(feature_space, metric="cosine", precision="int8", store_dir=DEFAULT_STORE_DIR):
+    """Quantise a feature space of the embedding store and save it next to it."""
+    matrix = load_feature_space(feature_space, store_dir).matrix
+    quantized = QuantizedMatrix.from_matrix(matrix, metric, precision)
+    quantized.save(quantized_path(feature_space, metric, precision, store_dir))
+    return quantized
+
+
+def quantization_report(
+    feature_matrix, tag_index, ids, metric="cosine", precisions=PRECISIONS, N=10, K=100, query_rows=None, n_queries=500, seed=42
+):
+    """
+    Drift of quantised retrieval against full precision (float64), to choose the
+    cheapest acceptable precision of a feature space.
+
+    Args
+    ----
+        feature_matrix
+            (n_songs x dim) feature embeddings (array or CSR matrix).
+        tag_index
+            TagIndex of the same songs, for NDCG.
+        ids
+            Song ids in the row order of `feature_matrix`.
+        metric
+            Similarity metric ('cosine', 'euclidean').
+        precisions
+            Precisions to compare (see PRECISIONS).
+        N
+            Cut-off for NDCG@N.
+        K
+            Cut-off for Overlap@K (share of the full-precision top K retrieved).
+        query_rows
+            Rows used as queries; defaults to `n_queries` random rows.
+        n_queries
+            Number of sampled queries when `query_rows` is not given.
+        seed
+            Seed for sampling the queries.
+
+    Returns
+    -------
+        pandas.DataFrame
+            One row per precision (plus the float64 reference) with memory, latency per
+            query, NDCG@N, its drift from float64, Overlap@N and Overlap@K.
+    """
+    ids = np.asarray(ids)
+    if query_rows is None:
+        rng = np.random.default_rng(seed)
+        query_rows = np.sort(rng.choice(len(ids), min(n_queries, len(ids)), replace=False))
+    K = max(K, N)
+
+    def run(prepared):
+        start = time.perf_counter()
+        indices, _ = top_k_by_similarity(query_rows, metric=metric, k=K, prepared=prepared)
+        return indices, (time.perf_counter() - start) / len(query_rows) * 1000
+
+    reference = prepare_feature_matrix(feature_matrix, metric)
+    runs = [("float64", _nbytes(reference["matrix"]) + reference["squared_norms"].nbytes, *run(reference))]
+    for precision in precisions:
+        if sparse.issparse(feature_matrix) and precision not in SPARSE_PRECISIONS:
+            print(f"Skipping {precision}: not available for sparse matrices.")
+            continue
+        quantized = QuantizedMatrix.from_matrix(feature_matrix, metric, precision)
+        runs.append((precision, quantized.nbytes, *run(quantized.prepared())))
+
+    exact_indices = runs[0][2]
+    rows = []
+    for precision, nbytes, indices, latency_ms in runs:
+        grades, n_relevant = batch_relevance(tag_index, ids[query_rows], ids[indices[:, :N]])
+        ndcg = float(np.mean(batch_metrics(grades, n_relevant, k=N)["NDCG@N"]))
+        overlap = {
+            cut: np.mean([len(np.intersect1d(a[:cut], b[:cut])) / cut for a, b in zip(indices, exact_indices)])
+            for cut in (N, K)
+        }
+        rows.append(
+            {
+                "precision": precision,
+                "memory_mb": nbytes / 2**20,
+                "latency_ms": latency_ms,
+                "NDCG@N": ndcg,
+                f"Overlap@{N}": overlap[N],
+                f"Overlap@{K}": overlap[K],
+            }
+        )
+    report = pd.DataFrame(rows)
+    report["NDCG drift"] = report["NDCG@N"] - report["NDCG@N"].iloc[0]
+    return report
+
+
+def choose_precision(report, max_ndcg_drop=0.005, min_overlap=0.9, overlap_column=None):
+    """
+    Cheapest precision of a `quantization_report` whose NDCG@N dropped by at most
+    `max_ndcg_drop` and whose overlap with full precision is at least `min_overlap`.
+    """
+    overlap_column = overlap_column or [c for c in report.columns if c.startswith("Overlap@")][-1]
+    acceptable = report[(report["NDCG drift"] >= -max_ndcg_drop) & (report[overlap_column] >= min_overlap)]
+    return acceptable.sort_values("memory_mb").iloc[0]["precision"]
+
+
+def quantization_report_store(
+    feature_spaces, tag_index, metric="cosine", store_dir=DEFAULT_STORE_DIR, max_ndcg_drop=0.005, min_overlap=0.9, **kwargs
+):
+    """
+    Run `quantization_report` for several feature spaces of the embedding store.
+
+    Songs missing from `tag_index` are left out of the queries and candidates.
+
+    Returns
+    -------
+        pandas.DataFrame
+            The reports of all feature spaces with a 'System' column and a 'chosen'
+            flag marking the cheapest acceptable precision of each.
+    """
+    reports = []
+    for name in feature_spaces:
+        feature_space = load_feature_space(name, store_dir)
+        known = np.flatnonzero(pd.Index(tag_index.ids).get_indexer(feature_space.ids) >= 0)
+        matrix = feature_space.matrix[known]
+        if not sparse.issparse(matrix):
+            matrix = np.asarray(matrix)
+        report = quantization_report(matrix, tag_index, feature_space.ids[known], metric, **kwargs)
+        report.insert(0, "System", name)
+        report["chosen"] = report["precision"] == choose_precision(report, max_ndcg_drop, min_overlap)
+        reports.append(report)
+    return pd.concat(reports, ignore_index=True)
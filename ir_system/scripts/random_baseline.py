@@ -1,10 +1,94 @@
-import random
+import numpy as np
 import pandas as pd
 
+
+def _splitmix64(values):
+    """SplitMix64 finaliser: a well-mixed uint64 hash of each value."""
+    with np.errstate(over="ignore"):
+        z = values + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def random_baseline_rows(query_rows, n_songs, N=10, seed=42):
+    """
+    Random top N of many queries at once, in O(Q * N).
+
+    Every draw is a counter-based hash of (seed, query row, position, attempt), so the
+    list of a query depends only on the seed and its row: the same in any batch, shard
+    or order, and equal to what `random_baseline` returns for that query. Self-matches
+    are excluded by construction and duplicates within a list are redrawn.
+
+    Args
+    ----
+        query_rows
+            Rows (positions in the dataset) of the query songs; -1 for a query that is
+            not in the dataset (nothing to exclude).
+        n_songs
+            Number of songs in the dataset.
+        N
+            Number of songs per query.
+        seed
+            Random seed.
+
+    Returns
+    -------
+        tuple
+            (indices, scores): (Q x N) rows of the random songs and rank-derived scores
+            (-rank), the format of `top_k_by_similarity`.
+    """
+    query_rows = np.asarray(query_rows, dtype=np.int64).reshape(-1)
+    excluded = query_rows >= 0
+    n_candidates = n_songs - excluded.astype(np.int64)
+    if np.any(n_candidates < N):
+        raise ValueError(f"Cannot draw {N} distinct songs from {n_songs} songs.")
+
+    keys = _splitmix64(_splitmix64(np.uint64(seed)) ^ query_rows.astype(np.uint64))
+    indices = np.zeros((len(query_rows), N), dtype=np.int64)
+    attempt = np.zeros((len(query_rows), N), dtype=np.uint64)
+    pending = np.ones((len(query_rows), N), dtype=bool)
+    positions = np.arange(N, dtype=np.uint64)[None, :]
+
+    # Only the lists that still hold duplicates are redrawn after the first pass
+    active = np.arange(len(query_rows))
+    while len(active):
+        draws = _splitmix64(keys[active, None] ^ _splitmix64(positions + attempt[active] * np.uint64(N)))
+        draws = (draws % n_candidates[active, None].astype(np.uint64)).astype(np.int64)
+        # Skip over the query's own row
+        draws += excluded[active, None] & (draws >= query_rows[active, None])
+        block = np.where(pending[active], draws, indices[active])
+        indices[active] = block
+
+        # A position is pending again if its song already appears earlier in the list
+        order = np.argsort(block, axis=1, kind="stable")
+        sorted_block = np.take_along_axis(block, order, axis=1)
+        repeated_sorted = np.zeros(block.shape, dtype=bool)
+        repeated_sorted[:, 1:] = sorted_block[:, 1:] == sorted_block[:, :-1]
+        repeated = np.zeros(block.shape, dtype=bool)
+        np.put_along_axis(repeated, order, repeated_sorted, axis=1)
+        pending[active] = repeated
+        attempt[active] += repeated.astype(np.uint64)
+        active = active[repeated.any(axis=1)]
+
+    scores = np.broadcast_to(-np.arange(N, dtype=np.float64), indices.shape).copy()
+    return indices, scores
+
+
+def random_baseline_ids(query_ids, ids, N=10, seed=42):
+    """(ids, scores) of the random top N of the given query ids, like `retrieve_top_k_ids`."""
+    ids = np.asarray(ids)
+    query_rows = pd.Index(ids).get_indexer(list(query_ids))
+    indices, scores = random_baseline_rows(query_rows, len(ids), N, seed)
+    return ids[indices], scores
+
+
 def random_baseline(query_song, dataset, random_state: int = 42, N=10):
     """
     Generate a random list of N songs excluding the query song.
     Internally keep 'id', but exclude it in the output display.
     """
-    filtered_dataset = dataset[dataset['id'] != query_song['id']].sample(frac=1, random_state=random_state)
-    return filtered_dataset.head(N)
\ No newline at end of file
+    query_rows = np.flatnonzero((dataset['id'] == query_song['id']).values)
+    query_row = query_rows[0] if len(query_rows) else -1
+    indices, _ = random_baseline_rows([query_row], len(dataset), N, seed=random_state)
+    return dataset.iloc[indices[0]]
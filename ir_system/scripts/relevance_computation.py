@@ -1,3 +1,11 @@
+from collections import OrderedDict
+
+import numpy as np
+from scipy import sparse
+
+from scripts.instrumentation import timed
+
+
 def compute_weighted_jaccard(query_tags, candidate_tags):
         """
         Compute the Weighted Jaccard Similarity between two tag-weight dictionaries.
@@ -17,4 +25,218 @@ def compute_weighted_jaccard(query_tags, candidate_tags):
         intersection = sum(min(query_tags.get(tag, 0), candidate_tags.get(tag, 0)) for tag in set(query_tags.keys()) & set(candidate_tags.keys()))
         union = sum(max(query_tags.get(tag, 0), candidate_tags.get(tag, 0)) for tag in set(query_tags.keys()) | set(candidate_tags.keys()))
 
-        return intersection / union if union > 0 else 0
\ No newline at end of file
+        return intersection / union if union > 0 else 0
+
+
+class TagIndex:
+    """
+    Sparse song x tag weight matrix with an inverted index for Weighted Jaccard relevance.
+
+    Relevance of a query is only computed against candidates that share at least one
+    tag with it (the union of the query tags' postings), which gives the same relevant
+    songs and scores as calling `compute_weighted_jaccard` against every song.
+
+    Attributes
+    ----------
+        ids: numpy.ndarray
+            Song ids in row order (the order of the dataset the index was built from).
+        tags: list
+            Tag names in column order.
+        weights: scipy.sparse.csr_matrix
+            (n_songs x n_tags) tag weights.
+        postings: scipy.sparse.csc_matrix
+            Same weights in column-major form; column j lists the songs tagged with tag j.
+        cache_size: int or None
+            Number of query songs whose relevance `relevance_for_id` keeps, least recently
+            used first out. 0 disables the cache, None keeps every query (O(N^2) memory
+            over a full evaluation).
+    """
+
+    DEFAULT_CACHE_SIZE = 1024
+
+    def __init__(self, ids, tags, weights, cache_size=DEFAULT_CACHE_SIZE):
+        self.ids = np.asarray(ids)
+        self.tags = list(tags)
+        self.tag_to_column = {tag: column for column, tag in enumerate(self.tags)}
+        self.id_to_row = {song_id: row for row, song_id in enumerate(self.ids)}
+        self.weights = weights.tocsr()
+        self.postings = self.weights.tocsc()
+        self.row_sums = np.asarray(self.weights.sum(axis=1)).ravel()
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def __getstate__(self):
+        # Cached relevance is per-process working memory, not part of the index
+        state = self.__dict__.copy()
+        state["_cache"] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault("cache_size", self.DEFAULT_CACHE_SIZE)
+        state["_cache"] = OrderedDict()
+        self.__dict__.update(state)
+
+    @classmethod
+    @timed()
+    def from_dataset(cls, dataset, tags_column="(tag, weight)", cache_size=DEFAULT_CACHE_SIZE):
+        """
+        Build the index from a dataset with parsed tag dictionaries.
+
+        Args
+        ----
+            dataset
+                DataFrame with an 'id' column and a column of {tag: weight} dictionaries.
+            tags_column
+                Name of the tags column.
+            cache_size
+                Number of queries `relevance_for_id` keeps (see the class attributes).
+
+        Returns
+        -------
+            TagIndex
+        """
+        tag_to_column = {}
+        indptr = [0]
+        indices = []
+        data = []
+        for tags_dict in dataset[tags_column]:
+            for tag, weight in tags_dict.items():
+                indices.append(tag_to_column.setdefault(tag, len(tag_to_column)))
+                data.append(weight)
+            indptr.append(len(indices))
+
+        weights = sparse.csr_matrix(
+            (np.asarray(data, dtype=np.float64), np.asarray(indices, dtype=np.int64), np.asarray(indptr, dtype=np.int64)),
+            shape=(len(indptr) - 1, len(tag_to_column)),
+        )
+        return cls(dataset["id"].values, tag_to_column.keys(), weights, cache_size)
+
+    def rows_for_ids(self, song_ids):
+        """Rows of the given song ids as an int64 array."""
+        return np.fromiter((self.id_to_row[song_id] for song_id in song_ids), dtype=np.int64, count=len(song_ids))
+
+    def _query_vector(self, query_tags):
+        """Dense query weights over the index's tags; tags unknown to the index only add to the union."""
+        query = np.zeros(len(self.tags))
+        extra_weight = 0.0
+        for tag, weight in query_tags.items():
+            column = self.tag_to_column.get(tag)
+            if column is None:
+                extra_weight += weight
+            else:
+                query[column] = weight
+        return query, extra_weight
+
+    @timed()
+    def relevance_for_tags(self, query_tags):
+        """
+        Weighted Jaccard relevance of every song to a tag dictionary.
+
+        Args
+        ----
+            query_tags
+                Dictionary of tags and weights for the query song.
+
+        Returns
+        -------
+            tuple
+                (rows, scores): rows of the songs with a non-zero score, in dataset
+                order, and their Weighted Jaccard scores.
+        """
+        query, extra_weight = self._query_vector(query_tags)
+        query_columns = np.flatnonzero(query)
+        if len(query_columns) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        # Candidates: union of the postings of the query's tags
+        postings = self.postings
+        candidates = np.unique(
+            np.concatenate([postings.indices[postings.indptr[c] : postings.indptr[c + 1]] for c in query_columns])
+        )
+
+        candidate_weights = self.weights[candidates]
+        minimums = np.minimum(candidate_weights.data, query[candidate_weights.indices])
+        owner = np.repeat(np.arange(len(candidates)), np.diff(candidate_weights.indptr))
+        intersection = np.bincount(owner, weights=minimums, minlength=len(candidates))
+
+        # sum(max) over the union = sum(query) + sum(candidate) - sum(min)
+        union = query.sum() + extra_weight + self.row_sums[candidates] - intersection
+        scores = np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+        relevant = scores > 0
+        return candidates[relevant], scores[relevant]
+
+    def relevance_for_id(self, song_id):
+        """
+        Cached Weighted Jaccard relevance of every song to an indexed query song.
+
+        At most `cache_size` queries are kept; the least recently used one is evicted.
+
+        Returns
+        -------
+            tuple
+                (relevant_ids, scores), in dataset order.
+        """
+        if song_id in self._cache:
+            self._cache.move_to_end(song_id)
+            return self._cache[song_id]
+        row = self.id_to_row[song_id]
+        start, end = self.weights.indptr[row], self.weights.indptr[row + 1]
+        query_tags = dict(zip((self.tags[c] for c in self.weights.indices[start:end]), self.weights.data[start:end]))
+        rows, scores = self.relevance_for_tags(query_tags)
+        result = (self.ids[rows], scores)
+        if self.cache_size != 0:
+            self._cache[song_id] = result
+            if self.cache_size is not None:
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return result
+
+    @timed()
+    def pairwise_relevance(self, query_rows, candidate_rows):
+        """
+        Weighted Jaccard of aligned (query, candidate) row pairs, vectorised.
+
+        Uses sum(min(a, b)) = (sum(a) + sum(b) - sum(|a - b|)) / 2 on the sparse rows.
+
+        Args
+        ----
+            query_rows
+                Rows of the query songs.
+            candidate_rows
+                Rows of the candidate songs, same length as `query_rows`.
+
+        Returns
+        -------
+            numpy.ndarray
+                Weighted Jaccard score of every pair.
+        """
+        query_rows = np.asarray(query_rows, dtype=np.int64)
+        candidate_rows = np.asarray(candidate_rows, dtype=np.int64)
+        absolute_difference = abs(self.weights[query_rows] - self.weights[candidate_rows])
+        query_sums = self.row_sums[query_rows]
+        candidate_sums = self.row_sums[candidate_rows]
+        intersection = (query_sums + candidate_sums - np.asarray(absolute_difference.sum(axis=1)).ravel()) / 2
+        union = query_sums + candidate_sums - intersection
+        return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+    @timed()
+    def relevant_songs(self, query_song, tags_column="(tag, weight)"):
+        """
+        Relevant song ids and scores for a query row, as `evaluate_metrics` defines them.
+
+        Returns
+        -------
+            tuple
+                (relevant_ids, relevance_scores): list of ids and dict of id -> score.
+        """
+        if query_song["id"] in self.id_to_row:
+            relevant_ids, scores = self.relevance_for_id(query_song["id"])
+        else:
+            rows, scores = self.relevance_for_tags(query_song[tags_column])
+            relevant_ids = self.ids[rows]
+        relevant_ids = relevant_ids.tolist()
+        return relevant_ids, dict(zip(relevant_ids, scores.tolist()))
+
+    def clear_cache(self):
+        self._cache.clear()
@@ -0,0 +1,323 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import zipfile
+
+import numpy as np
+
+from scripts.metric_kernels import evaluate_retrieved
+from scripts.retrieval_by_similarity import prepare_feature_matrix, top_k_by_similarity
+
+
+DEFAULT_CACHE_DIR = "../dataset/cache"
+INDEX_FILE = "index.json"
+RUN_FILE = "run.json"
+
+
+def array_digest(array, hasher=None, chunk_rows=4096):
+    """
+    SHA-256 of an array's dtype, shape and contents.
+
+    Large (e.g., memory-mapped) matrices are hashed in row chunks.
+    """
+    hasher = hasher or hashlib.sha256()
+    array = np.asarray(array)
+    hasher.update(f"{array.dtype.str}{array.shape}".encode())
+    if array.dtype.kind in "OU":
+        for value in array.ravel():
+            hasher.update(str(value).encode())
+            hasher.update(b"\0")
+    elif array.ndim > 1 and array.shape[0] > chunk_rows:
+        for start in range(0, array.shape[0], chunk_rows):
+            hasher.update(np.ascontiguousarray(array[start : start + chunk_rows]).tobytes())
+    else:
+        hasher.update(np.ascontiguousarray(array).tobytes())
+    return hasher.hexdigest()
+
+
+def embedding_digest(ids, feature_matrix):
+    """Digest of a feature space: song ids and their vectors."""
+    hasher = hashlib.sha256()
+    array_digest(ids, hasher)
+    return array_digest(feature_matrix, hasher)
+
+
+def relevance_digest(tag_index):
+    """Digest of the relevance inputs: song ids, tag names and tag weights."""
+    hasher = hashlib.sha256()
+    array_digest(tag_index.ids, hasher)
+    array_digest(np.asarray(tag_index.tags, dtype=str), hasher)
+    weights = tag_index.weights
+    for part in (weights.indptr, weights.indices, weights.data):
+        array_digest(part, hasher)
+    return hasher.hexdigest()
+
+
+def _params_digest(params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _tmp_path(path):
+    """Temporary name next to `path`, unique per process and thread sharing the cache."""
+    return f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+
+
+def _write_json(path, data):
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=4, default=str)
+    os.replace(tmp_path, path)
+
+
+class ResultCache:
+    """
+    Content-addressed, block-wise cache of per-query results.
+
+    A run is keyed on the SHA-256 of its parameters and of the digests of its inputs
+    (embeddings, relevance data), so any change to the data gives a new key instead of
+    silently reusing stale results. Within a run, results are stored per query block as
+    soon as the block is computed: an interrupted run resumes with the blocks already on
+    disk, and asking for new queries only computes those. Runs are evicted least recently
+    used first when `max_bytes` or `max_entries` is exceeded.
+
+    Several processes may share a cache directory: files are written under unique
+    temporary names and renamed into place, and index updates are merged into the
+    index on disk rather than overwriting it.
+
+    Args
+    ----
+        cache_dir
+            Root directory of the cache.
+        max_bytes
+            Maximum total size of the cache in bytes (None for no limit).
+        max_entries
+            Maximum number of cached runs (None for no limit).
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=None, max_entries=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # Index of runs: run key -> {"last_access": float, "bytes": int}
+    def _read_index(self):
+        path = os.path.join(self.cache_dir, INDEX_FILE)
+        index = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                index = json.load(f)
+        # Runs whose index entry was lost to a concurrent update are picked up from disk
+        for key in os.listdir(self.cache_dir):
+            run_file = os.path.join(self._run_dir(key), RUN_FILE)
+            if key not in index and os.path.exists(run_file):
+                index[key] = {"last_access": os.path.getmtime(run_file), "bytes": self._run_bytes(key)}
+        return index
+
+    def _update_index(self, entries=None, removed=()):
+        """
+        Apply changes to the index as it is on disk now and write it atomically.
+
+        Only the given entries are set or removed, so the updates of other processes
+        written since this one last read the index are kept.
+        """
+        index = self._read_index()
+        index.update(entries or {})
+        for key in removed:
+            index.pop(key, None)
+        _write_json(os.path.join(self.cache_dir, INDEX_FILE), index)
+        return index
+
+    def run_key(self, params, input_digests):
+        """Key of a run from its parameters and input digests."""
+        return _params_digest({"params": params, "inputs": input_digests})
+
+    def _run_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _load_blocks(self, key):
+        """All cached per-query rows of a run: query id -> {field: value}."""
+        rows = {}
+        run_dir = self._run_dir(key)
+        if not os.path.isdir(run_dir):
+            return rows
+        for filename in sorted(os.listdir(run_dir)):
+            if not filename.endswith(".npz") or ".tmp" in filename:
+                continue
+            try:
+                with np.load(os.path.join(run_dir, filename)) as block:
+                    fields = {name: block[name] for name in block.files}
+                query_ids = fields.pop("query_ids")
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+                # Unreadable block (e.g., truncated by an interrupted run); its queries are recomputed
+                continue
+            for i, query_id in enumerate(query_ids):
+                rows[query_id] = {name: values[i] for name, values in fields.items()}
+        return rows
+
+    def _save_block(self, key, query_ids, fields):
+        run_dir = self._run_dir(key)
+        os.makedirs(run_dir, exist_ok=True)
+        block_name = array_digest(np.asarray(query_ids, dtype=str))[:16]
+        path = os.path.join(run_dir, f"{block_name}.npz")
+        # Written through a handle so numpy does not append '.npz' to the temporary name
+        tmp_path = _tmp_path(path)
+        with open(tmp_path, "wb") as f:
+            np.savez(f, query_ids=np.asarray(query_ids, dtype=str), **fields)
+        os.replace(tmp_path, path)
+
+    def get_or_compute(self, params, input_digests, query_ids, compute_block, block_size=1024):
+        """
+        Return per-query results, computing only the queries not cached yet.
+
+        Args
+        ----
+            params
+                JSON-serialisable run parameters (feature space, metric, N, ...).
+            input_digests
+                Dict of digests of the run inputs (see `embedding_digest`, `relevance_digest`).
+            query_ids
+                Ids of the queries to return.
+            compute_block
+                Function taking a list of query ids and returning a dict of arrays whose
+                first dimension is the number of queries.
+            block_size
+                Number of queries computed and stored per block.
+
+        Returns
+        -------
+            dict
+                Field name -> array stacked in the order of `query_ids`.
+        """
+        key = self.run_key(params, input_digests)
+        rows = self._load_blocks(key)
+
+        run_file = os.path.join(self._run_dir(key), RUN_FILE)
+        if not os.path.exists(run_file):
+            os.makedirs(self._run_dir(key), exist_ok=True)
+            _write_json(run_file, {"params": params, "inputs": input_digests})
+
+        query_ids = [str(query_id) for query_id in query_ids]
+        missing = list(dict.fromkeys(query_id for query_id in query_ids if query_id not in rows))
+        for start in range(0, len(missing), block_size):
+            block_ids = missing[start : start + block_size]
+            fields = {name: np.asarray(values) for name, values in compute_block(block_ids).items()}
+            self._save_block(key, block_ids, fields)
+            for i, query_id in enumerate(block_ids):
+                rows[query_id] = {name: values[i] for name, values in fields.items()}
+
+        self._touch(key)
+        self.evict(keep=key)
+
+        if not query_ids:
+            return {}
+        field_names = rows[query_ids[0]].keys()
+        return {name: np.stack([rows[query_id][name] for query_id in query_ids]) for name in field_names}
+
+    def _run_bytes(self, key):
+        run_dir = self._run_dir(key)
+        total = 0
+        for filename in os.listdir(run_dir) if os.path.isdir(run_dir) else ():
+            try:
+                total += os.path.getsize(os.path.join(run_dir, filename))
+            except FileNotFoundError:
+                # Temporary file renamed by another process in the meantime
+                continue
+        return total
+
+    def _touch(self, key):
+        self._update_index({key: {"last_access": time.time(), "bytes": self._run_bytes(key)}})
+
+    def evict(self, keep=None):
+        """Remove least recently used runs until the size and entry limits hold."""
+        index = self._read_index()
+        by_age = sorted(index, key=lambda k: index[k]["last_access"])
+
+        def over_limits():
+            too_many = self.max_entries is not None and len(index) > self.max_entries
+            too_big = self.max_bytes is not None and sum(v["bytes"] for v in index.values()) > self.max_bytes
+            return too_many or too_big
+
+        removed = []
+        for key in by_age:
+            if not over_limits():
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._run_dir(key), ignore_errors=True)
+            del index[key]
+            removed.append(key)
+        if removed:
+            self._update_index(removed=removed)
+
+    def clear(self):
+        index = self._read_index()
+        for key in index:
+            shutil.rmtree(self._run_dir(key), ignore_errors=True)
+        self._update_index(removed=list(index))
+
+
+def cached_system_results(
+    cache,
+    feature_space,
+    ids,
+    feature_matrix,
+    tag_index,
+    similarity_metric="cosine",
+    N=10,
+    query_ids=None,
+    block_size=1024,
+):
+    """
+    Retrieval results and per-query metrics of one system, through a ResultCache.
+
+    Args
+    ----
+        cache
+            ResultCache to read from and write to.
+        feature_space
+            Name of the feature space (e.g., "BERT").
+        ids
+            Song ids in the row order of `feature_matrix`.
+        feature_matrix
+            (n_songs x dim) feature embeddings.
+        tag_index
+            TagIndex of the same songs, for relevance.
+        similarity_metric
+            Similarity metric ('cosine', 'euclidean').
+        N
+            Number of top results to retrieve.
+        query_ids
+            Ids of the query songs (defaults to every song).
+        block_size
+            Number of queries computed and stored per block.
+
+    Returns
+    -------
+        dict
+            'retrieved' (Q x N ids), 'scores' (Q x N) and the per-query Precision@N,
+            Recall@N, NDCG@N and MRR arrays, in the order of `query_ids`.
+    """
+    ids = np.asarray(ids)
+    query_ids = ids if query_ids is None else np.asarray(query_ids)
+    params = {"feature_space": feature_space, "similarity_metric": similarity_metric, "N": N}
+    input_digests = {
+        "embeddings": embedding_digest(ids, feature_matrix),
+        "relevance": relevance_digest(tag_index),
+    }
+    id_to_row = {str(song_id): row for row, song_id in enumerate(ids)}
+    prepared = {}
+
+    def compute_block(block_ids):
+        if "matrix" not in prepared:
+            prepared.update(prepare_feature_matrix(feature_matrix, similarity_metric))
+        rows = [id_to_row[song_id] for song_id in block_ids]
+        indices, scores = top_k_by_similarity(rows, metric=similarity_metric, k=N, prepared=prepared)
+        retrieved = ids[indices]
+        per_query = evaluate_retrieved(tag_index, ids[rows], retrieved, k=N)
+        return {"retrieved": retrieved.astype(str), "scores": scores, **per_query}
+
+    return cache.get_or_compute(params, input_digests, query_ids, compute_block, block_size=block_size)
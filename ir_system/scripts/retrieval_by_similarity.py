@@ -1,6 +1,14 @@
 from sklearn.metrics.pairwise import cosine_similarity, euclidean_distances
+import numpy as np
 import pandas as pd
+from scipy import sparse
 
+from scripts.instrumentation import timed, timer
+
+SUPPORTED_METRICS = ('cosine', 'euclidean')
+
+
+@timed()
 def retrieve_n_songs_by_similarity(query_song, dataset, feature_columns, metric='cosine', N=10):
     """
     Compute similarity using the specified metric.
@@ -24,20 +32,267 @@ def retrieve_n_songs_by_similarity(query_song, dataset, feature_columns, metric=
             A DataFrame of the top N similar songs with similarity scores.
     """
     # Extract the feature vector for the query song
-    query_vector = query_song[feature_columns].values.reshape(1, -1)
-    feature_matrix = dataset[feature_columns].values
+    with timer("retrieve_n_songs_by_similarity.features"):
+        query_vector = query_song[feature_columns].values.reshape(1, -1)
+        feature_matrix = dataset[feature_columns].values
 
     # Compute similarity or distance
-    if metric == 'cosine':
-        similarities = cosine_similarity(query_vector, feature_matrix).flatten()
-    elif metric == 'euclidean':
-        distances = euclidean_distances(query_vector, feature_matrix).flatten()
-        similarities = 1 / (1 + distances)  # Convert distances to similarity
+    with timer("retrieve_n_songs_by_similarity.score"):
+        if metric == 'cosine':
+            similarities = cosine_similarity(query_vector, feature_matrix).flatten()
+        elif metric == 'euclidean':
+            distances = euclidean_distances(query_vector, feature_matrix).flatten()
+            similarities = 1 / (1 + distances)  # Convert distances to similarity
+        else:
+            raise ValueError("Unsupported metric. Use 'cosine' or 'euclidean'.")
+
+    # Exclude the query song and select the top N rows without sorting the whole dataset
+    with timer("retrieve_n_songs_by_similarity.select"):
+        candidates = np.flatnonzero((dataset['id'] != query_song['id']).values)
+        top = top_k_positions(similarities[candidates], N)
+        positions = candidates[top]
+
+        # Work on a copy so the caller's dataset is not modified
+        results = dataset.iloc[positions].copy()
+        results['similarity'] = similarities[positions]
+
+    return results
+
+
+def top_k_positions(scores, k):
+    """Positions of the k largest scores, ordered by descending score, ties by position."""
+    return top_k_rows(np.asarray(scores)[None, :], k)[0]
+
+
+def top_k_rows(scores, k):
+    """
+    Row-wise `top_k_positions` of a (Q x n) score block.
+
+    Returns
+    -------
+        numpy.ndarray
+            (Q x k) column positions, by descending score, ties by position.
+    """
+    return _smallest_k_rows(np.negative(scores), k)
+
+
+def _smallest_k_rows(costs, k, max_block=2**18):
+    """
+    Row-wise positions of the k smallest costs (negated scores), by ascending cost,
+    ties by position.
+
+    Rows are selected with one `argpartition` per group of about `max_block` costs
+    (its full-width index array stays cache-sized instead of being as large as the
+    block), then the selected columns are sorted row-wise with `lexsort`.
+    """
+    n_rows, n_columns = costs.shape
+    k = min(k, n_columns)
+    if k <= 0:
+        return np.empty((n_rows, 0), dtype=np.int64)
+    if k == n_columns:
+        top = np.broadcast_to(np.arange(n_columns), (n_rows, n_columns)).copy()
     else:
+        top = np.empty((n_rows, k), dtype=np.int64)
+        group_size = max(1, max_block // n_columns)
+        for start in range(0, n_rows, group_size):
+            group = costs[start : start + group_size]
+            group_top = np.argpartition(group, k - 1, axis=1)[:, :k]
+            # argpartition picks arbitrary members of a tie at the k-th cost; redo those
+            # rows with a stable sort so the lowest positions win, as in a full sort
+            kth = np.take_along_axis(group, group_top, axis=1).max(axis=1)
+            for row in np.flatnonzero(np.count_nonzero(group <= kth[:, None], axis=1) > k):
+                group_top[row] = np.argsort(group[row], kind="stable")[:k]
+            top[start : start + group_size] = group_top
+    top_costs = np.take_along_axis(costs, top, axis=1)
+    return np.take_along_axis(top, np.lexsort((top, top_costs), axis=1), axis=1)
+
+
+@timed()
+def prepare_feature_matrix(feature_matrix, metric='cosine', dtype=np.float64):
+    """
+    Pre-process a feature matrix once so it can be scored against many query blocks.
+
+    For 'cosine' the rows are L2-normalised (zero rows stay zero, as in sklearn);
+    for 'euclidean' the squared row norms are precomputed. Sparse matrices (e.g.
+    TF-IDF) stay in CSR format and are never densified.
+
+    Args
+    ----
+        feature_matrix
+            (n_songs x dim) array or scipy sparse matrix of feature embeddings.
+        metric
+            Similarity metric ('cosine', 'euclidean').
+        dtype
+            Floating point type used for scoring. float64 reproduces the
+            scores of `retrieve_n_songs_by_similarity`.
+
+    Returns
+    -------
+        dict
+            Prepared matrix and auxiliary arrays, consumed by `top_k_by_similarity`.
+    """
+    if metric not in SUPPORTED_METRICS:
         raise ValueError("Unsupported metric. Use 'cosine' or 'euclidean'.")
 
-    # Add similarity scores to dataset and exclude the query song
-    dataset['similarity'] = similarities
-    results = dataset[dataset['id'] != query_song['id']].sort_values(by='similarity', ascending=False)
+    if sparse.issparse(feature_matrix):
+        matrix = sparse.csr_matrix(feature_matrix, dtype=dtype)
+        squared_norms = np.asarray(matrix.multiply(matrix).sum(axis=1), dtype=dtype).ravel()
+    else:
+        matrix = np.asarray(feature_matrix, dtype=dtype)
+        squared_norms = np.einsum('ij,ij->i', matrix, matrix)
+
+    if metric == 'cosine':
+        norms = np.sqrt(squared_norms)
+        norms[norms == 0] = 1
+        if sparse.issparse(matrix):
+            matrix = sparse.csr_matrix(sparse.diags(1 / norms) @ matrix)
+        else:
+            matrix = matrix / norms[:, None]
 
-    return results.head(N)
\ No newline at end of file
+    return {'metric': metric, 'matrix': matrix, 'squared_norms': squared_norms}
+
+
+def _score_block(prepared, query_rows=None, query_vectors=None):
+    """Similarity of a block of queries (rows of the prepared matrix or raw vectors) to all songs."""
+    if 'quantized' in prepared:
+        return prepared['quantized'].score_block(query_rows, query_vectors)
+
+    metric = prepared['metric']
+    matrix = prepared['matrix']
+
+    if query_vectors is None:
+        queries = matrix[query_rows]
+        query_squared_norms = prepared['squared_norms'][query_rows]
+    else:
+        if sparse.issparse(query_vectors):
+            query_vectors = query_vectors.toarray()
+        queries = np.asarray(query_vectors, dtype=matrix.dtype)
+        query_squared_norms = np.einsum('ij,ij->i', queries, queries)
+        if metric == 'cosine':
+            norms = np.sqrt(query_squared_norms)
+            norms[norms == 0] = 1
+            queries = queries / norms[:, None]
+
+    if sparse.issparse(matrix):
+        # Sparse-dense product, O(nnz x block size): only the query block is densified
+        if sparse.issparse(queries):
+            queries = queries.toarray()
+        scores = np.ascontiguousarray((matrix @ queries.T).T)
+    else:
+        scores = queries @ matrix.T
+    if metric == 'euclidean':
+        # Same expansion as sklearn's euclidean_distances
+        scores *= -2
+        scores += query_squared_norms[:, None]
+        scores += prepared['squared_norms'][None, :]
+        np.maximum(scores, 0, out=scores)
+        np.sqrt(scores, out=scores)
+        scores += 1
+        np.reciprocal(scores, out=scores)
+    return scores
+
+
+@timed()
+def top_k_by_similarity(
+    query_rows,
+    feature_matrix=None,
+    metric='cosine',
+    k=10,
+    exclude_self=True,
+    chunk_size=256,
+    prepared=None,
+):
+    """
+    Batched top-K retrieval for a block of queries.
+
+    Queries are scored in chunks of `chunk_size` with one matrix product per chunk, so
+    peak memory is bounded by chunk_size x n_songs scores even when the whole catalogue
+    is queried against itself. The top K of a chunk are selected with row-group
+    `argpartition`s and ordered by descending similarity (ties by row).
+
+    Args
+    ----
+        query_rows
+            Row positions of the query songs in `feature_matrix`.
+        feature_matrix
+            (n_songs x dim) array or scipy sparse matrix of feature embeddings. Not
+            needed if `prepared` is given.
+        metric
+            Similarity metric ('cosine', 'euclidean').
+        k
+            Number of results per query.
+        exclude_self
+            Mask each query's own row out of its results.
+        chunk_size
+            Number of queries scored per matrix product.
+        prepared
+            Output of `prepare_feature_matrix` (or `QuantizedMatrix.prepared` for
+            reduced precision), to reuse across calls.
+
+    Returns
+    -------
+        tuple
+            (indices, scores): (n_queries x k) arrays of row positions and similarities.
+    """
+    if prepared is None:
+        prepared = prepare_feature_matrix(feature_matrix, metric)
+    elif prepared['metric'] != metric:
+        raise ValueError(f"Prepared matrix is for '{prepared['metric']}', not '{metric}'.")
+
+    query_rows = np.asarray(query_rows, dtype=np.int64)
+    n_songs = prepared['matrix'].shape[0]
+    k = min(k, n_songs - 1 if exclude_self else n_songs)
+
+    indices = np.empty((len(query_rows), k), dtype=np.int64)
+    scores = np.empty((len(query_rows), k), dtype=np.result_type(prepared['matrix'].dtype, np.float32))
+
+    for start in range(0, len(query_rows), chunk_size):
+        block_rows = query_rows[start : start + chunk_size]
+        # Select on negated scores in place, so the block is not copied
+        costs = _score_block(prepared, query_rows=block_rows)
+        np.negative(costs, out=costs)
+        if exclude_self:
+            costs[np.arange(len(block_rows)), block_rows] = np.inf
+
+        top = _smallest_k_rows(costs, k)
+        indices[start : start + len(block_rows)] = top
+        scores[start : start + len(block_rows)] = -np.take_along_axis(costs, top, axis=1)
+
+    return indices, scores
+
+
+@timed()
+def retrieve_top_k_ids(query_ids, ids, feature_matrix=None, metric='cosine', k=10, chunk_size=256, prepared=None):
+    """
+    Top-K retrieval by song id.
+
+    Args
+    ----
+        query_ids
+            Ids of the query songs.
+        ids
+            Song ids in the row order of `feature_matrix`.
+        feature_matrix
+            (n_songs x dim) array or scipy sparse matrix of feature embeddings.
+        metric
+            Similarity metric ('cosine', 'euclidean').
+        k
+            Number of results per query.
+        chunk_size
+            Number of queries scored per matrix product.
+        prepared
+            Output of `prepare_feature_matrix` (or `QuantizedMatrix.prepared` for
+            reduced precision), to reuse across calls.
+
+    Returns
+    -------
+        tuple
+            (retrieved_ids, scores): (n_queries x k) arrays of song ids and similarities.
+    """
+    ids = np.asarray(ids)
+    id_to_row = pd.Series(np.arange(len(ids)), index=ids)
+    query_rows = id_to_row.loc[list(query_ids)].values
+    indices, scores = top_k_by_similarity(
+        query_rows, feature_matrix, metric=metric, k=k, chunk_size=chunk_size, prepared=prepared
+    )
+    return ids[indices], scores
@@ -0,0 +1,474 @@
+import numpy as np
+import pandas as pd
+
+from scripts.evaluation_metrics import retrieve_rows
+from scripts.instrumentation import timed
+from scripts.metric_kernels import batch_beyond_accuracy, evaluate_retrieved
+from scripts.relevance_computation import TagIndex
+
+
+ACCURACY_KEYS = ("Precision@N", "Recall@N", "NDCG@N", "MRR")
+BEYOND_KEYS = ("Div@N", "AvgPop@N")
+
+
+def query_strata(dataset, strata_column="genre"):
+    """
+    Stratum code of every song: the first entry of list columns such as 'genre'
+    ('' for songs without one), the value itself otherwise.
+
+    Returns
+    -------
+        tuple
+            (codes, labels): an int array of stratum codes and the stratum labels.
+    """
+    values = dataset[strata_column].map(
+        lambda value: (value[0] if len(value) else "") if isinstance(value, (list, tuple)) else value
+    )
+    codes, labels = pd.factorize(values, use_na_sentinel=False)
+    return codes, np.asarray(labels)
+
+
+def sample_order(n, strata_codes=None, seed=42, min_per_stratum=0):
+    """
+    Random order of n queries in which every prefix is a (proportionally) stratified
+    sample, so queries can be drawn in stages without replacement.
+
+    Within each stratum h of size n_h the shuffled members get the keys
+    (i + u_h) / n_h, i = 0, 1, ..., with one random offset u_h per stratum, and the
+    queries are sorted by key: the first m queries hold about m * n_h / n of stratum h.
+    The first `min_per_stratum` members of every stratum (all of a smaller stratum)
+    are moved to the front, so once they are drawn every stratum has at least that
+    many queries and grows proportionally from there.
+    """
+    rng = np.random.default_rng(seed)
+    if strata_codes is None:
+        return rng.permutation(n)
+    strata_codes = np.asarray(strata_codes)
+    keys = np.empty(n)
+    tiers = np.ones(n, dtype=np.int64)
+    for code in np.unique(strata_codes):
+        members = rng.permutation(np.flatnonzero(strata_codes == code))
+        offset = rng.random()
+        keys[members] = (np.arange(len(members)) + offset) / len(members)
+        floor = min(min_per_stratum, len(members))
+        if floor:
+            keys[members[:floor]] = (np.arange(floor) + offset) / floor
+            tiers[members[:floor]] = 0
+    return np.lexsort((rng.random(n), keys, tiers))
+
+
+def stratified_estimate(values, strata_codes, weights, n_bootstrap=1000, confidence=0.95, rng=None, max_block=2**21):
+    """
+    Stratified mean of per-query values with a percentile bootstrap confidence interval.
+
+    Values are resampled with replacement within each stratum, and stratum means are
+    weighted by the population share of the stratum (renormalised over the strata
+    present in the sample).
+
+    Args
+    ----
+        values
+            Per-query values of the sample.
+        strata_codes
+            Stratum code of every sampled query.
+        weights
+            Population share of every stratum code.
+        n_bootstrap
+            Number of bootstrap replicates.
+        confidence
+            Confidence level of the interval.
+        rng
+            numpy Generator for the resampling.
+        max_block
+            Maximum number of values resampled at once (bounds memory).
+
+    Returns
+    -------
+        tuple
+            (estimate, ci_low, ci_high)
+    """
+    rng = rng or np.random.default_rng()
+    values = np.asarray(values, dtype=np.float64)
+    present = np.unique(strata_codes)
+    present_weights = np.asarray(weights)[present]
+    present_weights = present_weights / present_weights.sum()
+
+    estimate = 0.0
+    replicates = np.zeros(n_bootstrap)
+    for code, weight in zip(present, present_weights):
+        stratum_values = values[strata_codes == code]
+        estimate += weight * stratum_values.mean()
+        block = max(1, max_block // len(stratum_values))
+        for start in range(0, n_bootstrap, block):
+            stop = min(start + block, n_bootstrap)
+            draws = rng.integers(0, len(stratum_values), (stop - start, len(stratum_values)))
+            replicates[start:stop] += weight * stratum_values[draws].mean(axis=1)
+
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(replicates, [alpha, 1 - alpha])
+    return float(estimate), float(low), float(high)
+
+
+def sampled_evaluation(
+    evaluate,
+    n_population,
+    strata_codes=None,
+    target_ci_width=0.01,
+    ci_metrics=("NDCG@N",),
+    confidence=0.95,
+    stage_size=200,
+    max_queries=None,
+    n_bootstrap=1000,
+    seed=42,
+    callback=None,
+    min_per_stratum=5,
+):
+    """
+    Evaluate queries in stages until the confidence intervals are narrow enough.
+
+    Queries are drawn in the order of `sample_order`. After every stage the running
+    (stratified) means and their bootstrap confidence intervals are updated; sampling
+    stops once every stratum has at least `min_per_stratum` evaluated queries and every
+    watched interval is at most `target_ci_width` wide, or when `max_queries`
+    (default: the whole population) have been evaluated.
+
+    Args
+    ----
+        evaluate
+            Function mapping an array of population positions to a dict of per-query
+            value arrays (one entry per metric key).
+        n_population
+            Number of candidate queries.
+        strata_codes
+            Stratum code of every candidate query, or None for simple random sampling.
+        target_ci_width
+            Stop once the watched intervals are at most this wide (high - low).
+        ci_metrics
+            Watched keys; a key matches itself and every tuple key ending in it
+            (e.g., "NDCG@N" watches ("cosine", "NDCG@N")).
+        confidence
+            Confidence level of the intervals.
+        stage_size
+            Number of queries evaluated per stage.
+        max_queries
+            Upper bound on the number of evaluated queries.
+        n_bootstrap
+            Number of bootstrap replicates per interval.
+        seed
+            Seed of the query order and of the bootstrap.
+        callback
+            Optional function called as callback(stage) with the history entry of
+            every stage.
+        min_per_stratum
+            Minimum number of evaluated queries of every stratum (capped at its size)
+            before the intervals may stop sampling; a stratum with one or two queries
+            has a near-zero bootstrap spread and would make the interval look narrow.
+
+    Returns
+    -------
+        dict
+            "estimates" (key -> (mean, ci_low, ci_high)), "positions" (evaluated
+            population positions, in evaluation order), "converged" and "history"
+            (one entry per stage with the number of queries and the widest watched
+            interval).
+    """
+    order = sample_order(n_population, strata_codes, seed, min_per_stratum)
+    max_queries = n_population if max_queries is None else min(max_queries, n_population)
+    strata_codes = np.zeros(n_population, dtype=np.int64) if strata_codes is None else np.asarray(strata_codes)
+    weights = np.bincount(strata_codes) / n_population
+    required = np.minimum(np.bincount(strata_codes), min_per_stratum)
+    rng = np.random.default_rng(seed)
+
+    values = {}
+    history = []
+    estimates = {}
+    converged = False
+    n_done = 0
+    while n_done < max_queries:
+        positions = order[n_done : min(n_done + stage_size, max_queries)]
+        for key, stage_values in evaluate(positions).items():
+            values.setdefault(key, []).append(np.asarray(stage_values, dtype=np.float64))
+        n_done += len(positions)
+
+        sample_codes = strata_codes[order[:n_done]]
+        estimates = {
+            key: stratified_estimate(np.concatenate(parts), sample_codes, weights, n_bootstrap, confidence, rng)
+            for key, parts in values.items()
+        }
+        watched = [
+            high - low
+            for key, (_, low, high) in estimates.items()
+            if key in ci_metrics or (isinstance(key, tuple) and key[-1] in ci_metrics)
+        ]
+        widest = max(watched) if watched else 0.0
+        smallest = np.bincount(sample_codes, minlength=len(required)) - required
+        converged = n_done >= 2 and smallest.min() >= 0 and widest <= target_ci_width
+        stage = {"queries": n_done, "max_ci_width": widest, "strata_below_minimum": int((smallest < 0).sum())}
+        history.append(stage)
+        if callback is not None:
+            callback(stage)
+        if converged:
+            break
+
+    return {"estimates": estimates, "positions": order[:n_done], "converged": converged, "history": history}
+
+
+def _sampling_metadata(
+    outcome, query_ids, strata_column, target_ci_width, ci_metrics, confidence, stage_size, seed, min_per_stratum
+):
+    return {
+        "seed": seed,
+        "strata_column": strata_column,
+        "min_per_stratum": min_per_stratum,
+        "target_ci_width": target_ci_width,
+        "ci_metrics": list(ci_metrics),
+        "confidence": confidence,
+        "stage_size": stage_size,
+        "converged": outcome["converged"],
+        "n_queries": len(outcome["positions"]),
+        "query_ids": [str(query_id) for query_id in query_ids],
+        "history": outcome["history"],
+    }
+
+
+@timed()
+def run_evaluations_sampled(
+    dataset,
+    feature_columns,
+    similarity_metrics,
+    N=10,
+    tag_index=None,
+    neighbour_graphs=None,
+    feature_matrix=None,
+    query_indices=None,
+    strata_column=None,
+    target_ci_width=0.01,
+    ci_metrics=("NDCG@N",),
+    confidence=0.95,
+    stage_size=200,
+    max_queries=None,
+    n_bootstrap=1000,
+    seed=42,
+    callback=None,
+    min_per_stratum=5,
+):
+    """
+    Sampling mode of `run_evaluations`: average metrics over a staged query sample,
+    with bootstrap confidence intervals, instead of over every query.
+
+    All similarity metrics are evaluated on the same queries; sampling stops when the
+    intervals of `ci_metrics` are at most `target_ci_width` wide for all of them.
+
+    Args
+    ----
+        dataset
+            Full dataset containing features for similarity computation.
+        feature_columns
+            List of columns corresponding to feature embeddings (None for the random
+            baseline).
+        similarity_metrics
+            List of similarity metrics to evaluate (e.g., ['cosine', 'euclidean']).
+        N
+            Number of top results to retrieve.
+        tag_index
+            Optional TagIndex built from `dataset`.
+        neighbour_graphs
+            Optional mapping of similarity metric -> NeighbourGraph of this feature space.
+        feature_matrix
+            Optional feature matrix aligned with `dataset` (e.g., sparse TF-IDF), used
+            instead of the feature columns.
+        query_indices
+            Candidate query indices (defaults to every song).
+        strata_column
+            If given (e.g., 'genre'), queries are sampled proportionally per stratum of
+            this column (see `query_strata`).
+        target_ci_width, ci_metrics, confidence, stage_size, max_queries, n_bootstrap, seed, callback, min_per_stratum
+            See `sampled_evaluation`.
+
+    Returns
+    -------
+        tuple
+            (results, metadata): results has the format of `run_evaluations` plus
+            "<key> CI low" and "<key> CI high" for every metric; metadata records the
+            seed, the sampled query ids, the stopping state and the stage history.
+    """
+    if tag_index is None:
+        tag_index = TagIndex.from_dataset(dataset)
+    ids = dataset["id"].values
+    query_indices = np.arange(len(dataset)) if query_indices is None else np.asarray(query_indices)
+    strata_codes = query_strata(dataset, strata_column)[0][query_indices] if strata_column else None
+
+    def evaluate(positions):
+        rows = query_indices[positions]
+        per_query = {}
+        for metric in similarity_metrics:
+            retrieved = retrieve_rows(
+                rows, dataset, feature_columns, metric, N, (neighbour_graphs or {}).get(metric), feature_matrix
+            )
+            scores = evaluate_retrieved(tag_index, ids[rows], ids[retrieved], k=N)
+            per_query.update({(metric, key): scores[key] for key in ACCURACY_KEYS})
+        return per_query
+
+    outcome = sampled_evaluation(
+        evaluate,
+        len(query_indices),
+        strata_codes,
+        target_ci_width,
+        ci_metrics,
+        confidence,
+        stage_size,
+        max_queries,
+        n_bootstrap,
+        seed,
+        callback,
+        min_per_stratum,
+    )
+
+    results = {metric: {} for metric in similarity_metrics}
+    for (metric, key), (mean, low, high) in outcome["estimates"].items():
+        results[metric][key] = mean
+        results[metric][f"{key} CI low"] = low
+        results[metric][f"{key} CI high"] = high
+    metadata = _sampling_metadata(
+        outcome,
+        ids[query_indices[outcome["positions"]]],
+        strata_column,
+        target_ci_width,
+        ci_metrics,
+        confidence,
+        stage_size,
+        seed,
+        min_per_stratum,
+    )
+    return results, metadata
+
+
+@timed()
+def evaluate_tradeoffs_sampled(
+    datasets,
+    systems,
+    beyond_metrics,
+    beyond_tags_column,
+    beyond_popularity_column,
+    N=10,
+    neighbour_graphs=None,
+    feature_matrices=None,
+    weight_threshold=60,
+    strata_column=None,
+    target_ci_width=0.01,
+    ci_metrics=("NDCG@N",),
+    confidence=0.95,
+    stage_size=200,
+    max_queries=None,
+    n_bootstrap=1000,
+    seed=42,
+    min_per_stratum=5,
+):
+    """
+    Sampling mode of `evaluate_tradeoffs`: the queries of every system are drawn in
+    stages from its whole dataset until the confidence intervals of `ci_metrics` are
+    at most `target_ci_width` wide.
+
+    Every system uses the same seed, so systems over the same dataset are evaluated
+    on the same queries.
+
+    Args
+    ----
+        datasets
+            Dictionary mapping system names to their respective datasets.
+        systems
+            Dictionary mapping system names to their feature columns (None for random).
+        beyond_metrics
+            List of similarity metrics to evaluate (e.g., ['cosine', 'euclidean']).
+        beyond_tags_column
+            Name of the column containing tags for diversity.
+        beyond_popularity_column
+            Name of the column containing popularity scores.
+        N
+            Number of top results to evaluate.
+        neighbour_graphs
+            Optional mapping of system name -> {similarity metric: NeighbourGraph}.
+        feature_matrices
+            Optional mapping of system name -> feature matrix aligned with its dataset.
+        weight_threshold
+            Tag weight threshold for diversity.
+        strata_column
+            If given (e.g., 'genre'), queries are sampled proportionally per stratum.
+        target_ci_width, ci_metrics, confidence, stage_size, max_queries, n_bootstrap, seed, min_per_stratum
+            See `sampled_evaluation`.
+
+    Returns
+    -------
+        pandas.DataFrame
+            The columns of `evaluate_tradeoffs` plus "<key> CI low" / "<key> CI high"
+            and the number of queries; the sampling metadata of every system is stored
+            in `attrs["sampling"]`.
+    """
+    results = []
+    sampling = {}
+
+    for system_name, feature_columns in systems.items():
+        print(f"{system_name}:")
+        dataset = datasets[system_name]
+        ids = dataset["id"].values
+        # Relevance always comes from '(tag, weight)', as in `evaluate_tradeoffs`
+        tag_index = TagIndex.from_dataset(dataset)
+        if beyond_tags_column == "(tag, weight)":
+            diversity_weights = tag_index.weights
+        else:
+            diversity_weights = TagIndex.from_dataset(dataset, beyond_tags_column).weights
+        popularity = dataset[beyond_popularity_column].values
+        system_graphs = (neighbour_graphs or {}).get(system_name, {})
+        feature_matrix = (feature_matrices or {}).get(system_name)
+        metrics = ["random"] if feature_columns is None else beyond_metrics
+        strata_codes = query_strata(dataset, strata_column)[0] if strata_column else None
+
+        def evaluate(rows):
+            per_query = {}
+            for metric in metrics:
+                retrieved = retrieve_rows(
+                    rows, dataset, feature_columns, metric, N, system_graphs.get(metric), feature_matrix
+                )
+                scores = evaluate_retrieved(tag_index, ids[rows], ids[retrieved], k=N)
+                beyond = batch_beyond_accuracy(retrieved, diversity_weights, popularity, (weight_threshold,))
+                per_query.update({(metric, key): scores[key] for key in ACCURACY_KEYS if key != "MRR"})
+                per_query.update({(metric, key): beyond["per_query"][weight_threshold][key] for key in BEYOND_KEYS})
+            return per_query
+
+        outcome = sampled_evaluation(
+            evaluate,
+            len(dataset),
+            strata_codes,
+            target_ci_width,
+            ci_metrics,
+            confidence,
+            stage_size,
+            max_queries,
+            n_bootstrap,
+            seed,
+            lambda stage: print(f"  {stage['queries']} queries, widest CI {stage['max_ci_width']:.4f}"),
+            min_per_stratum,
+        )
+        sampling[system_name] = _sampling_metadata(
+            outcome,
+            ids[outcome["positions"]],
+            strata_column,
+            target_ci_width,
+            ci_metrics,
+            confidence,
+            stage_size,
+            seed,
+            min_per_stratum,
+        )
+
+        for metric in metrics:
+            row = {"System": system_name, "Metric": metric}
+            for key in ("Precision@N", "Recall@N", "NDCG@N") + BEYOND_KEYS:
+                row[key], row[f"{key} CI low"], row[f"{key} CI high"] = outcome["estimates"][(metric, key)]
+            row["Queries"] = len(outcome["positions"])
+            results.append(row)
+        print()
+
+    results = pd.DataFrame(results)
+    results.attrs["sampling"] = sampling
+    return results
@@ -0,0 +1,368 @@
+import itertools
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from scripts.late_fusion import LateFusion
+from scripts.metric_kernels import batch_beyond_accuracy, batch_metrics
+from scripts.relevance_computation import TagIndex
+from scripts.retrieval_by_similarity import top_k_by_similarity
+
+
+DEFAULT_OBJECTIVES = {"NDCG@N": "max", "Div@N": "max", "AvgPop@N": "min"}
+DEFAULT_PARAMETERS = {
+    "metric": "cosine",
+    "normalization": "minmax",
+    "strategy": "weighted",
+    "weights": None,
+    "N": 10,
+    "rrf_k": 60,
+    "weight_threshold": 60,
+}
+
+
+def parameter_grid(grid):
+    """All configurations (dicts) of a {parameter: [values]} grid, over the defaults."""
+    names = list(grid)
+    return [
+        {**DEFAULT_PARAMETERS, **dict(zip(names, values))}
+        for values in itertools.product(*(grid[name] for name in names))
+    ]
+
+
+def weight_grid(system_names, step=0.1):
+    """Fusion weight dicts on the simplex (weights summing to 1) with the given step."""
+    n_steps = int(round(1 / step))
+    grid = []
+    for split in itertools.product(range(n_steps + 1), repeat=len(system_names) - 1):
+        if sum(split) <= n_steps:
+            steps = split + (n_steps - sum(split),)
+            grid.append({name: round(s * step, 10) for name, s in zip(system_names, steps)})
+    return grid
+
+
+class ParetoFrontier:
+    """
+    Streaming Pareto frontier of evaluated configurations.
+
+    Args
+    ----
+        objectives
+            {result key: 'max' or 'min'}, e.g. {"NDCG@N": "max", "Div@N": "max"}.
+    """
+
+    def __init__(self, objectives=None):
+        self.objectives = dict(objectives or DEFAULT_OBJECTIVES)
+        self._signs = np.array([1.0 if d == "max" else -1.0 for d in self.objectives.values()])
+        self.results = []
+
+    def _point(self, result):
+        return np.array([result[key] for key in self.objectives], dtype=np.float64) * self._signs
+
+    def dominates(self, a, b):
+        """Whether result `a` is at least as good as `b` everywhere and better somewhere."""
+        a, b = self._point(a), self._point(b)
+        return bool(np.all(a >= b) and np.any(a > b))
+
+    def is_dominated(self, result):
+        return any(self.dominates(other, result) for other in self.results)
+
+    def add(self, result):
+        """Add a result; returns True if it joins the frontier (dominated members are dropped)."""
+        if self.is_dominated(result):
+            return False
+        self.results = [other for other in self.results if not self.dominates(result, other)]
+        self.results.append(result)
+        return True
+
+    def to_frame(self):
+        return pd.DataFrame(self.results)
+
+
+def _select(stage, query_rows):
+    """Restrict a precomputed stage to a subset of queries (rows of its matrices)."""
+    if query_rows is None:
+        return stage
+    fusion, grades, rows = stage
+    return fusion.subset(query_rows), grades[query_rows], rows[query_rows]
+
+
+def _evaluate_group(state, configs, query_rows=None):
+    """
+    Evaluate configurations that differ only in `weight_threshold`: one fusion, one
+    relevance lookup and one beyond-accuracy pass serve all of them.
+
+    Returns the result dicts and the per-query arrays of every objective.
+    """
+    config = configs[0]
+    fusion, candidate_grades, candidate_rows = _select(
+        state["stages"][(config["metric"], config["normalization"])], query_rows
+    )
+    n_relevant = state["n_relevant"] if query_rows is None else state["n_relevant"][query_rows]
+    N = config["N"]
+
+    positions, scores = fusion.fuse_positions(config["strategy"], config["weights"], N, config["rrf_k"])
+    grades = np.take_along_axis(candidate_grades, positions, axis=1)
+    grades[~np.isfinite(scores)] = np.nan
+    accuracy = batch_metrics(grades, n_relevant, k=N)
+
+    rows = np.take_along_axis(candidate_rows, positions, axis=1)
+    thresholds = [c["weight_threshold"] for c in configs]
+    beyond = batch_beyond_accuracy(rows, state["tag_weights"], state["popularity"], thresholds, state["n_songs"])
+
+    results, per_query = [], []
+    for c in configs:
+        threshold = c["weight_threshold"]
+        results.append(
+            {
+                **c,
+                **{key: float(values.mean()) for key, values in accuracy.items()},
+                **beyond[threshold],
+                "n_queries": len(n_relevant),
+            }
+        )
+        per_query.append({**accuracy, **beyond["per_query"][threshold]})
+    return results, per_query
+
+
+# Per-process state set by `_init_worker`
+_WORKER = {}
+
+
+def _init_worker(state):
+    _WORKER.clear()
+    _WORKER.update(state)
+
+
+def _run_group(task):
+    configs, sample_rows, frontier, objectives, z = task
+    stopped = [False] * len(configs)
+    if sample_rows is not None and frontier:
+        sample_results, per_query = _evaluate_group(_WORKER, configs, sample_rows)
+        pareto = ParetoFrontier(objectives)
+        pareto.results = frontier
+        for i, (result, values) in enumerate(zip(sample_results, per_query)):
+            # Optimistic estimate: every objective pushed z standard errors towards better
+            optimistic = dict(result)
+            for key, direction in objectives.items():
+                margin = z * np.std(values[key]) / np.sqrt(len(values[key]))
+                optimistic[key] = result[key] + (margin if direction == "max" else -margin)
+            stopped[i] = pareto.is_dominated(optimistic)
+
+    remaining = [config for config, stop in zip(configs, stopped) if not stop]
+    full = iter(_evaluate_group(_WORKER, remaining)[0] if remaining else [])
+    return [
+        {**sample_results[i], "stopped": True} if stop else {**next(full), "stopped": False}
+        for i, stop in enumerate(stopped)
+    ]
+
+
+class FusionSweep:
+    """
+    Grid search over late-fusion weights, strategy, normalisation, N, similarity metric
+    and diversity weight threshold, with every shared stage computed once.
+
+    Neighbour lists are retrieved once per system and metric (`depth` neighbours, or
+    read from neighbour graphs), per-system normalised scores are aligned once per
+    metric and normalisation (LateFusion), and relevance grades of all fused
+    candidates are looked up once per alignment. A configuration is then a fusion, a
+    gather and a beyond-accuracy pass over all queries.
+
+    Every configuration is fused over the same `depth` candidates per system, whatever
+    the other entries of the grid, so its results are comparable across sweeps.
+
+    Args
+    ----
+        datasets
+            Dictionary mapping system names to their datasets.
+        systems
+            Dictionary mapping system names to their feature columns.
+        query_ids
+            Ids of the query songs.
+        tags_column
+            Name of the column containing tags (relevance and diversity).
+        popularity_column
+            Name of the column containing popularity scores.
+        neighbour_graphs
+            Optional mapping of system name -> {similarity metric: NeighbourGraph}.
+        base_dataset
+            Dataset providing tags and popularity; defaults to the first system's dataset.
+        objectives
+            Pareto objectives (see ParetoFrontier).
+        depth
+            Number of candidates per system that are normalised and fused; must be at
+            least the largest N of a grid.
+    """
+
+    def __init__(
+        self,
+        datasets,
+        systems,
+        query_ids,
+        tags_column="(tag, weight)",
+        popularity_column="popularity",
+        neighbour_graphs=None,
+        base_dataset=None,
+        objectives=None,
+        depth=100,
+    ):
+        self.datasets = datasets
+        self.systems = systems
+        self.query_ids = list(query_ids)
+        self.neighbour_graphs = neighbour_graphs or {}
+        self.objectives = dict(objectives or DEFAULT_OBJECTIVES)
+        self.depth = depth
+
+        base = datasets[next(iter(systems))] if base_dataset is None else base_dataset
+        self.base_ids = pd.Index(base["id"].values)
+        self.tag_index = TagIndex.from_dataset(base, tags_column)
+        self.popularity = base[popularity_column].values.astype(np.float64)
+        self.n_relevant = np.array([len(self.tag_index.relevance_for_id(song_id)[0]) for song_id in self.query_ids])
+        self._neighbours = {}
+        self._stages = {}
+
+    def neighbours(self, system, metric, depth):
+        """(ids, scores) of the top `depth` neighbours of every query for one system."""
+        key = (system, metric)
+        cached = self._neighbours.get(key)
+        if cached is None or cached[0].shape[1] < depth:
+            graph = self.neighbour_graphs.get(system, {}).get(metric)
+            if graph is not None:
+                ids, scores = graph.top_n_ids(self.query_ids, depth)
+            else:
+                dataset = self.datasets[system]
+                ids = dataset["id"].values
+                query_rows = pd.Index(ids).get_indexer(self.query_ids)
+                if np.any(query_rows < 0):
+                    missing = [song_id for song_id, row in zip(self.query_ids, query_rows) if row < 0]
+                    raise KeyError(f"Query ids missing from the {system} dataset: {missing[:10]}")
+                rows, scores = top_k_by_similarity(
+                    query_rows, dataset[self.systems[system]].values, metric=metric, k=depth
+                )
+                ids = ids[rows]
+            cached = self._neighbours[key] = (np.asarray(ids, dtype=object), np.asarray(scores, dtype=np.float64))
+        ids, scores = cached
+        return ids[:, :depth], scores[:, :depth]
+
+    def stage(self, metric, normalization):
+        """(LateFusion, candidate grades, candidate rows) shared by configurations."""
+        key = (metric, normalization)
+        if key not in self._stages:
+            fusion = LateFusion(
+                self.query_ids,
+                {system: self.neighbours(system, metric, self.depth) for system in self.systems},
+                normalization,
+            )
+            codes = fusion.candidate_codes
+            valid = codes >= 0
+            candidate_ids = fusion.vocabulary[np.maximum(codes, 0)]
+            rows = self.base_ids.get_indexer(candidate_ids.ravel()).reshape(codes.shape)
+            if np.any(valid & (rows < 0)):
+                raise ValueError("Some retrieved songs are missing from the base dataset.")
+            rows[~valid] = 0
+
+            query_rows = self.tag_index.rows_for_ids(self.query_ids)
+            tag_rows = self.tag_index.rows_for_ids(self.base_ids[rows.ravel()].tolist())
+            grades = self.tag_index.pairwise_relevance(np.repeat(query_rows, codes.shape[1]), tag_rows)
+            grades = grades.reshape(codes.shape)
+            grades[~valid] = np.nan
+            self._stages[key] = (fusion, grades, rows)
+        return self._stages[key]
+
+    def _state(self, configs):
+        largest_N = max(c["N"] for c in configs)
+        if largest_N > self.depth:
+            raise ValueError(f"N={largest_N} is larger than the fusion depth ({self.depth}).")
+        for metric, normalization in {(c["metric"], c["normalization"]) for c in configs}:
+            self.stage(metric, normalization)
+        return {
+            "stages": self._stages,
+            "n_relevant": self.n_relevant,
+            "tag_weights": self.tag_index.weights,
+            "popularity": self.popularity,
+            "n_songs": len(self.base_ids),
+        }
+
+    def run(self, grid, n_workers=1, early_stopping=None, sample_size=0.2, z=2.0, seed=42, callback=None):
+        """
+        Evaluate every configuration of a grid and track the Pareto frontier.
+
+        Args
+        ----
+            grid
+                {parameter: [values]} over 'weights', 'strategy', 'normalization',
+                'metric', 'N', 'rrf_k' and 'weight_threshold', or a list of
+                configuration dicts.
+            n_workers
+                Number of worker processes; 1 evaluates in this process.
+            early_stopping
+                If True, every configuration is first evaluated on a query sample and
+                stopped there when even its optimistic estimate (mean pushed `z`
+                standard errors towards better) is dominated by the current frontier.
+            sample_size
+                Fraction (or number) of queries used for the early-stopping stage.
+            z
+                Number of standard errors of the optimistic estimate.
+            seed
+                Seed for sampling the early-stopping queries.
+            callback
+                Optional function called with every result as soon as it is evaluated.
+
+        Returns
+        -------
+            pandas.DataFrame
+                One row per configuration with the parameters, mean metrics,
+                `stopped` (evaluated on the sample only) and `pareto` flags.
+        """
+        configs = parameter_grid(grid) if isinstance(grid, dict) else [{**DEFAULT_PARAMETERS, **c} for c in grid]
+        groups = {}
+        for config in configs:
+            key = tuple(
+                (name, repr(value)) for name, value in sorted(config.items()) if name != "weight_threshold"
+            )
+            groups.setdefault(key, []).append(config)
+        groups = list(groups.values())
+
+        sample_rows = None
+        if early_stopping:
+            n_queries = len(self.query_ids)
+            size = int(sample_size * n_queries) if sample_size < 1 else int(sample_size)
+            rng = np.random.default_rng(seed)
+            sample_rows = np.sort(rng.choice(n_queries, max(min(size, n_queries), 2), replace=False))
+
+        state = self._state(configs)
+        self.frontier = ParetoFrontier(self.objectives)
+        results = []
+
+        def collect(group_results):
+            for result in group_results:
+                if not result["stopped"]:
+                    self.frontier.add(result)
+                results.append(result)
+                if callback is not None:
+                    callback(result)
+
+        # Groups are dispatched in waves so early stopping sees the frontier so far
+        wave_size = max(n_workers, 1) * 2
+        pool = Pool(n_workers, initializer=_init_worker, initargs=(state,)) if n_workers > 1 else None
+        if pool is None:
+            _init_worker(state)
+        try:
+            for start in range(0, len(groups), wave_size):
+                tasks = [
+                    (group, sample_rows, list(self.frontier.results), self.objectives, z)
+                    for group in groups[start : start + wave_size]
+                ]
+                for group_results in pool.imap(_run_group, tasks) if pool else map(_run_group, tasks):
+                    collect(group_results)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        frame = pd.DataFrame(results)
+        frontier_ids = {id(r) for r in self.frontier.results}
+        frame["pareto"] = [id(r) in frontier_ids for r in results]
+        return frame
+
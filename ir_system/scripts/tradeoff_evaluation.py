@@ -1,11 +1,17 @@
 from scripts.evaluation_metrics import (
     beyond_accuracy_metrics,
     evaluate_metrics,
+    retrieve_rows,
     run_evaluations,
 )
+from scripts.instrumentation import timed
+from scripts.metric_kernels import batch_beyond_accuracy, evaluate_retrieved
+from scripts.relevance_computation import TagIndex
+import numpy as np
 import pandas as pd
 
 
+@timed()
 def evaluate_tradeoffs(
     query_indices,
     datasets,
@@ -14,6 +20,7 @@ def evaluate_tradeoffs(
     beyond_tags_column,
     beyond_popularity_column,
     N=10,
+    neighbour_graphs=None,
 ):
     """
     Evaluate trade-offs between NDCG and beyond-accuracy metrics for multiple IR systems.
@@ -34,6 +41,9 @@ def evaluate_tradeoffs(
             Name of the column containing popularity scores.
         N
             Number of top results to evaluate.
+        neighbour_graphs
+            Optional mapping of system name -> {similarity metric: NeighbourGraph}.
+            Systems with graphs read their rankings from them.
 
     Returns
     -------
@@ -47,6 +57,8 @@ def evaluate_tradeoffs(
         dataset = datasets[system_name]
 
         isRandomBaseline = feature_columns is None
+        tag_index = TagIndex.from_dataset(dataset)
+        system_graphs = (neighbour_graphs or {}).get(system_name, {})
         if isRandomBaseline:
             ndcg_sum = 0
             precision_sum = 0
@@ -54,7 +66,7 @@ def evaluate_tradeoffs(
             for query_index in query_indices:
                 query_song = dataset.iloc[query_index]
                 eval_metrics = evaluate_metrics(
-                    query_song, dataset, feature_columns, None, N=N
+                    query_song, dataset, feature_columns, None, N=N, tag_index=tag_index
                 )
                 ndcg_sum += eval_metrics[f"NDCG@N"]
                 precision_sum += eval_metrics[f"Precision@N"]
@@ -93,7 +105,13 @@ def evaluate_tradeoffs(
             for metric in beyond_metrics:
                 # Evaluate NDCG
                 average_metric_scores = run_evaluations(
-                    query_indices, dataset, feature_columns, [metric], N=N
+                    query_indices,
+                    dataset,
+                    feature_columns,
+                    [metric],
+                    N=N,
+                    tag_index=tag_index,
+                    neighbour_graphs=system_graphs,
                 )
                 ndcg = average_metric_scores[metric][f"NDCG@N"]
                 precision = average_metric_scores[metric][f"Precision@N"]
@@ -109,6 +127,7 @@ def evaluate_tradeoffs(
                     popularity_column=beyond_popularity_column,
                     N=N,
                     weight_threshold=60,
+                    neighbour_graphs=system_graphs,
                 )
 
                 # Extract Diversity and Popularity
@@ -131,3 +150,98 @@ def evaluate_tradeoffs(
 
     # Convert results to a DataFrame
     return pd.DataFrame(results)
+
+
+@timed()
+def evaluate_tradeoffs_thresholds(
+    query_indices,
+    datasets,
+    systems,
+    beyond_metrics,
+    beyond_tags_column,
+    beyond_popularity_column,
+    weight_thresholds,
+    N=10,
+    neighbour_graphs=None,
+    feature_matrices=None,
+):
+    """
+    Evaluate trade-offs between NDCG and beyond-accuracy metrics for several tag weight
+    thresholds, retrieving once per system and metric.
+
+    Args
+    ----
+        query_indices
+            List of indices for query songs in the datasets.
+        datasets
+            Dictionary mapping system names to their respective datasets.
+        systems
+            Dictionary mapping system names to their feature columns (None for random).
+        beyond_metrics
+            List of similarity metrics to evaluate (e.g., ['cosine', 'euclidean']).
+        beyond_tags_column
+            Name of the column containing tags for diversity.
+        beyond_popularity_column
+            Name of the column containing popularity scores.
+        weight_thresholds
+            List of thresholds for tag weights to calculate diversity.
+        N
+            Number of top results to evaluate.
+        neighbour_graphs
+            Optional mapping of system name -> {similarity metric: NeighbourGraph}.
+        feature_matrices
+            Optional mapping of system name -> feature matrix aligned with its dataset
+            (e.g., the sparse TF-IDF matrix of `load_tfidf_sparse`), used instead of
+            the feature columns.
+
+    Returns
+    -------
+        pandas.DataFrame
+            One row per system, metric and threshold with NDCG, Coverage, Diversity and Popularity.
+    """
+    results = []
+    query_indices = np.asarray(query_indices)
+
+    for system_name, feature_columns in systems.items():
+        dataset = datasets[system_name]
+        # Relevance always comes from '(tag, weight)', as in `evaluate_tradeoffs`
+        tag_index = TagIndex.from_dataset(dataset)
+        if beyond_tags_column == "(tag, weight)":
+            diversity_weights = tag_index.weights
+        else:
+            diversity_weights = TagIndex.from_dataset(dataset, beyond_tags_column).weights
+        system_graphs = (neighbour_graphs or {}).get(system_name, {})
+        metrics = ["random"] if feature_columns is None else beyond_metrics
+
+        for metric in metrics:
+            rows = retrieve_rows(
+                query_indices,
+                dataset,
+                feature_columns,
+                metric,
+                N,
+                system_graphs.get(metric),
+                (feature_matrices or {}).get(system_name),
+            )
+            ids = dataset["id"].values
+            ndcg = evaluate_retrieved(tag_index, ids[query_indices], ids[rows], k=N)["NDCG@N"].mean()
+            beyond_scores = batch_beyond_accuracy(
+                rows,
+                diversity_weights,
+                dataset[beyond_popularity_column].values,
+                weight_thresholds,
+            )
+            for threshold in weight_thresholds:
+                results.append(
+                    {
+                        "System": system_name,
+                        "Metric": metric,
+                        "Threshold": threshold,
+                        f"NDCG@N": ndcg,
+                        f"Cov@N": beyond_scores[threshold][f"Cov@N"],
+                        f"Div@N": beyond_scores[threshold][f"Div@N"],
+                        f"AvgPop@N": beyond_scores[threshold][f"AvgPop@N"],
+                    }
+                )
+
+    return pd.DataFrame(results)
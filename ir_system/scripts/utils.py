@@ -1,6 +1,48 @@
 import ast
+import os
+import pickle
+import time
+import tracemalloc
+
+import numpy as np
 import pandas as pd
 
+from scripts.embedding_store import read_sparse_tsv
+from scripts.relevance_computation import TagIndex
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+DEFAULT_DATASET_DIR = "../dataset"
+DEFAULT_PARSED_CACHE_DIR = "../dataset/cache/parsed"
+
+# Files joined by `load_dataset_with_info`, in merge order (the first one gives the row order)
+DATASET_FILES = [
+    "id_genres_mmsr.tsv",
+    "id_information_mmsr.tsv",
+    "id_metadata_mmsr.tsv",
+    "id_tags_dict.tsv",
+    "id_total_listens.tsv",
+    "id_url_mmsr.tsv",
+]
+RENAMED_COLUMNS = {"key": "song_key"}
+# Only text columns are declared. Numeric columns are left to read_csv's inference, as
+# in `load_dataset_with_info`: int64 when complete (e.g., release, duration_ms,
+# total_listens), float64 when values are missing (e.g., popularity, key, mode)
+COLUMN_DTYPES = {
+    "id": str,
+    "artist": str,
+    "song": str,
+    "album_name": str,
+    "spotify_id": str,
+    "url": str,
+}
+PARSED_COLUMNS = ("genre", "(tag, weight)")
+
 
 def load_dataset_with_info():
     """
@@ -71,3 +113,309 @@ def load_and_merge_tfidf_data(dataset, tfidf_embeddings_path):
     tfidf_columns = tfidf_data.columns[1:]
     merged_tfidf_dataset = pd.merge(dataset, tfidf_data, on="id")
     return merged_tfidf_dataset, tfidf_columns
+
+
+def load_tfidf_sparse(dataset, tfidf_embeddings_path, chunksize=2000):
+    """
+    Load TF-IDF embeddings as a CSR matrix aligned with the main dataset.
+
+    Sparse counterpart of `load_and_merge_tfidf_data`: the rows are the same (songs of
+    `dataset` with TF-IDF embeddings, in dataset order), but the vocabulary is not
+    merged in as dense columns. Pass the matrix to `top_k_by_similarity`,
+    `build_neighbour_graph` or `evaluate_tradeoffs_thresholds(feature_matrices=...)`.
+
+    Args
+    ----
+        dataset: pd.DataFrame
+            The main dataset containing song information.
+        tfidf_embeddings_path: str
+            Path to the TF-IDF embeddings file.
+        chunksize: int
+            Number of TSV rows parsed per chunk.
+
+    Returns
+    -------
+        tuple
+            (dataset rows with TF-IDF embeddings, CSR matrix in the same row order,
+            TF-IDF column names)
+    """
+    ids, matrix, columns = read_sparse_tsv(tfidf_embeddings_path, ["song"], chunksize)
+    rows = pd.Index(ids).get_indexer(dataset["id"].astype(str))
+    # Duplicate dataset ids are kept, as with pd.merge
+    present = rows >= 0
+    return dataset[present].reset_index(drop=True), matrix[rows[present]], pd.Index(columns)
+
+
+def _file_columns(file_path):
+    """Stripped column names of a TSV, read from its header only."""
+    columns = pd.read_csv(file_path, sep="\t", nrows=0).columns.str.strip()
+    return [RENAMED_COLUMNS.get(column, column) for column in columns]
+
+
+def _iter_projected(file_path, columns, chunksize=None):
+    """Yield only `columns` (plus 'id') of a TSV with explicit dtypes, in chunks if `chunksize` is given."""
+    wanted = {"id"} | {next((k for k, v in RENAMED_COLUMNS.items() if v == c), c) for c in columns}
+    dtypes = {column: dtype for column, dtype in COLUMN_DTYPES.items() if column in wanted}
+    reader = pd.read_csv(
+        file_path,
+        sep="\t",
+        usecols=lambda column: column.strip() in wanted,
+        dtype=dtypes,
+        chunksize=chunksize,
+    )
+    for chunk in [reader] if chunksize is None else reader:
+        chunk.columns = chunk.columns.str.strip()
+        yield chunk.rename(columns=RENAMED_COLUMNS)
+
+
+def _read_projected(file_path, columns, chunksize=None):
+    """Read only `columns` (plus 'id') of a TSV with explicit dtypes, optionally in chunks."""
+    parts = list(_iter_projected(file_path, columns, chunksize))
+    return pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+
+
+def _cached_parse(file_path, column, cache_dir, chunksize=None):
+    """
+    Parse a literal column ('genre' or '(tag, weight)') once and cache the compact form.
+
+    Tags are cached as a TagIndex (CSR), genres as a pickled Series of lists. The cache is
+    keyed on the source file's size and modification time.
+    """
+    stat = os.stat(file_path)
+    name = "tags_index" if column == "(tag, weight)" else "genres"
+    cache_path = os.path.join(cache_dir, f"{name}_{stat.st_size}_{int(stat.st_mtime)}.pkl")
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+
+    data = _read_projected(file_path, [column], chunksize)
+    data[column] = data[column].apply(ast.literal_eval)
+    parsed = TagIndex.from_dataset(data, column) if column == "(tag, weight)" else data.drop_duplicates("id").set_index("id")[column]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_path, "wb") as f:
+        pickle.dump(parsed, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return parsed
+
+
+def _tags_as_dicts(tag_index, ids):
+    """Rebuild {tag: weight} dictionaries for `ids` from a TagIndex."""
+    weights = tag_index.weights
+    tags = np.asarray(tag_index.tags, dtype=object)
+    rows = tag_index.rows_for_ids(ids)
+    dicts = []
+    for row in rows:
+        start, end = weights.indptr[row], weights.indptr[row + 1]
+        values = weights.data[start:end]
+        if np.all(values == np.round(values)):
+            values = values.astype(np.int64)
+        dicts.append(dict(zip(tags[weights.indices[start:end]].tolist(), values.tolist())))
+    return dicts
+
+
+def _process_peak_rss_mb():
+    """Peak RSS of the whole process so far (not of one load); None where unavailable."""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_dataset_columns(
+    columns=None,
+    dataset_dir=DEFAULT_DATASET_DIR,
+    cache_dir=DEFAULT_PARSED_CACHE_DIR,
+    chunksize=None,
+    return_tag_index=False,
+    measure_memory=False,
+):
+    """
+    Load only the requested columns of the joined dataset.
+
+    Only the files that hold a requested column are read, with `usecols` and explicit
+    dtypes. 'genre' and '(tag, weight)' are parsed once and cached (see `_cached_parse`).
+    Files are joined on a prebuilt id index instead of chained merges; the rows and their
+    order are the same as `load_dataset_with_info` (ids present in every file, in the
+    order of the genre file).
+
+    A load report is returned in `dataset.attrs["load_report"]`: load time, rows,
+    columns, the process's lifetime peak RSS and, with `measure_memory`, the peak
+    memory allocated by this load (traced with tracemalloc, which slows the load).
+
+    Args
+    ----
+        columns: list or None
+            Columns to load besides 'id' (None for all columns).
+        dataset_dir: str
+            Directory containing the dataset TSV files.
+        cache_dir: str
+            Directory for the parsed tag/genre cache.
+        chunksize: int or None
+            If given, files are read in chunks of this many rows to bound peak memory.
+        return_tag_index: bool
+            Also return the TagIndex (and skip rebuilding tag dictionaries if
+            '(tag, weight)' is not requested).
+        measure_memory: bool
+            Trace the peak memory allocated during this load.
+
+    Returns
+    -------
+        pd.DataFrame or (pd.DataFrame, TagIndex)
+    """
+    start_time = time.perf_counter()
+    was_tracing = tracemalloc.is_tracing()
+    if measure_memory:
+        if was_tracing:
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.start()
+    try:
+        dataset, tag_index = _load_dataset_columns(
+            columns, dataset_dir, cache_dir, chunksize, return_tag_index
+        )
+        peak_traced_mb = tracemalloc.get_traced_memory()[1] / 2**20 if measure_memory else None
+    finally:
+        if measure_memory and not was_tracing:
+            tracemalloc.stop()
+
+    dataset.attrs["load_report"] = {
+        "seconds": time.perf_counter() - start_time,
+        "peak_traced_mb": peak_traced_mb,
+        "process_peak_rss_mb": _process_peak_rss_mb(),
+        "rows": len(dataset),
+        "columns": list(dataset.columns),
+    }
+    if return_tag_index:
+        return dataset, tag_index
+    return dataset
+
+
+def _load_dataset_columns(columns, dataset_dir, cache_dir, chunksize, return_tag_index):
+    file_columns, columns = _requested_columns(columns, dataset_dir)
+
+    # Id index: ids present in every file, in the order of the first file
+    ids = None
+    for file_name in DATASET_FILES:
+        file_ids = _read_projected(os.path.join(dataset_dir, file_name), [], chunksize)["id"]
+        ids = pd.Index(file_ids) if ids is None else ids[ids.isin(file_ids)]
+    ids = ids.drop_duplicates()
+
+    dataset = pd.DataFrame({"id": ids.values})
+    tag_index = None
+    for file_name in DATASET_FILES:
+        file_path = os.path.join(dataset_dir, file_name)
+        for column in file_columns[file_name]:
+            if column == "id" or (column not in columns and not (return_tag_index and column == "(tag, weight)")):
+                continue
+            if column == "(tag, weight)":
+                tag_index = _cached_parse(file_path, column, cache_dir, chunksize)
+                if column in columns:
+                    dataset[column] = _tags_as_dicts(tag_index, dataset["id"].tolist())
+            elif column == "genre":
+                dataset[column] = _cached_parse(file_path, column, cache_dir, chunksize).reindex(ids).values
+        plain = [c for c in file_columns[file_name] if c in columns and c not in PARSED_COLUMNS and c != "id"]
+        if plain:
+            data = _read_projected(file_path, plain, chunksize).drop_duplicates("id").set_index("id")
+            for column in plain:
+                dataset[column] = data[column].reindex(ids).values
+
+    dataset = dataset[["id"] + [c for c in columns if c in dataset.columns]]
+    if return_tag_index and tag_index is not None:
+        tag_index = TagIndex(
+            dataset["id"].values,
+            tag_index.tags,
+            tag_index.weights[tag_index.rows_for_ids(dataset["id"].tolist())],
+            cache_size=tag_index.cache_size,
+        )
+    return dataset, tag_index
+
+
+def _requested_columns(columns, dataset_dir):
+    """Stripped columns of every dataset file and the validated requested columns."""
+    file_columns = {
+        file_name: _file_columns(os.path.join(dataset_dir, file_name)) for file_name in DATASET_FILES
+    }
+    available = [column for names in file_columns.values() for column in names if column != "id"]
+    columns = available if columns is None else list(columns)
+    unknown = set(columns) - set(available)
+    if unknown:
+        raise ValueError(f"Unknown columns: {sorted(unknown)}")
+    return file_columns, columns
+
+
+def iter_dataset_chunks(columns, chunksize=10000, dataset_dir=DEFAULT_DATASET_DIR):
+    """
+    Yield the projected dataset in chunks of at most `chunksize` rows, without ever
+    loading it whole.
+
+    The rows, their order and their values are those of `load_dataset_columns`. The
+    genre file (which gives the row order) is streamed chunk by chunk; the matching
+    rows of the other files are read from their own chunked readers and dropped once
+    joined. Besides the song ids, only about one chunk per file is held in memory
+    when the files list their songs in the same order (rows that arrive early are
+    buffered until their chunk comes up). '(tag, weight)' and 'genre' are parsed per
+    chunk.
+
+    Args
+    ----
+        columns: list or None
+            Columns to load besides 'id' (None for all columns).
+        chunksize: int
+            Number of rows read per chunk from every file.
+        dataset_dir: str
+            Directory containing the dataset TSV files.
+
+    Yields
+    ------
+        pd.DataFrame
+            Consecutive chunks of the joined dataset ('id' plus `columns`).
+    """
+    file_columns, columns = _requested_columns(columns, dataset_dir)
+
+    # Ids present in every file and not yielded yet (only the id columns are read)
+    pending = None
+    for file_name in DATASET_FILES:
+        file_ids = set()
+        for chunk in _iter_projected(os.path.join(dataset_dir, file_name), [], chunksize):
+            file_ids.update(chunk["id"] if pending is None else chunk["id"][chunk["id"].isin(pending)])
+        pending = file_ids
+
+    def projected(file_name):
+        return [c for c in file_columns[file_name] if c in columns and c != "id"]
+
+    primary, others = DATASET_FILES[0], [f for f in DATASET_FILES[1:] if projected(f)]
+    readers = {f: _iter_projected(os.path.join(dataset_dir, f), projected(f), chunksize) for f in others}
+    buffers = {f: pd.DataFrame(columns=projected(f), index=pd.Index([], name="id")) for f in others}
+
+    def take(file_name, ids):
+        # Read ahead until every id of the chunk is buffered. The first row of an id wins:
+        # later rows are either already buffered or of an id that was already yielded
+        buffer = buffers[file_name]
+        while not ids.isin(buffer.index).all():
+            chunk = next(readers[file_name], None)
+            if chunk is None:
+                break
+            chunk = chunk[chunk["id"].isin(pending) & ~chunk["id"].isin(buffer.index)].drop_duplicates("id")
+            parts = [frame for frame in (buffer, chunk.set_index("id")) if len(frame)]
+            buffer = pd.concat(parts) if parts else buffer
+        buffers[file_name] = buffer.drop(ids)
+        return buffer.loc[ids]
+
+    offset = 0
+    for chunk in _iter_projected(os.path.join(dataset_dir, primary), projected(primary), chunksize):
+        chunk = chunk[chunk["id"].isin(pending)].drop_duplicates("id")
+        if chunk.empty:
+            continue
+        ids = pd.Index(chunk["id"])
+        data = chunk.set_index("id")
+        for file_name in others:
+            data = data.join(take(file_name, ids))
+        pending.difference_update(ids)
+        for column in PARSED_COLUMNS:
+            if column in data.columns:
+                data[column] = data[column].apply(ast.literal_eval)
+
+        data = data.reset_index()[["id"] + columns]
+        data.index = pd.RangeIndex(offset, offset + len(data))
+        offset += len(data)
+        yield data
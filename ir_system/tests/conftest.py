@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+# Tests import the notebook helpers the way the notebooks do: `from scripts.x import ...`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import make_catalogue  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def catalogue():
+    """Small synthetic MMSR-shaped dataset and its feature columns."""
+    return make_catalogue(n_songs=400, dim=16, n_tags=60, mean_tags=5, seed=7)
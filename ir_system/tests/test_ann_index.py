@@ -0,0 +1,82 @@
+import json
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from scripts.ann_index import ExactIndex, IVFIndex, build_index
+from scripts.retrieval_by_similarity import top_k_positions
+
+
+def _matrix(catalogue):
+    dataset, feature_columns = catalogue
+    return dataset[feature_columns].values
+
+
+def _search_per_query(index, query_rows, k, exclude_self=True):
+    """The per-query IVF search: score the members of the probed lists one query at a time."""
+    matrix = index.prepared["matrix"]
+    squared_norms = index.prepared["squared_norms"]
+    indices = np.full((len(query_rows), k), -1)
+    scores = np.full((len(query_rows), k), -np.inf)
+    for i, row in enumerate(query_rows):
+        probed = index._probe(matrix[[row]])[0]
+        candidates = np.concatenate([index.list_order[index.list_offsets[l] : index.list_offsets[l + 1]] for l in probed])
+        if exclude_self:
+            candidates = candidates[candidates != row]
+        products = matrix[candidates] @ matrix[row]
+        if index.metric == "cosine":
+            candidate_scores = products
+        else:
+            candidate_scores = 1 / (1 + np.sqrt(np.maximum(squared_norms[row] - 2 * products + squared_norms[candidates], 0)))
+        top = top_k_positions(candidate_scores, k)
+        indices[i, : len(top)] = candidates[top]
+        scores[i, : len(top)] = candidate_scores[top]
+    return indices, scores
+
+
+@pytest.mark.parametrize("metric", ["cosine", "euclidean"])
+@pytest.mark.parametrize("n_probe", [1, 3])
+def test_batched_search_matches_the_per_query_search(catalogue, metric, n_probe):
+    index = IVFIndex(metric, n_lists=16, n_probe=n_probe).build(_matrix(catalogue))
+    query_rows = np.arange(0, 400, 3)
+
+    # A small block forces several batches
+    indices, scores = index.search(query_rows, k=10, max_block=2000)
+    expected_indices, expected_scores = _search_per_query(index, query_rows, 10)
+
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-6)
+
+
+def test_probing_every_list_is_exact(catalogue):
+    matrix = _matrix(catalogue)
+    query_rows = np.arange(0, 400, 7)
+    ivf, _ = IVFIndex("cosine", n_lists=8, n_probe=8).build(matrix).search(query_rows, k=10)
+    exact, _ = ExactIndex("cosine").build(matrix).search(query_rows, k=10)
+    np.testing.assert_array_equal(ivf, exact)
+
+
+def test_short_lists_are_padded(catalogue):
+    index = IVFIndex("cosine", n_lists=64, n_probe=1).build(_matrix(catalogue))
+    indices, scores = index.search(np.arange(400), k=50)
+    missing = indices < 0
+    assert missing.any()
+    assert np.all(np.isneginf(scores[missing]))
+    assert not np.any(indices == np.arange(400)[:, None])
+
+
+def test_saved_index_records_the_effective_number_of_lists(tmp_path, catalogue):
+    matrix = _matrix(catalogue)[:20]
+    index = IVFIndex("cosine", n_lists=256, n_probe=4).build(matrix)
+    index.save(str(tmp_path))
+
+    assert json.loads((tmp_path / "params.json").read_text())["n_lists"] == 20
+    loaded = IVFIndex.load(str(tmp_path), matrix)
+    np.testing.assert_array_equal(loaded.search(np.arange(20), k=5)[0], index.search(np.arange(20), k=5)[0])
+
+
+def test_sparse_feature_spaces_warn_and_fall_back_to_exact_search(catalogue):
+    with pytest.warns(UserWarning, match="exact search"):
+        index = build_index("BERT", sparse.csr_matrix(_matrix(catalogue)))
+    assert isinstance(index, ExactIndex)
@@ -0,0 +1,71 @@
+import json
+
+import numpy as np
+import pytest
+
+from scripts.binary_export import (
+    binary_to_precomputed_json,
+    build_id_dictionary,
+    export_precomputed_binary,
+    export_precomputed_json_file,
+    read_query_row,
+)
+
+
+def _system(n_queries=30, n_songs=100, k=10, seed=3, with_scores=False):
+    rng = np.random.default_rng(seed)
+    songs = [f"song{i:03d}" for i in range(n_songs)]
+    content = {}
+    for query in rng.permutation(n_songs)[:n_queries]:
+        # Ragged rows exercise the -1 padding
+        retrieved = [songs[i] for i in rng.choice(n_songs, size=rng.integers(1, k + 1), replace=False)]
+        if with_scores:
+            content[songs[query]] = dict(zip(retrieved, np.sort(rng.random(len(retrieved)))[::-1].tolist()))
+        else:
+            content[songs[query]] = retrieved
+    return {"metadata": {"system": "synthetic", "N": k}, "content": content}
+
+
+def test_json_round_trip(tmp_path):
+    data = _system()
+    json_path = tmp_path / "system.json"
+    json_path.write_text(json.dumps(data))
+
+    header = export_precomputed_json_file(str(json_path))
+
+    assert header["queries_are_dictionary"]
+    restored = binary_to_precomputed_json(str(tmp_path / "system.bin.json"))
+    assert restored == data
+    assert list(restored["content"]) == list(data["content"])
+
+
+def test_scores_round_trip_at_float16(tmp_path):
+    data = _system(with_scores=True)
+    ids = build_id_dictionary(data["content"])
+    export_precomputed_binary(data, str(tmp_path / "system.bin"), ids)
+
+    restored = binary_to_precomputed_json(str(tmp_path / "system.bin.json"), ids=ids)
+
+    assert restored["metadata"] == data["metadata"]
+    for query_id, retrieved in data["content"].items():
+        assert list(restored["content"][query_id]) == list(retrieved)
+        np.testing.assert_allclose(
+            list(restored["content"][query_id].values()), list(retrieved.values()), rtol=1e-3
+        )
+
+
+@pytest.mark.parametrize("with_scores", [False, True])
+def test_single_rows_match_the_content(tmp_path, with_scores):
+    first, second = _system(seed=3, with_scores=with_scores), _system(seed=4, with_scores=with_scores)
+    # A dictionary shared with another system: query rows are no longer dictionary indices
+    ids = build_id_dictionary(first["content"], second["content"])
+    header = export_precomputed_binary(second, str(tmp_path / "second.bin"), ids)
+    assert not header["queries_are_dictionary"]
+
+    for query_id, retrieved in second["content"].items():
+        row, scores = read_query_row(str(tmp_path / "second.bin.json"), query_id, ids=ids)
+        assert row == list(retrieved)
+        if with_scores:
+            np.testing.assert_allclose(scores, list(retrieved.values()), rtol=1e-3)
+        else:
+            assert scores is None
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from scripts.embedding_store import (
+    MANIFEST_FILE,
+    convert_all_feature_spaces,
+    convert_tsv_to_store,
+    has_feature_space,
+    load_feature_space,
+)
+
+
+def _write_tsv(path, n_rows=25, dim=4, seed=0, with_song=True):
+    values = np.random.default_rng(seed).random((n_rows, dim), dtype=np.float32)
+    lines = ["id\t" + ("song\t" if with_song else "") + "\t".join(f"f{i}" for i in range(dim))]
+    for row in range(n_rows):
+        # A quoted title spanning two lines: the raw line count is not the row count
+        song = ('"first line\nsecond line"' if row % 7 == 0 else f"title {row}") + "\t" if with_song else ""
+        lines.append(f"song{row:03d}\t{song}" + "\t".join(repr(float(v)) for v in values[row]))
+    path.write_text("\n".join(lines) + "\n")
+    return values
+
+
+@pytest.mark.parametrize("sparse_format", [False, True])
+def test_store_matches_the_tsv(tmp_path, sparse_format):
+    values = _write_tsv(tmp_path / "features.tsv")
+    manifest = convert_tsv_to_store(
+        str(tmp_path / "features.tsv"), "Test", str(tmp_path / "store"), ["song"], 4, sparse_format
+    )
+
+    feature_space = load_feature_space("Test", str(tmp_path / "store"))
+    assert manifest["n_rows"] == len(values)
+    assert feature_space.ids.tolist() == [f"song{row:03d}" for row in range(len(values))]
+    matrix = feature_space.matrix.toarray() if sparse_format else np.asarray(feature_space.matrix)
+    np.testing.assert_array_equal(matrix, values)
+    assert not [p.name for p in (tmp_path / "store" / "Test").iterdir() if p.suffix in (".tmp", ".raw")]
+
+
+def test_failed_conversion_leaves_no_manifest(tmp_path):
+    _write_tsv(tmp_path / "features.tsv")
+    store_dir = str(tmp_path / "store")
+    convert_tsv_to_store(str(tmp_path / "features.tsv"), "Test", store_dir, ["song"])
+
+    (tmp_path / "features.tsv").write_text("id\tsong\tf0\nsong000\ttitle\tnot a number\n")
+    with pytest.raises(ValueError):
+        convert_tsv_to_store(str(tmp_path / "features.tsv"), "Test", store_dir, ["song"])
+
+    assert not has_feature_space("Test", store_dir)
+    assert not (tmp_path / "store" / "Test" / MANIFEST_FILE).exists()
+
+
+def test_convert_all_reports_skipped_feature_spaces(tmp_path, capsys):
+    _write_tsv(tmp_path / "id_lyrics_bert_mmsr.tsv", with_song=False)
+    summary = convert_all_feature_spaces(str(tmp_path), str(tmp_path / "store"), ["BERT", "MFCC"])
+
+    assert list(summary["converted"]) == ["BERT"]
+    assert list(summary["skipped"]) == ["MFCC"]
+    assert capsys.readouterr().out == ""
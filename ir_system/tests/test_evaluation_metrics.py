@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from scripts.evaluation_metrics import evaluate_metrics, run_evaluations
+from scripts.relevance_computation import TagIndex
+
+
+def _per_query_average(query_indices, dataset, feature_columns, metrics, N, tag_index):
+    results = {}
+    for metric in metrics:
+        rows = [
+            evaluate_metrics(dataset.iloc[q], dataset, feature_columns, metric, N, tag_index=tag_index)
+            for q in query_indices
+        ]
+        results[metric] = {key: np.mean([row[key] for row in rows]) for key in rows[0]}
+    return results
+
+
+@pytest.mark.parametrize("use_features", [True, False])
+def test_run_evaluations_matches_per_query_evaluation(catalogue, use_features):
+    dataset, feature_columns = catalogue
+    feature_columns = feature_columns if use_features else None
+    metrics = ["cosine", "euclidean"] if use_features else ["random"]
+    tag_index = TagIndex.from_dataset(dataset)
+    query_indices = np.arange(0, len(dataset), 9)
+
+    batched = run_evaluations(query_indices, dataset, feature_columns, metrics, N=10, tag_index=tag_index)
+    expected = _per_query_average(query_indices, dataset, feature_columns, metrics, 10, tag_index)
+
+    for metric in metrics:
+        assert list(batched[metric]) == list(expected[metric])
+        for key, value in expected[metric].items():
+            assert batched[metric][key] == pytest.approx(value, abs=1e-12)
@@ -0,0 +1,36 @@
+from scripts import instrumentation
+from scripts.evaluation_metrics import evaluate_metrics
+
+
+def test_only_stages_are_timed(catalogue):
+    dataset, feature_columns = catalogue
+    with instrumentation.instrumented_run() as stage_report:
+        for query in range(0, 40, 10):
+            evaluate_metrics(dataset.iloc[query], dataset, feature_columns, "cosine", 10)
+        stages = stage_report().set_index("stage")["calls"]
+
+    assert stages["evaluation_metrics.evaluate_metrics"] == 4
+    assert stages["evaluate_metrics.metrics"] == 4
+    # Per-item helpers run thousands of times per query and are not timed individually
+    assert not any(
+        stage.endswith(("compute_weighted_jaccard", "precision_at_k", "recall_at_k", "ndcg_at_k", "mean_reciprocal_rank"))
+        for stage in stages.index
+    )
+
+
+def test_recordings_are_taken_and_merged():
+    instrumentation.reset()
+    instrumentation.enable()
+    try:
+        with instrumentation.timer("worker.stage"):
+            instrumentation.count("worker.items", 3)
+        taken = instrumentation.take_recording()
+        assert instrumentation.report().empty
+
+        instrumentation.merge_recording(taken)
+        instrumentation.merge_recording(taken)
+        assert instrumentation.report().set_index("stage").loc["worker.stage", "calls"] == 2
+        assert instrumentation.counters() == {"worker.items": 6}
+    finally:
+        instrumentation.disable()
+        instrumentation.reset()
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from scripts.evaluation_metrics import mean_reciprocal_rank, ndcg_at_k, precision_at_k, recall_at_k
+from scripts.metric_kernels import batch_metrics, batch_relevance, evaluate_retrieved
+from scripts.relevance_computation import TagIndex
+
+
+def test_batch_metrics_match_the_per_query_metrics():
+    rng = np.random.default_rng(0)
+    k = 10
+    grades = np.where(rng.random((200, k)) < 0.3, rng.random((200, k)), 0.0)
+    grades[::17] = 0.0
+    n_relevant = (grades > 0).sum(axis=1) + rng.integers(0, 5, 200)
+    batched = batch_metrics(grades, n_relevant, k=k)
+
+    for i, row in enumerate(grades):
+        retrieved = list(range(k))
+        relevant = [position for position in retrieved if row[position] > 0]
+        relevant += [f"unretrieved{j}" for j in range(n_relevant[i] - len(relevant))]
+        assert batched["Precision@N"][i] == pytest.approx(precision_at_k(retrieved, relevant, k))
+        assert batched["Recall@N"][i] == pytest.approx(recall_at_k(retrieved, relevant, k))
+        assert batched["NDCG@N"][i] == pytest.approx(ndcg_at_k(retrieved, relevant, k))
+        assert batched["MRR"][i] == pytest.approx(mean_reciprocal_rank(retrieved, relevant))
+
+
+def test_graded_mode_looks_up_each_query_once(catalogue):
+    dataset, _ = catalogue
+    tag_index = TagIndex.from_dataset(dataset)
+    tag_index.cache_size = 0
+    lookups = []
+    relevance_for_id = tag_index.relevance_for_id
+    tag_index.relevance_for_id = lambda song_id: lookups.append(song_id) or relevance_for_id(song_id)
+
+    ids = dataset["id"].values
+    query_ids = ids[:20]
+    evaluate_retrieved(tag_index, query_ids, ids[20:220].reshape(20, 10), ndcg_mode="graded")
+    assert lookups == list(query_ids)
+
+
+def test_missing_ids_are_missing_results(catalogue):
+    dataset, _ = catalogue
+    tag_index = TagIndex.from_dataset(dataset)
+    ids = dataset["id"].values
+    retrieved = ids[10:40].reshape(3, 10).astype(object)
+    retrieved[0, 5:] = None
+    retrieved[1, :] = np.nan
+
+    grades, n_relevant = batch_relevance(tag_index, [ids[0], ids[1], np.nan], retrieved)
+    assert np.isnan(grades[0, 5:]).all() and not np.isnan(grades[0, :5]).any()
+    assert np.isnan(grades[1]).all() and np.isnan(grades[2]).all()
+    assert n_relevant[2] == 0
+
+    metrics = evaluate_retrieved(tag_index, [ids[0], ids[1], np.nan], retrieved)
+    for key in ("Precision@N", "Recall@N", "NDCG@N", "MRR"):
+        assert metrics[key][1] == metrics[key][2] == 0
+
+
+def test_unknown_ids_are_rejected(catalogue):
+    dataset, _ = catalogue
+    tag_index = TagIndex.from_dataset(dataset)
+    ids = dataset["id"].values
+    with pytest.raises(KeyError, match="unknown"):
+        batch_relevance(tag_index, ["unknown"], ids[:10].reshape(1, 10))
+    with pytest.raises(KeyError, match="unknown"):
+        batch_relevance(tag_index, ids[:1], np.array([["unknown"] + list(ids[1:10])], dtype=object))
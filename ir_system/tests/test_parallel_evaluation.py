@@ -0,0 +1,117 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from benchmarks.synthetic import make_tags
+from scripts import instrumentation, parallel_evaluation
+from scripts.evaluation_metrics import retrieve_rows, run_evaluations
+from scripts.metric_kernels import evaluate_retrieved, mean_metrics
+from scripts.parallel_evaluation import evaluate_tradeoffs_parallel, run_evaluations_parallel
+from scripts.relevance_computation import TagIndex
+from scripts.tradeoff_evaluation import evaluate_tradeoffs
+
+
+@pytest.fixture(scope="module")
+def two_tag_columns(catalogue):
+    """The catalogue with a second, different tags column for diversity."""
+    dataset, feature_columns = catalogue
+    dataset = dataset.copy()
+    dataset["diversity tags"] = make_tags(len(dataset), n_tags=40, mean_tags=8, seed=11)
+    return dataset, feature_columns
+
+
+def test_run_evaluations_parallel_matches_serial(catalogue):
+    dataset, feature_columns = catalogue
+    query_indices = np.arange(0, len(dataset), 5)
+    serial = run_evaluations(query_indices, dataset, feature_columns, ["cosine", "euclidean"], N=10)
+    parallel = run_evaluations_parallel(
+        query_indices, dataset, feature_columns, ["cosine", "euclidean"], N=10, n_workers=2, shard_size=16,
+        progress_callback=lambda *args: None,
+    )
+    for metric in serial:
+        assert parallel[metric] == pytest.approx(serial[metric], abs=1e-12)
+
+
+def test_evaluate_tradeoffs_parallel_matches_serial(two_tag_columns):
+    dataset, feature_columns = two_tag_columns
+    query_indices = np.arange(0, len(dataset), 8)
+    datasets = {"features": dataset, "random": dataset}
+    systems = {"features": feature_columns, "random": None}
+    arguments = (query_indices, datasets, systems, ["cosine"], "diversity tags", "popularity")
+
+    serial = evaluate_tradeoffs(*arguments, N=10)
+    parallel = evaluate_tradeoffs_parallel(
+        *arguments, N=10, n_workers=2, shard_size=16, progress_callback=lambda *args: None
+    )
+    assert parallel[["System", "Metric"]].values.tolist() == serial[["System", "Metric"]].values.tolist()
+    for key in ("Precision@N", "Recall@N", "NDCG@N", "Div@N", "AvgPop@N"):
+        np.testing.assert_allclose(parallel[key].values, serial[key].values, rtol=1e-12, err_msg=key)
+
+
+def test_sparse_feature_matrix_is_shared(catalogue):
+    dataset, _ = catalogue
+    tfidf = sparse.random(len(dataset), 200, density=0.05, format="csr", random_state=3)
+    query_indices = np.arange(0, len(dataset), 5)
+    ids = dataset["id"].values
+    tag_index = TagIndex.from_dataset(dataset)
+
+    parallel = run_evaluations_parallel(
+        query_indices, dataset, [], ["cosine"], N=10, n_workers=2, shard_size=16,
+        progress_callback=lambda *args: None, feature_matrix=tfidf,
+    )
+    rows = retrieve_rows(query_indices, dataset, [], "cosine", 10, feature_matrix=tfidf)
+    serial = mean_metrics(evaluate_retrieved(tag_index, ids[query_indices], ids[rows], k=10))
+    assert parallel["cosine"] == pytest.approx(serial, abs=1e-12)
+
+
+def test_shared_memory_is_released_when_the_pool_fails(catalogue, monkeypatch):
+    dataset, feature_columns = catalogue
+    names = []
+    original = parallel_evaluation.SharedArray.__init__
+
+    def tracked(self, array):
+        original(self, array)
+        names.append(self.spec[0])
+
+    def failing_pool(*args, **kwargs):
+        raise OSError("no processes")
+
+    monkeypatch.setattr(parallel_evaluation.SharedArray, "__init__", tracked)
+    monkeypatch.setattr(parallel_evaluation, "Pool", failing_pool)
+    with pytest.raises(OSError, match="no processes"):
+        parallel_evaluation.ShardedEvaluator(dataset, feature_columns, ["cosine", "euclidean"], n_workers=2)
+
+    assert len(names) == 4
+    for name in names:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+
+def test_worker_timings_are_merged_into_the_parent(catalogue):
+    dataset, feature_columns = catalogue
+    query_indices = np.arange(0, len(dataset), 5)
+    with instrumentation.instrumented_run() as stage_report:
+        run_evaluations_parallel(
+            query_indices, dataset, feature_columns, ["cosine", "euclidean"], N=10, n_workers=2, shard_size=16,
+            progress_callback=lambda *args: None,
+        )
+        counters = instrumentation.counters()
+        stages = stage_report().set_index("stage")["calls"]
+
+    n_shards = -(-len(query_indices) // 16)
+    assert counters["evaluate_metrics.queries"] == 2 * len(query_indices)
+    assert stages["evaluate_shard.retrieval"] == 2 * n_shards
+    assert stages["retrieval_by_similarity.top_k_by_similarity"] == 2 * n_shards
+
+
+def test_workers_record_nothing_while_disabled(catalogue):
+    dataset, feature_columns = catalogue
+    instrumentation.reset()
+    run_evaluations_parallel(
+        np.arange(0, len(dataset), 5), dataset, feature_columns, ["cosine"], N=10, n_workers=2,
+        progress_callback=lambda *args: None,
+    )
+    assert instrumentation.report().empty
+
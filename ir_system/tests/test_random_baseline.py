@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from scripts.random_baseline import random_baseline, random_baseline_ids, random_baseline_rows
+
+
+def test_lists_do_not_depend_on_the_batch():
+    rows = np.arange(300)
+    indices, scores = random_baseline_rows(rows, 300, N=10, seed=5)
+
+    order = np.random.default_rng(0).permutation(300)
+    shuffled, _ = random_baseline_rows(rows[order], 300, N=10, seed=5)
+    np.testing.assert_array_equal(shuffled, indices[order])
+
+    for start in range(0, 300, 37):
+        shard, _ = random_baseline_rows(rows[start : start + 37], 300, N=10, seed=5)
+        np.testing.assert_array_equal(shard, indices[start : start + 37])
+
+    np.testing.assert_array_equal(scores, np.broadcast_to(-np.arange(10.0), scores.shape))
+
+
+def test_lists_are_distinct_and_exclude_the_query():
+    # N close to the catalogue size forces many redraws
+    indices, _ = random_baseline_rows(np.arange(50), 50, N=45, seed=1)
+    assert np.all(indices != np.arange(50)[:, None])
+    assert all(len(set(row)) == 45 for row in indices.tolist())
+
+    outside, _ = random_baseline_rows([-1], 50, N=50, seed=1)
+    assert sorted(outside[0]) == list(range(50))
+
+
+def test_seed_changes_the_lists():
+    first, _ = random_baseline_rows(np.arange(100), 100, N=10, seed=1)
+    second, _ = random_baseline_rows(np.arange(100), 100, N=10, seed=2)
+    assert not np.array_equal(first, second)
+
+
+def test_per_query_baseline_matches_the_batch(catalogue):
+    dataset, _ = catalogue
+    ids = dataset["id"].values
+    batch, _ = random_baseline_ids(ids[::41], ids, N=10, seed=9)
+    for row, query in enumerate(range(0, len(dataset), 41)):
+        single = random_baseline(dataset.iloc[query], dataset, random_state=9, N=10)
+        assert single["id"].tolist() == batch[row].tolist()
+
+
+def test_too_few_songs_is_rejected():
+    with pytest.raises(ValueError):
+        random_baseline_rows([0], 10, N=10)
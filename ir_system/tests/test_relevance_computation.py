@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from scripts.evaluation_metrics import evaluate_metrics
+from scripts.relevance_computation import TagIndex, compute_weighted_jaccard
+
+
+def test_tag_index_matches_weighted_jaccard(catalogue):
+    dataset, _ = catalogue
+    tag_index = TagIndex.from_dataset(dataset)
+    tags = dataset["(tag, weight)"].tolist()
+
+    for query in range(0, len(dataset), 23):
+        expected = np.array([compute_weighted_jaccard(tags[query], candidate) for candidate in tags])
+        relevant_ids, scores = tag_index.relevance_for_id(dataset["id"].iloc[query])
+        assert relevant_ids.tolist() == dataset["id"].values[expected > 0].tolist()
+        np.testing.assert_allclose(scores, expected[expected > 0], rtol=1e-12)
+
+        candidates = np.arange(len(dataset))
+        pairwise = tag_index.pairwise_relevance(np.full(len(dataset), query), candidates)
+        np.testing.assert_allclose(pairwise, expected, rtol=1e-12, atol=1e-15)
+
+
+def test_evaluate_metrics_is_the_same_with_and_without_the_index(catalogue):
+    dataset, feature_columns = catalogue
+    tag_index = TagIndex.from_dataset(dataset)
+    for query in range(0, len(dataset), 57):
+        query_song = dataset.iloc[query]
+        scan = evaluate_metrics(query_song, dataset, feature_columns, "cosine", 10)
+        indexed = evaluate_metrics(query_song, dataset, feature_columns, "cosine", 10, tag_index=tag_index)
+        assert indexed == pytest.approx(scan)
+
+
+def test_relevance_cache_is_bounded(catalogue):
+    dataset, _ = catalogue
+    ids = dataset["id"].values
+    bounded = TagIndex.from_dataset(dataset, cache_size=5)
+    for song_id in ids[:50]:
+        bounded.relevance_for_id(song_id)
+    assert list(bounded._cache) == list(ids[45:50])
@@ -0,0 +1,109 @@
+import json
+import threading
+
+import numpy as np
+
+from scripts import result_cache
+from scripts.relevance_computation import TagIndex
+from scripts.result_cache import ResultCache, cached_system_results
+
+
+def _system(catalogue):
+    dataset, feature_columns = catalogue
+    ids = dataset["id"].values
+    return ids, dataset[feature_columns].values, TagIndex.from_dataset(dataset)
+
+
+def test_second_run_is_served_from_the_cache(catalogue, tmp_path, monkeypatch):
+    ids, matrix, tag_index = _system(catalogue)
+    cache = ResultCache(str(tmp_path))
+    first = cached_system_results(cache, "synthetic", ids, matrix, tag_index, query_ids=ids[:50], block_size=16)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("cached queries were recomputed")
+
+    monkeypatch.setattr(result_cache, "top_k_by_similarity", fail)
+    second = cached_system_results(cache, "synthetic", ids, matrix, tag_index, query_ids=ids[:50], block_size=16)
+
+    assert first.keys() == second.keys()
+    for name in first:
+        np.testing.assert_array_equal(first[name], second[name])
+
+
+def test_only_new_queries_are_computed(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    computed = []
+
+    def compute_block(block_ids):
+        computed.append(list(block_ids))
+        return {"value": np.array([len(query_id) for query_id in block_ids])}
+
+    cache.get_or_compute({"run": 1}, {}, ["a", "bb"], compute_block)
+    result = cache.get_or_compute({"run": 1}, {}, ["ccc", "a", "bb"], compute_block)
+
+    assert computed == [["a", "bb"], ["ccc"]]
+    np.testing.assert_array_equal(result["value"], [3, 1, 2])
+
+
+def test_changed_inputs_invalidate_the_run(catalogue, tmp_path):
+    ids, matrix, tag_index = _system(catalogue)
+    cache = ResultCache(str(tmp_path))
+    cached_system_results(cache, "synthetic", ids, matrix, tag_index, query_ids=ids[:20])
+
+    changed = matrix.copy()
+    changed[0] += 1.0
+    results = cached_system_results(cache, "synthetic", ids, changed, tag_index, query_ids=ids[:20])
+    assert len(cache._read_index()) == 2
+
+    fresh = cached_system_results(ResultCache(str(tmp_path / "fresh")), "synthetic", ids, changed, tag_index, query_ids=ids[:20])
+    for name in fresh:
+        np.testing.assert_array_equal(results[name], fresh[name])
+
+
+def test_least_recently_used_runs_are_evicted(tmp_path):
+    cache = ResultCache(str(tmp_path), max_entries=2)
+
+    def compute_block(block_ids):
+        return {"value": np.zeros(len(block_ids))}
+
+    keys = []
+    for run in range(3):
+        cache.get_or_compute({"run": run}, {}, ["a"], compute_block)
+        keys.append(cache.run_key({"run": run}, {}))
+
+    assert sorted(cache._read_index()) == sorted(keys[1:])
+    assert not (tmp_path / keys[0]).exists()
+
+
+def test_index_updates_from_other_processes_are_kept(tmp_path):
+    cache = ResultCache(str(tmp_path))
+
+    def compute_block(block_ids):
+        return {"value": np.zeros(len(block_ids))}
+
+    cache.get_or_compute({"run": 0}, {}, ["a"], compute_block)
+    # Another process rewrote the index from a stale copy that misses run 0
+    (tmp_path / "index.json").write_text(json.dumps({"other": {"last_access": 0.0, "bytes": 0}}))
+    cache.get_or_compute({"run": 1}, {}, ["a"], compute_block)
+
+    keys = [cache.run_key({"run": run}, {}) for run in range(2)]
+    assert sorted(cache._read_index()) == sorted(keys + ["other"])
+
+
+def test_concurrent_runs_share_the_index(tmp_path):
+    def compute_block(block_ids):
+        return {"value": np.zeros(len(block_ids))}
+
+    def run(worker):
+        cache = ResultCache(str(tmp_path))
+        for run in range(5):
+            cache.get_or_compute({"worker": worker, "run": run}, {}, ["a", "b"], compute_block, block_size=1)
+
+    threads = [threading.Thread(target=run, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(ResultCache(str(tmp_path))._read_index()) == 40
+    assert not [path.name for path in tmp_path.rglob("*.tmp")]
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from scripts.retrieval_by_similarity import (
+    retrieve_n_songs_by_similarity,
+    top_k_by_similarity,
+    top_k_positions,
+    top_k_rows,
+)
+
+
+@pytest.fixture(scope="module")
+def tied_catalogue(catalogue):
+    """The synthetic catalogue with groups of identical embeddings (tied similarities)."""
+    dataset, feature_columns = catalogue
+    dataset = dataset.copy()
+    for group in range(0, 60, 6):
+        dataset.loc[group + 1 : group + 5, feature_columns] = dataset.loc[group, feature_columns].values
+    return dataset, feature_columns
+
+
+@pytest.mark.parametrize("metric", ["cosine", "euclidean"])
+def test_batched_top_k_matches_per_query_retrieval(tied_catalogue, metric):
+    dataset, feature_columns = tied_catalogue
+    query_rows = np.r_[np.arange(0, 60), np.arange(60, len(dataset), 13)]
+    indices, scores = top_k_by_similarity(query_rows, dataset[feature_columns].values, metric=metric, k=10, chunk_size=32)
+
+    for row, retrieved, retrieved_scores in zip(query_rows, indices, scores):
+        expected = retrieve_n_songs_by_similarity(dataset.iloc[row], dataset, feature_columns, metric, 10)
+        assert row not in retrieved
+        assert dataset["id"].values[retrieved].tolist() == expected["id"].tolist()
+        # sklearn upcasts float32 input blockwise, so distances of identical rows differ by ~1e-8
+        np.testing.assert_allclose(retrieved_scores, expected["similarity"].values, rtol=1e-10, atol=1e-6)
+
+
+def test_ties_are_broken_by_position():
+    scores = np.array([[1.0, 3.0, 2.0, 3.0, 2.0, 2.0, 0.5], [0.0] * 7, [5.0, 4.0, 3.0, 2.0, 1.0, 0.0, -1.0]])
+    np.testing.assert_array_equal(top_k_rows(scores, 3), [[1, 3, 2], [0, 1, 2], [0, 1, 2]])
+    for row in scores:
+        expected = np.argsort(-row, kind="stable")
+        for k in range(1, 8):
+            np.testing.assert_array_equal(top_k_positions(row, k), expected[:k])
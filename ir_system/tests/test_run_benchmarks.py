@@ -0,0 +1,23 @@
+import pytest
+
+from benchmarks.run_benchmarks import compare_to_baseline, run_benchmarks
+
+
+@pytest.fixture(scope="module")
+def report():
+    return run_benchmarks(scales=(200,), dim=8, n_tags=50, n_queries=10, stages=["top_k_by_similarity"], repeats=2)
+
+
+def test_identical_configurations_are_compared(report):
+    comparison = compare_to_baseline(report, report)
+    assert comparison["stage"].tolist() == ["top_k_by_similarity"]
+    assert not comparison["regression"].any()
+
+
+@pytest.mark.parametrize("key, value", [("dim", 16), ("N", 20), ("n_tags", 10), ("seed", 1)])
+def test_different_configurations_are_refused(report, key, value):
+    baseline = {**report, "config": {**report["config"], key: value}}
+    with pytest.raises(ValueError, match=key):
+        compare_to_baseline(report, baseline)
+    with pytest.warns(UserWarning, match=key):
+        compare_to_baseline(report, baseline, allow_config_mismatch=True)
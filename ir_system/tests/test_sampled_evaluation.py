@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from scripts.evaluation_metrics import run_evaluations
+from scripts.sampled_evaluation import run_evaluations_sampled, sample_order, sampled_evaluation
+
+
+def _constant(positions):
+    return {"NDCG@N": np.full(len(positions), 0.5)}
+
+
+def test_stops_once_the_interval_is_narrow_enough():
+    outcome = sampled_evaluation(_constant, 1000, stage_size=50, n_bootstrap=100, min_per_stratum=0)
+    assert outcome["converged"]
+    assert len(outcome["positions"]) == 50
+    assert outcome["estimates"]["NDCG@N"] == pytest.approx((0.5, 0.5, 0.5))
+
+
+def test_small_strata_are_filled_before_stopping():
+    # Three strata of 3, 40 and 957 queries; the first stages cannot cover the minimum of all of them
+    strata = np.repeat([0, 1, 2], [3, 40, 957])
+    outcome = sampled_evaluation(_constant, 1000, strata, stage_size=4, n_bootstrap=100, min_per_stratum=5)
+
+    assert outcome["converged"]
+    counts = np.bincount(strata[outcome["positions"]], minlength=3)
+    assert np.all(counts >= [3, 5, 5])
+    assert [stage["strata_below_minimum"] for stage in outcome["history"]][-1] == 0
+    assert outcome["history"][0]["strata_below_minimum"] > 0
+    # Floors come first, so sampling stops as soon as they are drawn
+    assert len(outcome["positions"]) == 16
+
+
+def test_wide_intervals_run_to_the_query_budget():
+    values = np.random.default_rng(0).random(1000)
+
+    def evaluate(positions):
+        return {"NDCG@N": values[positions]}
+
+    outcome = sampled_evaluation(evaluate, 1000, target_ci_width=1e-6, stage_size=100, max_queries=300, n_bootstrap=100)
+    assert not outcome["converged"]
+    assert len(outcome["history"]) == 3
+    assert len(np.unique(outcome["positions"])) == 300
+
+    widths = [stage["max_ci_width"] for stage in outcome["history"]]
+    assert widths[-1] < widths[0]
+
+
+def test_sample_order_prefixes_are_stratified():
+    strata = np.repeat([0, 1, 2], [100, 300, 600])
+    order = sample_order(1000, strata, seed=3)
+    assert sorted(order) == list(range(1000))
+    for m in (10, 100, 500):
+        counts = np.bincount(strata[order[:m]], minlength=3)
+        np.testing.assert_allclose(counts, np.array([0.1, 0.3, 0.6]) * m, atol=1)
+
+
+def test_full_sample_matches_the_exhaustive_evaluation(catalogue):
+    dataset, feature_columns = catalogue
+    exhaustive = run_evaluations(np.arange(len(dataset)), dataset, feature_columns, ["cosine"], N=10)
+    sampled, metadata = run_evaluations_sampled(
+        dataset, feature_columns, ["cosine"], N=10, strata_column="genre", target_ci_width=0.0, n_bootstrap=50
+    )
+
+    assert metadata["n_queries"] == len(dataset)
+    for key in ("Precision@N", "Recall@N", "NDCG@N", "MRR"):
+        assert sampled["cosine"][key] == pytest.approx(exhaustive["cosine"][key])
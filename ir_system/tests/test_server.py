@@ -0,0 +1,152 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+# server.py lives at the repository root, next to ir_system
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from scripts.ann_index import ExactIndex  # noqa: E402
+from scripts.embedding_store import convert_tsv_to_store  # noqa: E402
+from server import LRUCache, MicroBatcher, QueryService, Stats, make_handler  # noqa: E402
+
+
+class FailingIndex:
+    """ExactIndex wrapper whose search fails whenever a 'bad' row is in the batch."""
+
+    def __init__(self, index, bad_row):
+        self.index = index
+        self.bad_row = bad_row
+        self.batches = []
+
+    def search(self, rows, k):
+        self.batches.append(list(rows))
+        if self.bad_row in rows:
+            raise ValueError("bad query")
+        return self.index.search(rows, k)
+
+
+def _submit_together(batcher, requests):
+    async def main():
+        runner = asyncio.ensure_future(batcher.run())
+        results = await asyncio.gather(*(batcher.submit(row, k) for row, k in requests), return_exceptions=True)
+        runner.cancel()
+        return results
+
+    return asyncio.run(main())
+
+
+@pytest.fixture(scope="module")
+def exact_index(catalogue):
+    dataset, feature_columns = catalogue
+    return ExactIndex("cosine").build(dataset[feature_columns].values)
+
+
+def test_batched_requests_match_single_searches(exact_index):
+    stats = Stats()
+    batcher = MicroBatcher(exact_index, stats, max_batch=64, max_wait_ms=50)
+    requests = [(row, 5 + row % 3) for row in range(0, 100, 10)]
+
+    results = _submit_together(batcher, requests)
+
+    assert stats.snapshot()["batches"] == 1
+    for (row, k), (indices, scores) in zip(requests, results):
+        expected_indices, expected_scores = exact_index.search([row], k)
+        np.testing.assert_array_equal(indices, expected_indices[0])
+        np.testing.assert_allclose(scores, expected_scores[0])
+
+
+def test_failed_batch_only_fails_the_bad_request(exact_index):
+    index = FailingIndex(exact_index, bad_row=30)
+    batcher = MicroBatcher(index, Stats(), max_batch=64, max_wait_ms=50)
+    requests = [(row, 5) for row in range(0, 60, 10)]
+
+    results = _submit_together(batcher, requests)
+
+    assert index.batches[0] == [row for row, _ in requests]
+    for (row, _), result in zip(requests, results):
+        if row == 30:
+            assert isinstance(result, ValueError)
+        else:
+            np.testing.assert_array_equal(result[0], exact_index.search([row], 5)[0][0])
+
+
+def test_lru_cache_evicts_the_least_recently_used():
+    cache = LRUCache(max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert len(cache) == 2
+
+
+@pytest.fixture(scope="module")
+def service(catalogue, tmp_path_factory):
+    dataset, feature_columns = catalogue
+    store_dir = tmp_path_factory.mktemp("store")
+    tsv_path = store_dir / "features.tsv"
+    dataset[["id"] + feature_columns].to_csv(tsv_path, sep="\t", index=False)
+    convert_tsv_to_store(str(tsv_path), "BERT", str(store_dir))
+    return QueryService(str(store_dir), systems=["BERT"], metrics=["cosine"], max_k=20)
+
+
+@pytest.fixture(scope="module")
+def base_url(service):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(service))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def _get(url):
+    try:
+        with urllib.request.urlopen(url) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+def test_repeated_searches_are_cached(service, catalogue):
+    song_id = catalogue[0]["id"].iloc[3]
+    first = service.search(song_id, "BERT", k=5)
+    second = service.search(song_id, "BERT", k=5)
+    assert not first["cached"] and second["cached"]
+    assert first["results"] == second["results"]
+    assert len(first["results"]) == 5 and song_id not in [r["id"] for r in first["results"]]
+
+
+@pytest.mark.parametrize(
+    "query, status",
+    [
+        ("/search?id=song0000001&system=BERT&k=5", 200),
+        ("/search?id=unknown&system=BERT", 404),
+        ("/search?id=song0000001&system=VGG19", 404),
+        ("/search?id=song0000001&system=BERT&k=500", 400),
+        ("/search?id=song0000001&system=BERT&k=ten", 400),
+        ("/search?system=BERT", 404),
+        ("/systems", 200),
+        ("/stats", 200),
+        ("/unknown", 404),
+    ],
+)
+def test_status_codes(base_url, query, status):
+    code, payload = _get(base_url + query)
+    assert code == status
+    if status != 200:
+        assert "error" in payload
+
+
+def test_search_failures_are_server_errors(service, monkeypatch):
+    batcher = service.batchers[("BERT", "cosine")]
+    monkeypatch.setattr(batcher, "index", FailingIndex(batcher.index, bad_row=2))
+    with pytest.raises(RuntimeError, match="bad query"):
+        service.search(service.feature_spaces["BERT"].ids[2], "BERT", k=7)
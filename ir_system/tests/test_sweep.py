@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from scripts.sweep import FusionSweep
+
+
+def _sweep(catalogue, **kwargs):
+    dataset, feature_columns = catalogue
+    systems = {"first": feature_columns[:8], "second": feature_columns[8:]}
+    query_ids = dataset["id"].values[::10]
+    return FusionSweep({name: dataset for name in systems}, systems, query_ids, **kwargs)
+
+
+def _row(frame, **config):
+    mask = np.ones(len(frame), dtype=bool)
+    for name, value in config.items():
+        mask &= frame[name] == value
+    assert mask.sum() == 1
+    return frame[mask].iloc[0]
+
+
+def test_configuration_does_not_depend_on_the_grid(catalogue):
+    config = {"strategy": "weighted", "normalization": "minmax", "metric": "cosine", "N": 10}
+    alone = _sweep(catalogue).run({key: [value] for key, value in config.items()})
+    wider = _sweep(catalogue).run({**{key: [value] for key, value in config.items()}, "N": [10, 100]})
+
+    for key in ("NDCG@N", "MRR", "Precision@N", "Div@N", "AvgPop@N"):
+        assert _row(alone, **config)[key] == pytest.approx(_row(wider, **config)[key])
+
+
+def test_configuration_does_not_depend_on_earlier_runs(catalogue):
+    sweep = _sweep(catalogue)
+    before = sweep.run({"N": [10]})
+    sweep.run({"N": [100]})
+    after = sweep.run({"N": [10]})
+    assert before["NDCG@N"].tolist() == pytest.approx(after["NDCG@N"].tolist())
+
+
+def test_N_larger_than_depth_is_rejected(catalogue):
+    with pytest.raises(ValueError):
+        _sweep(catalogue, depth=20).run({"N": [10, 50]})
+
+
+def test_query_missing_from_a_system_is_rejected(catalogue):
+    dataset, feature_columns = catalogue
+    systems = {"first": feature_columns[:8], "second": feature_columns[8:]}
+    datasets = {"first": dataset.iloc[1:], "second": dataset}
+    sweep = FusionSweep(datasets, systems, dataset["id"].values[:5], base_dataset=dataset)
+    with pytest.raises(KeyError, match=dataset["id"].iloc[0]):
+        sweep.neighbours("first", "cosine", 10)
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import make_tags
+from scripts.neighbour_graph import build_neighbour_graph
+from scripts.tradeoff_evaluation import evaluate_tradeoffs, evaluate_tradeoffs_thresholds, retrieve_rows
+
+
+def _graph(dataset, feature_columns):
+    return build_neighbour_graph("synthetic", dataset["id"].values, dataset[feature_columns].values, k_max=20)
+
+
+def test_graph_rows_match_the_batched_engine(catalogue):
+    dataset, feature_columns = catalogue
+    query_indices = np.arange(0, len(dataset), 7)
+    from_graph = retrieve_rows(query_indices, dataset, feature_columns, "cosine", 10, _graph(dataset, feature_columns))
+    direct = retrieve_rows(query_indices, dataset, feature_columns, "cosine", 10)
+    np.testing.assert_array_equal(from_graph, direct)
+
+
+def test_graph_neighbours_missing_from_the_dataset_are_rejected(catalogue):
+    dataset, feature_columns = catalogue
+    graph = _graph(dataset, feature_columns)
+    subset = dataset.iloc[::2].reset_index(drop=True)
+    with pytest.raises(ValueError, match="missing from the dataset"):
+        retrieve_rows(np.arange(10), subset, feature_columns, "cosine", 10, graph)
+
+
+def test_thresholds_match_evaluate_tradeoffs(catalogue):
+    dataset, feature_columns = catalogue
+    dataset = dataset.copy()
+    dataset["diversity tags"] = make_tags(len(dataset), n_tags=40, mean_tags=8, seed=11)
+    query_indices = np.arange(0, len(dataset), 8)
+    datasets = {"features": dataset}
+    systems = {"features": feature_columns}
+
+    serial = evaluate_tradeoffs(query_indices, datasets, systems, ["cosine"], "diversity tags", "popularity", N=10)
+    thresholds = evaluate_tradeoffs_thresholds(
+        query_indices, datasets, systems, ["cosine"], "diversity tags", "popularity", [60], N=10
+    )
+    for key in ("NDCG@N", "Div@N", "AvgPop@N"):
+        assert thresholds[key].iloc[0] == pytest.approx(serial[key].iloc[0], abs=1e-12)
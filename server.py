@@ -1,29 +1,353 @@
-# This is an example of a simple Flask server that serves a TSV file and a JSON file.
+# Local query service: answers top-K requests from warm in-memory indexes.
+#
+#   python server.py --port 5000
+#   GET /search?id=<song id>&system=BERT&metric=cosine&k=10
+#   GET /systems
+#   GET /stats
+#
+# Feature spaces are read from the embedding store (see ir_system/scripts/embedding_store.py),
+# so convert them once with `convert_all_feature_spaces()` before starting the server.
 
+import argparse
+import ast
+import asyncio
+import concurrent.futures
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 
-# from flask import Flask, jsonify, send_from_directory
-# import os, json
+import numpy as np
+import pandas as pd
 
-# app = Flask(__name__)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "ir_system"))
 
-# DATA_DIR = "data"
+from scripts.ann_index import DEFAULT_ANN_CONFIG, build_index  # noqa: E402
+from scripts.embedding_store import FEATURE_SPACE_FILES, has_feature_space, load_feature_space  # noqa: E402
+from scripts.relevance_computation import TagIndex  # noqa: E402
 
 
-# @app.route("/api/dataset")
-# def get_dataset():
-#     # Return the TSV file as text
-#     return send_from_directory(
-#         DATA_DIR, "merged_dataset.tsv", mimetype="text/tab-separated-values"
-#     )
+class LRUCache:
+    """Thread-safe LRU cache of responses."""
 
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
 
-# @app.route("/api/cache")
-# def get_cache():
-#     # Return the JSON content
-#     with open(os.path.join(DATA_DIR, "fb5d6.json"), "r") as f:
-#         data = json.load(f)
-#     return jsonify(data)
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
 
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
 
-# if __name__ == "__main__":
-#     app.run(host="0.0.0.0", port=5000, debug=True)
+    def __len__(self):
+        return len(self._items)
+
+
+class Stats:
+    """Request counters and latency percentiles over the most recent requests."""
+
+    def __init__(self, window=10000):
+        self.start_time = time.time()
+        self.requests = 0
+        self.cache_hits = 0
+        self.errors = 0
+        self.latencies_ms = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record_request(self, latency_ms, cache_hit):
+        with self._lock:
+            self.requests += 1
+            self.cache_hits += int(cache_hit)
+            self.latencies_ms.append(latency_ms)
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def record_batch(self, size):
+        with self._lock:
+            self.batch_sizes.append(size)
+
+    def snapshot(self):
+        with self._lock:
+            uptime = time.time() - self.start_time
+            latencies = np.asarray(self.latencies_ms)
+            batch_sizes = np.asarray(self.batch_sizes)
+            percentiles = (
+                {f"p{p}": float(np.percentile(latencies, p)) for p in (50, 90, 99)}
+                if len(latencies)
+                else {}
+            )
+            return {
+                "uptime_s": uptime,
+                "requests": self.requests,
+                "errors": self.errors,
+                "throughput_qps": self.requests / uptime if uptime > 0 else 0.0,
+                "cache_hit_rate": self.cache_hits / self.requests if self.requests else 0.0,
+                "latency_ms": percentiles,
+                "batches": len(batch_sizes),
+                "mean_batch_size": float(batch_sizes.mean()) if len(batch_sizes) else 0.0,
+            }
+
+
+class MicroBatcher:
+    """
+    Collects concurrent requests for one system and metric and answers them with a
+    single batched search.
+
+    The first request of a batch waits at most `max_wait_ms` for others to join, and a
+    batch is capped at `max_batch` requests. If the batched search fails, its requests
+    are retried one by one, so a bad request only fails itself.
+    """
+
+    def __init__(self, index, stats, max_batch=64, max_wait_ms=2.0):
+        self.index = index
+        self.stats = stats
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+
+    async def submit(self, row, k):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((row, k, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._answer(batch)
+
+    async def _answer(self, batch):
+        loop = asyncio.get_running_loop()
+        rows = [row for row, _, _ in batch]
+        k = max(k for _, k, _ in batch)
+        try:
+            indices, scores = await loop.run_in_executor(None, self.index.search, rows, k)
+        except Exception as error:
+            if len(batch) == 1:
+                _, _, future = batch[0]
+                if not future.done():
+                    future.set_exception(error)
+                return
+            for request in batch:
+                if not request[2].done():
+                    await self._answer([request])
+            return
+        self.stats.record_batch(len(batch))
+        for i, (_, request_k, future) in enumerate(batch):
+            # Requests that timed out were cancelled by their caller
+            if not future.done():
+                future.set_result((indices[i, :request_k], scores[i, :request_k]))
+
+
+class QueryService:
+    """
+    Feature spaces, search indexes and tag index loaded once, served through
+    per-(system, metric) micro-batchers running on a background event loop.
+    """
+
+    def __init__(
+        self,
+        store_dir,
+        tags_file=None,
+        systems=None,
+        metrics=("cosine",),
+        use_ann=False,
+        max_batch=64,
+        max_wait_ms=2.0,
+        cache_size=10000,
+        max_k=100,
+    ):
+        self.stats = Stats()
+        self.cache = LRUCache(cache_size)
+        self.max_k = max_k
+        self.feature_spaces = {}
+        self.batchers = {}
+
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+        for system in systems or FEATURE_SPACE_FILES:
+            if not has_feature_space(system, store_dir):
+                print(f"Skipping {system}: not in the embedding store {store_dir}.")
+                continue
+            feature_space = load_feature_space(system, store_dir)
+            self.feature_spaces[system] = feature_space
+            for metric in metrics:
+                start = time.perf_counter()
+                index = build_index(
+                    system, feature_space.matrix, metric, config=DEFAULT_ANN_CONFIG if use_ann else {}
+                )
+                batcher = MicroBatcher(index, self.stats, max_batch, max_wait_ms)
+                self.batchers[(system, metric)] = batcher
+                asyncio.run_coroutine_threadsafe(batcher.run(), self.loop)
+                print(f"Loaded {system} ({metric}) in {time.perf_counter() - start:.1f}s.")
+
+        self.tag_index = None
+        if tags_file is not None and os.path.exists(tags_file):
+            tags = pd.read_csv(tags_file, sep="\t")
+            tags.columns = tags.columns.str.strip()
+            tags["(tag, weight)"] = tags["(tag, weight)"].apply(ast.literal_eval)
+            self.tag_index = TagIndex.from_dataset(tags)
+
+    def systems(self):
+        return [
+            {"system": system, "metric": metric, "n_songs": len(self.feature_spaces[system].ids)}
+            for system, metric in self.batchers
+        ]
+
+    def search(self, song_id, system, metric="cosine", k=10, timeout=30):
+        start = time.perf_counter()
+        key = (system, metric, song_id, k)
+        response = self.cache.get(key)
+        cache_hit = response is not None
+
+        if not cache_hit:
+            if (system, metric) not in self.batchers:
+                raise KeyError(f"Unknown system/metric: {system}/{metric}")
+            if not 1 <= k <= self.max_k:
+                raise ValueError(f"k must be between 1 and {self.max_k}")
+            feature_space = self.feature_spaces[system]
+            row = feature_space.id_to_row.get(song_id)
+            if row is None:
+                raise KeyError(f"Unknown song id: {song_id}")
+
+            future = asyncio.run_coroutine_threadsafe(
+                self.batchers[(system, metric)].submit(row, k), self.loop
+            )
+            try:
+                indices, scores = future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                raise TimeoutError(f"Search timed out after {timeout}s") from None
+            except Exception as error:
+                # Failures inside the micro-batch are server errors, whatever their type
+                raise RuntimeError(f"Search failed: {error}") from error
+            indices, scores = indices[indices >= 0], scores[indices >= 0]
+            result_ids = feature_space.ids[indices].tolist()
+
+            results = [{"id": result_id, "score": float(score)} for result_id, score in zip(result_ids, scores)]
+            if self.tag_index is not None and song_id in self.tag_index.id_to_row:
+                known = [r for r in results if r["id"] in self.tag_index.id_to_row]
+                grades = self.tag_index.pairwise_relevance(
+                    np.full(len(known), self.tag_index.id_to_row[song_id]),
+                    self.tag_index.rows_for_ids([r["id"] for r in known]),
+                )
+                for result, grade in zip(known, grades):
+                    result["relevance"] = float(grade)
+
+            response = {"id": song_id, "system": system, "metric": metric, "k": k, "results": results}
+            self.cache.put(key, response)
+
+        latency_ms = (time.perf_counter() - start) * 1000
+        self.stats.record_request(latency_ms, cache_hit)
+        return {**response, "cached": cache_hit, "latency_ms": latency_ms}
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            try:
+                if url.path == "/search":
+                    self._send(
+                        200,
+                        service.search(
+                            params["id"],
+                            params["system"],
+                            params.get("metric", "cosine"),
+                            int(params.get("k", 10)),
+                        ),
+                    )
+                elif url.path == "/systems":
+                    self._send(200, service.systems())
+                elif url.path == "/stats":
+                    self._send(200, {**service.stats.snapshot(), "cache_size": len(service.cache)})
+                else:
+                    self._send(404, {"error": f"Unknown endpoint {url.path}"})
+            except KeyError as error:
+                service.stats.record_error()
+                self._send(404, {"error": str(error).strip("'\"")})
+            except ValueError as error:
+                service.stats.record_error()
+                self._send(400, {"error": str(error)})
+            except TimeoutError as error:
+                service.stats.record_error()
+                self._send(504, {"error": str(error)})
+            except Exception as error:
+                service.stats.record_error()
+                self._send(500, {"error": f"Internal error: {error}"})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local top-K query service.")
+    parser.add_argument("--host", default="127.0.0.1", help="Use 0.0.0.0 to accept remote connections.")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--store-dir", default="dataset/store")
+    parser.add_argument("--tags-file", default="dataset/id_tags_dict.tsv")
+    parser.add_argument("--systems", nargs="*", default=None)
+    parser.add_argument("--metrics", nargs="*", default=["cosine", "euclidean"])
+    parser.add_argument("--ann", action="store_true", help="Use IVF indexes for the high-dimensional systems.")
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-wait-ms", type=float, default=2.0)
+    parser.add_argument("--cache-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    service = QueryService(
+        args.store_dir,
+        tags_file=args.tags_file,
+        systems=args.systems,
+        metrics=args.metrics,
+        use_ann=args.ann,
+        max_batch=args.max_batch,
+        max_wait_ms=args.max_wait_ms,
+        cache_size=args.cache_size,
+    )
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    print(f"Serving {len(service.batchers)} system(s) on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
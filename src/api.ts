@@ -1,4 +1,10 @@
-import { DatasetRow, PrecomputedData, MetadataByFile } from "./api.types";
+import {
+  BinaryHeader,
+  BinarySection,
+  DatasetRow,
+  PrecomputedData,
+  MetadataByFile,
+} from "./api.types";
 
 export async function fetchDataset(): Promise<DatasetRow[]> {
   const res = await fetch("data/merged_dataset.tsv");
@@ -83,3 +89,106 @@ export async function fetchPrecomputedData(
 
   return json as PrecomputedData;
 }
+
+const PRECOMPUTED_DIR = "data/precomputed_systems/";
+
+const binaryHeaders: Record<string, BinaryHeader> = {};
+const idDictionaries: Record<
+  string,
+  { ids: string[]; index: Map<string, number> }
+> = {};
+const queryRowsByFile: Record<string, Map<number, number>> = {};
+
+async function fetchJson<T>(path: string): Promise<T> {
+  const res = await fetch(path);
+  if (!res.ok) {
+    throw new Error(`HTTP error! status: ${res.status}`);
+  }
+  return res.json();
+}
+
+// Fetch bytes [start, end) of a file; falls back to slicing if ranges are unsupported
+async function fetchByteRange(
+  path: string,
+  start: number,
+  end: number
+): Promise<ArrayBuffer> {
+  const res = await fetch(path, {
+    headers: { Range: `bytes=${start}-${end - 1}` },
+  });
+  if (!res.ok) {
+    throw new Error(`HTTP error! status: ${res.status}`);
+  }
+  const buffer = await res.arrayBuffer();
+  return res.status === 206 ? buffer : buffer.slice(start, end);
+}
+
+async function fetchSection(
+  path: string,
+  section: BinarySection,
+  row?: number
+): Promise<Int32Array> {
+  const rowLength = section.shape.slice(1).reduce((a, b) => a * b, 1);
+  const rowBytes = rowLength * 4;
+  const start = section.offset + (row ?? 0) * rowBytes;
+  const end =
+    row === undefined
+      ? section.offset + section.shape[0] * rowBytes
+      : start + rowBytes;
+  return new Int32Array(await fetchByteRange(path, start, end));
+}
+
+export async function fetchBinaryHeader(
+  headerFilename: string
+): Promise<BinaryHeader> {
+  if (!binaryHeaders[headerFilename]) {
+    binaryHeaders[headerFilename] = await fetchJson<BinaryHeader>(
+      PRECOMPUTED_DIR + headerFilename
+    );
+  }
+  return binaryHeaders[headerFilename];
+}
+
+async function fetchIdDictionary(idsFile: string) {
+  if (!idDictionaries[idsFile]) {
+    const ids = await fetchJson<string[]>(PRECOMPUTED_DIR + idsFile);
+    const index = new Map(ids.map((id, i): [string, number] => [id, i]));
+    idDictionaries[idsFile] = { ids, index };
+  }
+  return idDictionaries[idsFile];
+}
+
+// Results of a single query from a binary export (see ir_system/scripts/binary_export.py),
+// fetched with one byte-range request instead of downloading the whole system.
+export async function fetchPrecomputedRow(
+  headerFilename: string,
+  queryId: string
+): Promise<string[]> {
+  const header = await fetchBinaryHeader(headerFilename);
+  const dictionary = await fetchIdDictionary(header.ids_file);
+  const binaryPath = PRECOMPUTED_DIR + header.binary_file;
+
+  const queryIndex = dictionary.index.get(queryId);
+  if (queryIndex === undefined) {
+    return [];
+  }
+
+  let row: number | undefined = queryIndex;
+  if (!header.queries_are_dictionary) {
+    if (!queryRowsByFile[headerFilename]) {
+      const queries = await fetchSection(binaryPath, header.sections.queries);
+      queryRowsByFile[headerFilename] = new Map(
+        Array.from(queries, (index, i): [number, number] => [index, i])
+      );
+    }
+    row = queryRowsByFile[headerFilename].get(queryIndex);
+  }
+  if (row === undefined) {
+    return [];
+  }
+
+  const indices = await fetchSection(binaryPath, header.sections.indices, row);
+  return Array.from(indices)
+    .filter((index) => index >= 0)
+    .map((index) => dictionary.ids[index]);
+}
@@ -47,3 +47,25 @@ export interface PrecomputedData {
   metadata: Metadata;
   content: Record<string, string[]>;
 }
+
+export interface BinarySection {
+  offset: number;
+  dtype: string;
+  shape: number[];
+}
+
+export interface BinaryHeader {
+  format: string;
+  version: number;
+  metadata: Metadata;
+  n_queries: number;
+  k: number;
+  ids_file: string;
+  binary_file: string;
+  queries_are_dictionary: boolean;
+  sections: {
+    indices: BinarySection;
+    scores?: BinarySection;
+    queries: BinarySection;
+  };
+}